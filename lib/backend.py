@@ -5,12 +5,42 @@ import base64
 import subprocess
 import dataclasses
 import logging
-from asyncio import wait, sleep, gather, Semaphore, FIRST_COMPLETED, create_task
-from typing import Tuple, Awaitable, NoReturn, List, Union, Callable, Optional
-from functools import cached_property
+from asyncio import (
+    wait,
+    sleep,
+    gather,
+    Semaphore,
+    FIRST_COMPLETED,
+    create_task,
+    get_running_loop,
+    TimeoutError as AsyncioTimeoutError,
+)
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import (
+    Tuple,
+    Dict,
+    Deque,
+    Awaitable,
+    NoReturn,
+    List,
+    Union,
+    Callable,
+    Optional,
+    Any,
+    TypeVar,
+)
+from functools import cached_property, cache
 
 from anyio import open_file
-from aiohttp import web, ClientResponse, ClientSession, ClientConnectorError
+from aiohttp import (
+    web,
+    ClientResponse,
+    ClientSession,
+    ClientConnectorError,
+    ClientError,
+    ClientTimeout,
+)
 
 import requests
 from Crypto.Signature import pkcs1_15
@@ -18,12 +48,23 @@ from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 
 from lib.metrics import Metrics
+from lib.tracing import Tracer, RequestContext, REQUEST_ID_HEADER
+from lib.capture import Capture, CAPTURE_FILE
+from lib.watchdog import Watchdog, WATCHDOG_PROBE_TIMEOUT
+from lib.load_progress import LoadProgressExtractor
 from lib.data_types import (
     AuthData,
     EndpointHandler,
     LogAction,
     ApiPayload_T,
     JsonDataException,
+    WarmupResult,
+    StreamStats,
+    USAGE_KEY,
+    STREAM_STATS_KEY,
+    CANCELLED_KEY,
+    CPU_BOUND_ATTR,
+    cpu_bound,
 )
 
 MSG_HISTORY_LEN = 100
@@ -33,6 +74,30 @@ log = logging.getLogger(__file__)
 LOG_POLL_INTERVAL = 0.1
 BENCHMARK_INDICATOR_FILE = ".has_benchmark"
 MAX_PUBKEY_FETCH_ATTEMPTS = 3
+# public key of the autoscaler, that signs the requests workers receive. See lib.fake_autoscaler for local use
+PUBKEY_URL = os.environ.get("PUBKEY_URL", "https://run.vast.ai/pubkey/")
+
+T = TypeVar("T")
+
+
+@cache
+def import_pubkey(pubkey_pem: bytes) -> RSA.RsaKey:
+    return RSA.import_key(pubkey_pem)
+
+
+@cpu_bound
+def verify_signature(pubkey_pem: bytes, message: str, signature: str) -> bool:
+    h = SHA256.new(message.encode())
+    try:
+        pkcs1_15.new(import_pubkey(pubkey_pem)).verify(h, base64.b64decode(signature))
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def _timed_call(hook: Callable[..., T], args: Tuple[Any, ...]) -> Tuple[float, T]:
+    """runs in the hook executor, returns the time the hook started at alongside its result"""
+    return time.time(), hook(*args)
 
 
 @dataclasses.dataclass
@@ -53,12 +118,31 @@ class Backend:
     )
     log_actions: List[Tuple[LogAction, str]]
     reqnum = -1
-    msg_history = []
+    # signed messages of the last requests, so that a message can't be replayed
+    msg_history: Deque[Dict[str, Any]] = dataclasses.field(
+        default_factory=lambda: deque(maxlen=MSG_HISTORY_LEN)
+    )
     sem: Semaphore = dataclasses.field(default_factory=Semaphore)
+    # executor that CPU bound hooks run in, "thread" or "process", see lib.data_types.cpu_bound
+    hook_executor: str = "thread"
+    hook_max_workers: Optional[int] = None
+    pubkey_url: str = PUBKEY_URL
+    # set once the worker stops admitting requests before it stops, see lib.server
+    draining: bool = False
+    # parse the model's download progress from its log lines while it loads, see lib.load_progress
+    load_progress_extractors: List[LoadProgressExtractor] = dataclasses.field(
+        default_factory=list
+    )
 
     def __post_init__(self):
-        self.metrics = Metrics()
+        self.metrics = Metrics(
+            max_concurrency=None if self.allow_parallel_requests else 1
+        )
+        self.tracer = Tracer(registry=self.metrics.registry)
+        self.watchdog = Watchdog(registry=self.metrics.registry)
+        self.capture = Capture(CAPTURE_FILE) if CAPTURE_FILE else None
         self._total_pubkey_fetch_errors = 0
+        self._pubkey_pem: Optional[bytes] = None
         self._pubkey = self._fetch_pubkey()
 
     @property
@@ -67,11 +151,56 @@ class Backend:
             self._pubkey = self._fetch_pubkey()
         return self._pubkey
 
+    @property
+    def pubkey_pem(self) -> Optional[bytes]:
+        """
+        the pubkey in PEM format, which is what verify_signature is passed as RSA keys can't be pickled, exported
+        once rather than for every request
+        """
+        if self._pubkey_pem is None and self.pubkey is not None:
+            self._pubkey_pem = self.pubkey.export_key()
+        return self._pubkey_pem
+
     @cached_property
     def session(self):
         log.debug(f"starting session with {self.model_server_url}")
         return ClientSession(self.model_server_url)
 
+    @cached_property
+    def executor(self) -> Executor:
+        log.debug(f"starting {self.hook_executor} pool for CPU bound hooks")
+        match self.hook_executor:
+            case "thread":
+                return ThreadPoolExecutor(
+                    max_workers=self.hook_max_workers,
+                    thread_name_prefix="pyworker-hook",
+                )
+            case "process":
+                return ProcessPoolExecutor(max_workers=self.hook_max_workers)
+            case executor:
+                raise Exception(f"Unsupported hook executor: {executor}")
+
+    async def run_hook(self, hook: Callable[..., T], *args: Any) -> T:
+        """
+        calls a handler hook. Hooks marked with `lib.data_types.cpu_bound` are run in the hook executor so
+        that the event loop only does I/O, other hooks are called directly
+        """
+        if not getattr(hook, CPU_BOUND_ATTR, False):
+            return hook(*args)
+        self.metrics._hook_queued()
+        queued_at = time.time()
+        try:
+            started_at, result = await get_running_loop().run_in_executor(
+                self.executor, _timed_call, hook, args
+            )
+        except BaseException:
+            self.metrics._hook_done(wait_time=0.0, run_time=time.time() - queued_at)
+            raise
+        self.metrics._hook_done(
+            wait_time=started_at - queued_at, run_time=time.time() - started_at
+        )
+        return result
+
     def create_handler(
         self,
         handler: EndpointHandler[ApiPayload_T],
@@ -79,13 +208,31 @@ class Backend:
         async def handler_fn(
             request: web.Request,
         ) -> Union[web.Response, web.StreamResponse]:
-            return await self.__handle_request(handler=handler, request=request)
+            start = time.perf_counter()
+            ctx = self.tracer.start(request)
+            res = await self.__handle_request(handler=handler, request=request, ctx=ctx)
+            latency = time.perf_counter() - start
+            self.tracer.finish(ctx, status=res.status)
+            if self.capture:
+                self.capture.record(ctx, status=res.status, latency=latency)
+            self.metrics._response_sent(
+                endpoint=request.path,
+                status=res.status,
+                latency=latency,
+                # streamed responses have no content length, but are already sent
+                response_bytes=(
+                    res.body_length
+                    if res.content_length is None
+                    else res.content_length
+                ),
+            )
+            return res
 
         return handler_fn
 
     #######################################Private#######################################
     def _fetch_pubkey(self):
-        command = ["curl", "-X", "GET", "https://run.vast.ai/pubkey/"]
+        command = ["curl", "-X", "GET", self.pubkey_url]
         result = subprocess.check_output(command, universal_newlines=True)
         log.debug("public key:")
         log.debug(result)
@@ -107,16 +254,27 @@ class Backend:
         self,
         handler: EndpointHandler[ApiPayload_T],
         request: web.Request,
+        ctx: RequestContext,
     ) -> Union[web.Response, web.StreamResponse]:
         """use this function to forward requests to the model endpoint"""
+        if self.draining:
+            # i.e. sent on a keep-alive connection after the worker stopped listening
+            return web.Response(status=503)
         try:
-            data = await request.json()
-            auth_data, payload = handler.get_data_from_request(data)
+            with ctx.span("parse"):
+                data = await request.json()
+                auth_data, payload = await self.run_hook(
+                    handler.get_data_from_request, data
+                )
         except JsonDataException as e:
             return web.json_response(data=e.message, status=422)
         except json.JSONDecodeError:
             return web.json_response(dict(error="invalid JSON"), status=422)
-        workload = payload.count_workload()
+        with ctx.span("workload"):
+            workload = await self.run_hook(payload.count_workload)
+        ctx.workload = workload
+        ctx.payload = data.get("payload")
+        self.metrics.request_workload.observe(workload, request.path)
 
         async def wait_for_disconnection() -> None:
             while request.transport and not request.transport.is_closing():
@@ -131,17 +289,33 @@ class Backend:
         async def make_request() -> Union[web.Response, web.StreamResponse]:
             log.debug(f"got request, {auth_data.reqnum}")
             self.metrics._request_start(workload=workload, reqnum=auth_data.reqnum)
+            queued_at = time.perf_counter()
             if self.allow_parallel_requests is False:
                 log.debug(f"Waiting to aquire Sem for reqnum:{auth_data.reqnum}")
-                await self.sem.acquire()
+                with ctx.span("queue"):
+                    await self.sem.acquire()
                 log.debug(
                     f"Sem acquired for reqnum:{auth_data.reqnum}, starting request..."
                 )
             else:
                 log.debug(f"Starting request for reqnum:{auth_data.reqnum}")
+            self.metrics.queue_wait.observe(
+                time.perf_counter() - queued_at, request.path
+            )
+            response = None
+            start_time = time.time()
+            stream_stats = StreamStats(request_start=start_time)
+            request[STREAM_STATS_KEY] = stream_stats
+            self.watchdog.watch_stream(stream_stats)
             try:
-                start_time = time.time()
-                response = await self.__call_api(handler=handler, payload=payload)
+                with ctx.span("upstream"):
+                    response = await self.__call_api(
+                        handler=handler, payload=payload, request_id=ctx.request_id
+                    )
+                self.watchdog.progress()
+                self.metrics.upstream_latency.observe(
+                    time.time() - start_time, request.path
+                )
                 status_code = response.status
                 log.debug(
                     " ".join(
@@ -151,25 +325,49 @@ class Backend:
                         ]
                     )
                 )
-                res = await handler.generate_client_response(request, response)
+                with ctx.span("response"):
+                    res = await handler.generate_client_response(request, response)
+                self.watchdog.progress()
+                if request.get(CANCELLED_KEY):
+                    log.debug(
+                        f"client of reqnum: {auth_data.reqnum} disconnected during the response"
+                    )
+                    self.metrics._request_canceled(
+                        workload=workload, reqnum=auth_data.reqnum
+                    )
+                    return res
+                usage = request.get(USAGE_KEY)
                 self.metrics._request_end(
                     workload=workload,
                     req_response_time=time.time() - start_time,
                     reqnum=auth_data.reqnum,
+                    actual_workload=(
+                        payload.count_actual_workload(usage) if usage else None
+                    ),
+                    stream_stats=stream_stats,
                 )
                 return res
-            except requests.exceptions.RequestException as e:
+            except (requests.exceptions.RequestException, ClientError) as e:
+                # requests to the model API are made with aiohttp, which raises ClientError, otherwise
+                # failed requests would never be removed from requests_working
                 log.debug(f"[backend] Request error: {e}")
                 self.metrics._request_errored(
                     workload=workload, reqnum=auth_data.reqnum
                 )
                 return web.Response(status=500)
             finally:
+                # handlers that don't read the model API's response, i.e. on errors, would otherwise leave its
+                # connection open until the response is garbage collected
+                if response is not None:
+                    response.release()
+                self.watchdog.unwatch_stream(stream_stats)
                 self.sem.release()
 
         ###########
 
-        if self.__check_signature(auth_data) is False:
+        with ctx.span("signature"):
+            signature_valid = await self.__check_signature(auth_data)
+        if signature_valid is False:
             return web.Response(status=401)
 
         try:
@@ -187,30 +385,75 @@ class Backend:
             return web.Response(status=500)
 
     async def _start_tracking(self) -> None:
-        await gather(self.__read_logs(), self.metrics._send_metrics_loop())
+        await gather(
+            self.__read_logs(),
+            self.metrics._send_metrics_loop(),
+            self.metrics.loop_monitor.run(),
+            self.__watch_progress(),
+        )
 
     def backend_errored(self, msg: str) -> None:
         self.metrics._model_errored(msg)
 
+    def start_draining(self) -> None:
+        """stops admitting requests, and reports it to the autoscaler"""
+        log.debug(
+            f"draining, {len(self.metrics.model_metrics.requests_working)} requests in flight"
+        )
+        self.draining = True
+        self.metrics._draining()
+
+    async def __watch_progress(self) -> None:
+
+        def in_flight() -> int:
+            # a model that is loading, or already errored, isn't expected to make progress
+            if (
+                self.metrics.system_metrics.model_is_loaded is False
+                or self.metrics.model_metrics.error_msg
+            ):
+                return 0
+            return len(self.metrics.model_metrics.requests_working)
+
+        async def probe() -> bool:
+            try:
+                async with self.session.get(
+                    endpoint, timeout=ClientTimeout(total=WATCHDOG_PROBE_TIMEOUT)
+                ) as res:
+                    return res.status == 200
+            except (ClientError, AsyncioTimeoutError) as e:
+                log.debug(f"health probe failed: {e!r}")
+                return False
+
+        ###########
+
+        endpoint = self.benchmark_handler.healthcheck_endpoint
+        await self.watchdog.run(
+            in_flight=in_flight,
+            probe=probe if endpoint else None,
+            stalled=self.backend_errored,
+        )
+
     async def __call_api(
-        self, handler: EndpointHandler[ApiPayload_T], payload: ApiPayload_T
+        self,
+        handler: EndpointHandler[ApiPayload_T],
+        payload: ApiPayload_T,
+        request_id: Optional[str] = None,
     ) -> ClientResponse:
-        api_payload = payload.generate_payload_json()
+        api_payload = await self.run_hook(payload.generate_payload_json)
         log.debug(f"posting to endpoint: '{handler.endpoint}', payload: {api_payload}")
-        return await self.session.post(url=handler.endpoint, json=api_payload)
-
-    def __check_signature(self, auth_data: AuthData) -> bool:
-        def verify_signature(message, signature):
-            if self.pubkey is None:
+        return await self.session.post(
+            url=handler.endpoint,
+            json=api_payload,
+            headers={REQUEST_ID_HEADER: request_id} if request_id else None,
+        )
+
+    async def __check_signature(self, auth_data: AuthData) -> bool:
+        async def verify(message: str, signature: str) -> bool:
+            pubkey_pem = self.pubkey_pem
+            if pubkey_pem is None:
                 log.debug(f"No Public Key!")
                 return False
-
-            h = SHA256.new(message.encode())
-            try:
-                pkcs1_15.new(self.pubkey).verify(h, base64.b64decode(signature))
-                return True
-            except (ValueError, TypeError):
-                return False
+            return await self.run_hook(verify_signature, pubkey_pem, message, signature)
 
         message = {
             key: value
@@ -225,10 +468,13 @@ class Backend:
         elif message in self.msg_history:
             log.debug(f"message: {message} already in message history")
             return False
-        elif verify_signature(json.dumps(message, indent=4), auth_data.signature):
+        elif await verify(json.dumps(message, indent=4), auth_data.signature):
+            if message in self.msg_history:
+                # the same message was verified by a concurrent request
+                log.debug(f"message: {message} already in message history")
+                return False
             self.reqnum = max(auth_data.reqnum, self.reqnum)
             self.msg_history.append(message)
-            self.msg_history = self.msg_history[-MSG_HISTORY_LEN:]
             return True
         else:
             log.debug(
@@ -240,17 +486,27 @@ class Backend:
 
         async def run_benchmark() -> float:
             log.debug("starting benchmark")
+            workload_unit = self.benchmark_handler.payload_cls().workload_unit
             try:
                 with open(BENCHMARK_INDICATOR_FILE, "r") as f:
-                    log.debug("already ran benchmark")
-                    # trigger model load
-                    payload = self.benchmark_handler.make_benchmark_payload()
-                    _ = await self.__call_api(
-                        handler=self.benchmark_handler, payload=payload
-                    )
-                    return float(f.readline())
+                    cached_throughput = f.readline()
+                    cached_unit = f.readline().strip()
             except FileNotFoundError:
-                pass
+                cached_unit = None
+            if cached_unit == workload_unit:
+                log.debug("already ran benchmark")
+                # trigger model load
+                payload = self.benchmark_handler.make_benchmark_payload()
+                res = await self.__call_api(
+                    handler=self.benchmark_handler, payload=payload
+                )
+                await res.read()
+                res.release()
+                return float(cached_throughput)
+            if cached_unit is not None:
+                log.debug(
+                    f"benchmark was run with workload unit '{cached_unit}', running it again for '{workload_unit}'"
+                )
             max_throughput = 0
             last_throughput = 0
             sum_throughput = 0
@@ -261,6 +517,7 @@ class Backend:
                     handler=self.benchmark_handler, payload=payload
                 )
                 data = await res.json()
+                res.release()
                 time_elapsed = time.time() - start
                 # first run triggers one-time loading of the model which is very slow, so we skip counting it
                 if run == 0:
@@ -287,14 +544,58 @@ class Backend:
             )
             # save max_throughput so we don't have to run benchmark again on restart of cold instances
             with open(BENCHMARK_INDICATOR_FILE, "w") as f:
-                f.write(str(max_throughput))
+                f.write(f"{max_throughput}\n{workload_unit}\n")
             return max_throughput
 
+        async def run_warmup() -> List[WarmupResult]:
+            """
+            runs every warm-up shape of the benchmark handler so that the first real requests of those shapes
+            don't pay for one-time costs such as kernel autotuning and allocations
+            """
+            results = []
+            for shape in self.benchmark_handler.warmup_shapes:
+                payload = self.benchmark_handler.make_warmup_payload(shape)
+                workload = payload.count_workload()
+                times = []
+                for _ in range(max(self.benchmark_handler.warmup_runs, 1)):
+                    start = time.time()
+                    res = await self.__call_api(
+                        handler=self.benchmark_handler, payload=payload
+                    )
+                    await res.read()
+                    res.release()
+                    if res.status != 200:
+                        log.debug(
+                            f"warm-up run for {shape} failed with status {res.status}"
+                        )
+                        break
+                    times.append(time.time() - start)
+                if not times:
+                    continue
+                result = WarmupResult(
+                    shape=shape,
+                    workload=workload,
+                    cold_time=times[0],
+                    warm_time=(min(times[1:]) if len(times) > 1 else None),
+                )
+                log.debug(
+                    f"warm-up of {shape}: workload: {workload}, cold: {result.cold_time}, "
+                    f"warm: {result.warm_time}, throughput: {result.throughput}"
+                )
+                results.append(result)
+            return results
+
         async def handle_log_line(log_line: str) -> None:
             """
             Implement this function to handle each log line for your model.
             This function should mutate self.system_metrics and self.model_metrics
             """
+            if self.metrics.system_metrics.model_is_loaded is False:
+                for extract in self.load_progress_extractors:
+                    progress = extract(log_line)
+                    if progress is not None:
+                        self.metrics._load_progress(progress)
+                        break
             for action, msg in self.log_actions:
                 match action:
                     case LogAction.ModelLoaded if msg in log_line:
@@ -306,8 +607,14 @@ class Backend:
                         await sleep(5)
                         try:
                             max_throughput = await run_benchmark()
+                            warmup_results = await run_warmup()
+                            benchmark_payload = (
+                                self.benchmark_handler.make_benchmark_payload()
+                            )
                             self.metrics._model_loaded(
                                 max_throughput=max_throughput,
+                                benchmark_workload=benchmark_payload.count_workload(),
+                                warmup_results=warmup_results,
                             )
                         except ClientConnectorError as e:
                             log.debug(
@@ -327,9 +634,10 @@ class Backend:
                 while True:
                     line = await f.readline()
                     if line:
+                        self.watchdog.progress()
                         await handle_log_line(line.rstrip())
                     else:
-                        time.sleep(LOG_POLL_INTERVAL)
+                        await sleep(LOG_POLL_INTERVAL)
 
         ###########
 
@@ -0,0 +1,591 @@
+"""
+Measures PyWorker's own overhead per request, without any model time, i.e:
+
+python3 -m lib.bench_proxy -n 2000 --output bench_proxy.json
+python3 -m lib.bench_proxy -n 2000 --compare bench_proxy.json
+
+For each worker's handlers, requests signed with a local key are sent to the handler made by
+Backend.create_handler, served in-process, which forwards them to a model API that responds instantly with a
+canned response. The same requests are also sent straight to the model API, and the CPU time that takes is
+subtracted, so that what remains is the cost of going through PyWorker.
+
+Each stage of request handling that can be run on its own (parsing, AuthData.from_json_msg, the payload,
+workload, signature check, model API payload and metrics bookkeeping) is also timed in a loop, with the bytes
+it allocates. Response generation needs a model API response, so it is only measured as the mean time of the
+"response" span of the requests that were sent through PyWorker, alongside the other spans.
+
+Results are written as JSON with sorted keys, one value per line, so that the results of two commits can be
+diffed, and --compare prints the change of every value from a previous result. The worker's server is run with
+the ServerProfile of the environment (see lib.server_profile), or --profile aiohttp for aiohttp's defaults, so
+that the two can be compared too.
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import importlib
+import itertools
+import subprocess
+import tracemalloc
+import dataclasses
+from collections import Counter
+from types import ModuleType
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+
+from aiohttp import web, ClientSession, TCPConnector, __version__ as aiohttp_version
+
+from lib.data_types import AuthData, EndpointHandler
+from lib.fake_autoscaler import FakeAutoscaler
+from lib.fake_model_server import write_png
+from lib.server_profile import ServerProfile
+
+# allocations are traced for fewer iterations than timing, tracemalloc slows every allocation down
+ALLOC_ITERATIONS = 200
+STREAM_TOKENS = 16
+IMAGE_SIZE = 1024
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class Case:
+    """requests with one payload type, sent to one of a worker's handlers"""
+
+    name: str
+    worker: str
+    route: str
+    # name of the EndpointHandler class in workers.<worker>.server
+    handler: str
+    # makes the client payload of the requests, from the worker's server module
+    make_payload: Callable[[ModuleType], Dict[str, Any]]
+
+
+def comfy_custom_workflow(server: ModuleType) -> Dict[str, Any]:
+    default = server.DefaultComfyWorkflowData.for_test()
+    return dict(
+        custom_fields=dict(
+            width=default.width, height=default.height, steps=default.steps
+        ),
+        workflow=default.generate_payload_json()["input"]["workflow_json"],
+    )
+
+
+CASES = [
+    Case(
+        name="tgi-chat",
+        worker="tgi",
+        route="/v1/chat/completions",
+        handler="ChatHandler",
+        make_payload=lambda server: dataclasses.asdict(server.InputData.for_test()),
+    ),
+    Case(
+        name="tgi-chat-stream",
+        worker="tgi",
+        route="/v1/chat/completions",
+        handler="ChatHandler",
+        make_payload=lambda server: dict(
+            dataclasses.asdict(server.InputData.for_test()), stream=True
+        ),
+    ),
+    Case(
+        name="hello_world-generate",
+        worker="hello_world",
+        route="/generate",
+        handler="GenerateHandler",
+        make_payload=lambda server: dataclasses.asdict(server.InputData.for_test()),
+    ),
+    Case(
+        name="hello_world-generate_stream",
+        worker="hello_world",
+        route="/generate_stream",
+        handler="GenerateStreamHandler",
+        make_payload=lambda server: dataclasses.asdict(server.InputData.for_test()),
+    ),
+    Case(
+        name="comfyui-prompt",
+        worker="comfyui",
+        route="/prompt",
+        handler="DefaultComfyWorkflowHandler",
+        make_payload=lambda server: dataclasses.asdict(
+            server.DefaultComfyWorkflowData.for_test()
+        ),
+    ),
+    Case(
+        name="comfyui-custom-workflow",
+        worker="comfyui",
+        route="/custom-workflow",
+        handler="CustomComfyWorkflowHandler",
+        make_payload=comfy_custom_workflow,
+    ),
+]
+
+
+@dataclass
+class InstantModelApi:
+    """model API that responds to every request with the same canned response, as fast as it can"""
+
+    image_path: str
+
+    def __post_init__(self):
+        def event(data: Dict[str, Any]) -> bytes:
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        usage = dict(prompt_tokens=100, completion_tokens=STREAM_TOKENS)
+        usage.update(total_tokens=sum(usage.values()))
+        self.chat = json.dumps(
+            dict(
+                object="chat.completion",
+                choices=[
+                    dict(
+                        index=0,
+                        message=dict(role="assistant", content="ok " * STREAM_TOKENS),
+                        finish_reason="stop",
+                    )
+                ],
+                usage=usage,
+            )
+        ).encode()
+        self.chat_stream = b"".join(
+            [
+                *[
+                    event(
+                        dict(
+                            object="chat.completion.chunk",
+                            choices=[dict(index=0, delta=dict(content="ok "))],
+                        )
+                    )
+                    for _ in range(STREAM_TOKENS)
+                ],
+                event(dict(object="chat.completion.chunk", choices=[], usage=usage)),
+                b"data: [DONE]\n\n",
+            ]
+        )
+        self.generate = json.dumps(dict(generated_text="ok " * STREAM_TOKENS)).encode()
+        self.generate_stream = b"".join(
+            event(dict(token=dict(text="ok "))) for _ in range(STREAM_TOKENS)
+        )
+        self.runsync = json.dumps(
+            dict(output=dict(images=[dict(local_path=self.image_path)]))
+        ).encode()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=0)
+        app.add_routes(
+            [
+                web.post("/v1/chat/completions", self.handle_chat),
+                web.post("/generate", self.handle_generate),
+                web.post("/generate_stream", self.handle_generate_stream),
+                web.post("/runsync", self.handle_runsync),
+            ]
+        )
+        return app
+
+    async def handle_chat(self, request: web.Request) -> web.Response:
+        if (await request.json()).get("stream"):
+            return web.Response(body=self.chat_stream, content_type="text/event-stream")
+        return web.Response(body=self.chat, content_type="application/json")
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.Response(body=self.generate, content_type="application/json")
+
+    async def handle_generate_stream(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.Response(body=self.generate_stream, content_type="text/event-stream")
+
+    async def handle_runsync(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.Response(body=self.runsync, content_type="application/json")
+
+
+@dataclass
+class SpanCollector:
+    """stands in for the trace file writer of Backend's Tracer, keeps the spans of every request"""
+
+    durations: Dict[str, List[float]] = field(default_factory=dict)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        for stage, (_, duration) in record["spans"].items():
+            self.durations.setdefault(stage, []).append(duration)
+
+    def mean_us(self) -> Dict[str, float]:
+        return {
+            stage: round(sum(durations) / len(durations) * 1e6, 1)
+            for stage, durations in self.durations.items()
+        }
+
+
+def worker_env(pubkey_file: str, model_log: str) -> None:
+    """
+    environment the worker server modules expect, set before they are imported as they read it on import. The
+    public key is always the benchmark's, as requests are signed with it
+    """
+    os.environ["PUBKEY_URL"] = f"file://{pubkey_file}"
+    os.environ.setdefault("MODEL_LOG", model_log)
+    os.environ.setdefault("COMFY_MODEL", "flux")
+    # the instant model API returns the same image to every request
+    os.environ.setdefault("KEEP_OUTPUT_FILES", "true")
+    os.environ.setdefault("CONTAINER_ID", "0")
+    os.environ.setdefault("REPORT_ADDR", "http://127.0.0.1:1")
+    os.environ.setdefault("WORKER_PORT", "3000")
+    os.environ.setdefault("VAST_TCP_PORT_3000", "3000")
+    os.environ.setdefault("PUBLIC_IPADDR", "127.0.0.1")
+
+
+def measure(fn: Callable[[int], Any], iterations: int) -> Dict[str, float]:
+    """CPU time and bytes allocated per call of fn, which is passed the number of the call"""
+    start = time.process_time()
+    for i in range(iterations):
+        fn(i)
+    cpu = (time.process_time() - start) / iterations
+    alloc_iterations = min(iterations, ALLOC_ITERATIONS)
+    allocated = 0
+    tracemalloc.start()
+    for i in range(alloc_iterations):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        fn(i)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return dict(
+        cpu_us=round(cpu * 1e6, 1), alloc_bytes=round(allocated / alloc_iterations)
+    )
+
+
+async def send_requests(
+    url: str, bodies: List[bytes], concurrency: int
+) -> Dict[str, float]:
+    """sends every body with at most `concurrency` requests in flight, reading the whole response"""
+    statuses = Counter()
+    remaining = iter(bodies)
+
+    async def send(session: ClientSession) -> None:
+        for body in remaining:
+            async with session.post(
+                url, data=body, headers={"Content-Type": "application/json"}
+            ) as res:
+                await res.read()
+                statuses[res.status] += 1
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        await asyncio.gather(*[send(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        gc.collect()
+        retained = sys.getallocatedblocks() - blocks
+    return dict(
+        requests_per_second=round(len(bodies) / elapsed, 1),
+        cpu_us_per_request=round(cpu / len(bodies) * 1e6, 1),
+        retained_blocks_per_request=round(retained / len(bodies), 2),
+        errors=sum(count for status, count in statuses.items() if status != 200),
+    )
+
+
+@dataclass
+class ProxyBenchmark:
+    requests: int = 2000
+    concurrency: int = 32
+    iterations: int = 1000
+    warmup: int = 100
+    profile: ServerProfile = field(default_factory=ServerProfile)
+    autoscaler: FakeAutoscaler = field(default_factory=FakeAutoscaler)
+
+    def __post_init__(self):
+        # reqnums are shared by every case, as Backend rejects reqnums it has already seen
+        self.reqnums = itertools.count()
+
+    def auth_data(self, cost: float) -> Dict[str, Any]:
+        # in the order of AuthData's fields, which the signed message is built from
+        message = dict(
+            cost=cost, endpoint="bench", reqnum=next(self.reqnums), url="bench"
+        )
+        return dict(signature=self.autoscaler.sign(message), **message)
+
+    async def run(self, case: Case, upstream_url: str) -> Dict[str, Any]:
+        # imported once worker_env has been set, lib.backend reads PUBKEY_URL on import
+        from lib.metrics import Metrics
+
+        server = importlib.import_module(f"workers.{case.worker}.server")
+        handler = getattr(server, case.handler)()
+        client_payload = case.make_payload(server)
+        payload = handler.payload_cls().from_json_msg(client_payload)
+        workload = payload.count_workload()
+        upstream_body = json.dumps(payload.generate_payload_json()).encode()
+        bodies = [
+            json.dumps(
+                dict(auth_data=self.auth_data(workload), payload=client_payload)
+            ).encode()
+            for _ in range(self.warmup + self.requests)
+        ]
+        # the worker's own backend, forwarding to the instant model API
+        backend = dataclasses.replace(server.backend, model_server_url=upstream_url)
+        spans = SpanCollector()
+        backend.tracer.sample_rate = 1.0
+        backend.tracer.writer = spans
+        app = self.profile.make_app()
+        app.add_routes([web.post(case.route, backend.create_handler(handler))])
+        runner = self.profile.make_runner(app)
+        await runner.setup()
+        site = self.profile.make_site(runner, host="127.0.0.1", port=0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            await send_requests(
+                f"{upstream_url}{handler.endpoint}",
+                [upstream_body] * self.warmup,
+                self.concurrency,
+            )
+            direct = await send_requests(
+                f"{upstream_url}{handler.endpoint}",
+                [upstream_body] * self.requests,
+                self.concurrency,
+            )
+            url = f"http://{host}:{port}{case.route}"
+            await send_requests(url, bodies[: self.warmup], self.concurrency)
+            spans.durations.clear()
+            proxied = await send_requests(url, bodies[self.warmup :], self.concurrency)
+        finally:
+            await runner.cleanup()
+            await backend.session.close()
+        proxied.update(
+            direct_cpu_us_per_request=direct["cpu_us_per_request"],
+            overhead_cpu_us_per_request=round(
+                proxied["cpu_us_per_request"] - direct["cpu_us_per_request"], 1
+            ),
+        )
+        return dict(
+            end_to_end=proxied,
+            spans_us=spans.mean_us(),
+            stages=self.stages(case, handler, backend, Metrics(), bodies[-1]),
+        )
+
+    def stages(
+        self,
+        case: Case,
+        handler: EndpointHandler,
+        backend: "Backend",
+        metrics: "Metrics",
+        body: bytes,
+    ) -> Dict[str, Any]:
+        """CPU time and allocations of each stage of handling the request with `body`, run on its own"""
+        from lib.backend import verify_signature
+
+        data = json.loads(body)
+        auth_data = AuthData.from_json_msg(data["auth_data"])
+        payload = handler.payload_cls().from_json_msg(data["payload"])
+        workload = payload.count_workload()
+        pubkey_pem = backend.pubkey_pem
+
+        def check_signature(_: int) -> bool:
+            # as Backend.__check_signature does, other than the reqnum and message history checks
+            message = {
+                key: value
+                for key, value in dataclasses.asdict(auth_data).items()
+                if key != "signature"
+            }
+            return verify_signature(
+                pubkey_pem, json.dumps(message, indent=4), auth_data.signature
+            )
+
+        def bookkeeping(reqnum: int) -> None:
+            metrics._request_start(workload=workload, reqnum=reqnum)
+            metrics._request_end(
+                workload=workload, req_response_time=0.01, reqnum=reqnum
+            )
+            metrics._response_sent(
+                endpoint=case.route, status=200, latency=0.01, response_bytes=1000
+            )
+
+        stages = dict(
+            parse=lambda _: json.loads(body),
+            auth_data=lambda _: AuthData.from_json_msg(data["auth_data"]),
+            payload=lambda _: handler.payload_cls().from_json_msg(data["payload"]),
+            workload=lambda _: payload.count_workload(),
+            signature=check_signature,
+            payload_json=lambda _: payload.generate_payload_json(),
+            metrics=bookkeeping,
+        )
+        return {stage: measure(fn, self.iterations) for stage, fn in stages.items()}
+
+
+def environment(profile: ServerProfile) -> Dict[str, Any]:
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            universal_newlines=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        commit = None
+    return dict(
+        commit=commit,
+        python=platform.python_version(),
+        aiohttp=aiohttp_version,
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+        event_loop=type(asyncio.get_running_loop()).__module__,
+        profile=dataclasses.asdict(profile),
+    )
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def print_comparison(previous: Dict[str, Any], results: Dict[str, Any]) -> None:
+    old, new = flatten(previous["cases"]), flatten(results["cases"])
+    print(
+        f"compared with {previous['environment'].get('commit')}, "
+        f"now {results['environment'].get('commit')}"
+    )
+    print(f"{'':<60} {'before':>10} {'after':>10} {'change':>8}")
+    for key, value in new.items():
+        if key not in old:
+            continue
+        change = f"{(value - old[key]) / old[key]:+8.1%}" if old[key] else f"{'-':>8}"
+        print(f"{key:<60} {old[key]:>10g} {value:>10g} {change}")
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    for name, result in results["cases"].items():
+        if "skipped" in result:
+            print(f"{name}: skipped, {result['skipped']}")
+            continue
+        e2e = result["end_to_end"]
+        print(
+            f"{name}: {e2e['requests_per_second']} req/s, "
+            f"{e2e['overhead_cpu_us_per_request']} us CPU/request of overhead "
+            f"({e2e['cpu_us_per_request']} us through PyWorker, "
+            f"{e2e['direct_cpu_us_per_request']} us direct), {e2e['errors']} errors"
+        )
+        for stage, values in result["stages"].items():
+            print(
+                f"  {stage:<14} {values['cpu_us']:>10.1f} us {values['alloc_bytes']:>10} B"
+            )
+        spans = ", ".join(
+            f"{stage} {us} us" for stage, us in result["spans_us"].items()
+        )
+        print(f"  spans: {spans}")
+
+
+async def main(
+    args: argparse.Namespace, workdir: str, profile: ServerProfile
+) -> Dict[str, Any]:
+    benchmark = ProxyBenchmark(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        iterations=args.iterations,
+        warmup=args.warmup,
+        profile=profile,
+    )
+    pubkey_file = os.path.join(workdir, "pubkey.pem")
+    with open(pubkey_file, "wb") as f:
+        f.write(benchmark.autoscaler.key.public_key().export_key())
+    worker_env(pubkey_file, os.path.join(workdir, "model.log"))
+    image_path = os.path.join(workdir, "image.png")
+    write_png(image_path, IMAGE_SIZE, IMAGE_SIZE)
+    runner = web.AppRunner(
+        InstantModelApi(image_path=image_path).app(), access_log=None
+    )
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    cases = {}
+    try:
+        for case in CASES:
+            if args.cases and case.name not in args.cases:
+                continue
+            log.info(f"running {case.name}")
+            try:
+                cases[case.name] = await benchmark.run(case, f"http://{host}:{port}")
+            except ImportError as e:
+                # i.e. hello_world needs transformers
+                cases[case.name] = dict(skipped=str(e))
+            # the worker modules configure logging on import
+            logging.getLogger().setLevel(args.log_level)
+    finally:
+        await runner.cleanup()
+    return dict(
+        environment=environment(profile),
+        settings=dict(
+            requests=args.requests,
+            concurrency=args.concurrency,
+            iterations=args.iterations,
+            warmup=args.warmup,
+            log_level=args.log_level,
+            profile=args.profile,
+        ),
+        cases=cases,
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark PyWorker's per-request overhead"
+    )
+    arg_parser.add_argument(
+        "-n", dest="requests", type=int, default=2000, help="requests per case"
+    )
+    arg_parser.add_argument(
+        "-c", dest="concurrency", type=int, default=32, help="requests in flight"
+    )
+    arg_parser.add_argument(
+        "--iterations", type=int, default=1000, help="iterations of each stage"
+    )
+    arg_parser.add_argument("--warmup", type=int, default=100)
+    arg_parser.add_argument(
+        "--case",
+        dest="cases",
+        action="append",
+        choices=[case.name for case in CASES],
+        help="run only this case, can be repeated",
+    )
+    arg_parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        help="log level of the workers, DEBUG to include the cost of their debug logs",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        choices=["env", "aiohttp"],
+        default="env",
+        help="run the worker's server with the profile of the environment, or aiohttp's defaults",
+    )
+    arg_parser.add_argument("--output", help="write the results as JSON")
+    arg_parser.add_argument("--compare", help="results of a previous run to compare to")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+    profile = (
+        ServerProfile.aiohttp_defaults()
+        if args.profile == "aiohttp"
+        else ServerProfile()
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        results = profile.run(main(args, workdir, profile))
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"results written to {args.output}")
@@ -0,0 +1,70 @@
+"""
+Opt-in capture of the requests a worker handles, so that production traffic can be replayed with
+`lib.replay`. If $CAPTURE_FILE is set, a record of every request handled by Backend is written to it as a JSON
+line by a background thread:
+
+{"arrival": 1718000000.1, "request_id": "...", "endpoint": "/v1/chat/completions", "workload": 412.0,
+ "payload_hash": "9f2c...", "payload_size": 1834, "latency": 2.31, "status": 200}
+
+Payloads themselves are only captured, in "payload", if $CAPTURE_PAYLOADS is "true". The file is rotated every
+$CAPTURE_MAX_BYTES bytes, keeping $CAPTURE_BACKUPS old files.
+"""
+
+import os
+import json
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Dict
+
+from lib.tracing import JsonlWriter, RequestContext
+
+CAPTURE_FILE = os.environ.get("CAPTURE_FILE")
+CAPTURE_MAX_BYTES = int(os.environ.get("CAPTURE_MAX_BYTES", str(100 * 2**20)))
+CAPTURE_BACKUPS = int(os.environ.get("CAPTURE_BACKUPS", "5"))
+CAPTURE_PAYLOADS = os.environ.get("CAPTURE_PAYLOADS", "false") == "true"
+
+
+@dataclass
+class Capture:
+    path: str
+    max_bytes: int = CAPTURE_MAX_BYTES
+    backups: int = CAPTURE_BACKUPS
+    payloads: bool = CAPTURE_PAYLOADS
+
+    def __post_init__(self):
+        self.writer = JsonlWriter(
+            self.path,
+            max_bytes=self.max_bytes,
+            backups=self.backups,
+            prepare=self.__prepare,
+        )
+
+    def record(self, ctx: RequestContext, status: int, latency: float) -> None:
+        # the payload is serialized and hashed in the writer's thread, not on the event loop
+        self.writer.write(
+            dict(
+                arrival=ctx.start_time,
+                request_id=ctx.request_id,
+                endpoint=ctx.endpoint,
+                workload=ctx.workload,
+                latency=latency,
+                status=status,
+                payload=ctx.payload,
+            )
+        )
+
+    #######################################Private#######################################
+
+    def __prepare(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        payload = record.pop("payload")
+        if payload is not None:
+            payload_json = json.dumps(payload, sort_keys=True)
+            record.update(
+                payload_hash=hashlib.blake2b(
+                    payload_json.encode(), digest_size=8
+                ).hexdigest(),
+                payload_size=len(payload_json),
+            )
+            if self.payloads:
+                record["payload"] = payload
+        return record
@@ -1,15 +1,29 @@
 import time
 import logging
+import dataclasses
 from dataclasses import dataclass, field
 from enum import Enum
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Union, Tuple, Optional, Set, TypeVar, Generic, Type
+from typing import (
+    Dict,
+    Any,
+    Union,
+    Tuple,
+    Optional,
+    Set,
+    TypeVar,
+    Generic,
+    Type,
+    List,
+    Callable,
+    ClassVar,
+)
 from aiohttp import web, ClientResponse
 import inspect
 
+import numpy
 import psutil
 
-
 """
 type variable representing an incoming payload to pyworker that will used to calculate load and will then
 be forwarded to the model
@@ -17,6 +31,26 @@ be forwarded to the model
 
 log = logging.getLogger(__file__)
 
+# key under which an EndpointHandler stores the usage reported by the model API on the client request
+USAGE_KEY = "pyworker_usage"
+# key of the StreamStats of a client request, used by EndpointHandlers that stream responses
+STREAM_STATS_KEY = "pyworker_stream_stats"
+# key under which an EndpointHandler marks a client request whose client disconnected during the response
+CANCELLED_KEY = "pyworker_cancelled"
+CPU_BOUND_ATTR = "_pyworker_cpu_bound"
+
+Hook_T = TypeVar("Hook_T", bound=Callable[..., Any])
+
+
+def cpu_bound(hook: Hook_T) -> Hook_T:
+    """
+    marks a hook, such as ApiPayload.count_workload, as CPU bound. Backend runs CPU bound hooks in its hook
+    executor instead of on the event loop, so they don't stall concurrent requests. If the executor is a
+    process pool, the hook and its arguments must be picklable
+    """
+    setattr(hook, CPU_BOUND_ATTR, True)
+    return hook
+
 
 class JsonDataException(Exception):
     def __init__(self, json_msg: Dict[str, Any]):
@@ -25,6 +59,9 @@ class JsonDataException(Exception):
 
 @dataclass
 class ApiPayload(ABC):
+    # names what `count_workload` counts, to be changed with it. The benchmark throughput, cached in
+    # .has_benchmark across restarts, is measured again when it doesn't match
+    workload_unit: ClassVar[str] = ""
 
     @classmethod
     @abstractmethod
@@ -42,6 +79,14 @@ class ApiPayload(ABC):
         """defines how to calculate workload for a payload"""
         pass
 
+    def count_actual_workload(self, usage: Dict[str, Any]) -> Optional[float]:
+        """
+        defines how to calculate the actual workload of a request from the usage reported by the model API,
+        see EndpointHandler.report_usage. Returns None if it can't be calculated, in which case the estimate
+        from `count_workload` is used
+        """
+        return None
+
     @classmethod
     @abstractmethod
     def from_json_msg(cls, json_msg: Dict[str, Any]) -> "ApiPayload":
@@ -95,6 +140,11 @@ class EndpointHandler(ABC, Generic[ApiPayload_T]):
 
     benchmark_runs: int = 8
     benchmark_words: int = 100
+    # payload shapes that are sent to the model before the worker reports that it is loaded, so that the
+    # first real requests of those shapes don't pay for kernel autotuning and allocations. Each shape is
+    # passed to `make_warmup_payload` and run `warmup_runs` times, the first run being the cold one
+    warmup_shapes: List[Dict[str, Any]] = field(default_factory=list)
+    warmup_runs: int = 2
 
     @property
     @abstractmethod
@@ -102,6 +152,14 @@ class EndpointHandler(ABC, Generic[ApiPayload_T]):
         """the endpoint on the model API"""
         pass
 
+    @property
+    def healthcheck_endpoint(self) -> Optional[str]:
+        """
+        endpoint on the model API that responds with 200 while the model is healthy. The one of the benchmark
+        handler is probed when the model stops making progress, see lib.watchdog
+        """
+        return None
+
     @classmethod
     @abstractmethod
     def payload_cls(cls) -> Type[ApiPayload_T]:
@@ -113,6 +171,13 @@ class EndpointHandler(ABC, Generic[ApiPayload_T]):
         """defines how to create an ApiPayload for benchmarking."""
         pass
 
+    def make_warmup_payload(self, shape: Dict[str, Any]) -> ApiPayload_T:
+        """
+        defines how to create an ApiPayload for one of `warmup_shapes`. By default it's the benchmark
+        payload with the fields of the shape replaced, which needs the payload to be a dataclass
+        """
+        return dataclasses.replace(self.make_benchmark_payload(), **shape)
+
     @abstractmethod
     async def generate_client_response(
         self, client_request: web.Request, model_response: ClientResponse
@@ -122,6 +187,22 @@ class EndpointHandler(ABC, Generic[ApiPayload_T]):
         """
         pass
 
+    @staticmethod
+    def report_usage(client_request: web.Request, usage: Dict[str, Any]) -> None:
+        """
+        call this from `generate_client_response` with the usage reported by the model API, it is passed to
+        ApiPayload.count_actual_workload once the response is sent to correct the estimated workload
+        """
+        client_request[USAGE_KEY] = usage
+
+    @staticmethod
+    def report_cancelled(client_request: web.Request) -> None:
+        """
+        call this from `generate_client_response` if the client disconnects while the response is sent, i.e.
+        mid-stream, the request is then counted as cancelled rather than served or errored
+        """
+        client_request[CANCELLED_KEY] = True
+
     @classmethod
     def get_data_from_request(
         cls, req_data: Dict[str, Any]
@@ -150,6 +231,41 @@ class EndpointHandler(ABC, Generic[ApiPayload_T]):
             raise Exception("error deserializing request data")
 
 
+@dataclass
+class StreamStats:
+    """
+    token timings of a streamed model response. Backend puts one on every client request under
+    STREAM_STATS_KEY, streaming EndpointHandlers call `token` for every token they forward to the client
+    """
+
+    request_start: float
+    first_token: Optional[float] = None
+    last_token: Optional[float] = None
+    tokens: int = 0
+
+    def token(self) -> None:
+        now = time.time()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.tokens += 1
+
+
+@dataclass
+class WarmupResult:
+    """timings of the warm-up runs of a single payload shape"""
+
+    shape: Dict[str, Any]
+    workload: float
+    cold_time: float
+    warm_time: Optional[float]
+
+    @property
+    def throughput(self) -> float:
+        # the cold run includes one-time autotuning and allocation cost, only use it if there is nothing else
+        return self.workload / (self.warm_time or self.cold_time)
+
+
 @dataclass
 class SystemMetrics:
     """General system metrics"""
@@ -195,13 +311,36 @@ class ModelMetrics:
     workload_received: float
     workload_cancelled: float
     workload_errored: float
+    # estimated and actual workload of the requests whose actual workload is known
+    workload_estimated: float
+    workload_actual: float
     workload_pending: float
     # these are not
     cur_perf: float
     error_msg: Optional[str]
     max_throughput: float
-    requests_recieved: Set[int] = field(default_factory=set)
+    # number of requests received since the last report, this is reset after being sent to autoscaler
+    requests_recieved: int = 0
+    # number of requests received since the worker started, reported as num_requests_recieved
+    requests_recieved_total: int = 0
+    # reqnums of the requests that are being processed, requests are always removed once they are done, so
+    # this only holds as many reqnums as there are requests in flight
     requests_working: Set[int] = field(default_factory=set)
+    # (workload, throughput) points measured by the benchmark and warm-up runs, sorted by workload
+    throughput_curve: List[Tuple[float, float]] = field(default_factory=list)
+    # CPU bound hooks that are waiting for or running in the hook executor, this is not reset
+    hooks_queued: int = 0
+    # time CPU bound hooks spent waiting for and running in the hook executor, these are reset after being
+    # sent to autoscaler
+    hooks_run: int = 0
+    hook_wait_time: float = 0.0
+    hook_run_time: float = 0.0
+    # timings of streamed responses, these are reset after being sent to autoscaler
+    streams: int = 0
+    stream_tokens: int = 0
+    stream_time: float = 0.0
+    time_to_first_token_sum: float = 0.0
+    inter_token_latency_sum: float = 0.0
 
     @classmethod
     def empty(cls):
@@ -210,6 +349,8 @@ class ModelMetrics:
             workload_served=0.0,
             workload_cancelled=0.0,
             workload_errored=0.0,
+            workload_estimated=0.0,
+            workload_actual=0.0,
             cur_perf=0.0,
             workload_received=0.0,
             error_msg=None,
@@ -220,6 +361,36 @@ class ModelMetrics:
     def workload_processing(self) -> float:
         return max(self.workload_received - self.workload_cancelled, 0.0)
 
+    @property
+    def workload_estimation_error(self) -> float:
+        """relative error of the estimated workload, positive if workload is overestimated"""
+        if self.workload_actual <= 0:
+            return 0.0
+        return (self.workload_estimated - self.workload_actual) / self.workload_actual
+
+    @property
+    def time_to_first_token(self) -> float:
+        return self.time_to_first_token_sum / self.streams if self.streams else 0.0
+
+    @property
+    def inter_token_latency(self) -> float:
+        intervals = self.stream_tokens - self.streams
+        return self.inter_token_latency_sum / intervals if intervals > 0 else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.stream_tokens / self.stream_time if self.stream_time > 0 else 0.0
+
+    def expected_throughput(self, workload: float) -> float:
+        """
+        throughput expected for a request of the given workload, interpolated from the benchmark and
+        warm-up measurements. Falls back to max_throughput if there are no measurements
+        """
+        if not self.throughput_curve:
+            return self.max_throughput
+        workloads, throughputs = zip(*self.throughput_curve)
+        return float(numpy.interp(workload, workloads, throughputs))
+
     def set_errored(self, error_msg):
         self.reset()
         self.error_msg = error_msg
@@ -229,6 +400,17 @@ class ModelMetrics:
         self.workload_received = 0
         self.workload_cancelled = 0
         self.workload_errored = 0
+        self.requests_recieved = 0
+        self.workload_estimated = 0
+        self.workload_actual = 0
+        self.hooks_run = 0
+        self.hook_wait_time = 0.0
+        self.hook_run_time = 0.0
+        self.streams = 0
+        self.stream_tokens = 0
+        self.stream_time = 0.0
+        self.time_to_first_token_sum = 0.0
+        self.inter_token_latency_sum = 0.0
 
 
 @dataclass
@@ -241,11 +423,37 @@ class AutoScalaerData:
     error_msg: str
     max_perf: float
     cur_perf: float
+    # workload per second that can still be served, and that can be served in total
     cur_capacity: float
     max_capacity: float
     num_requests_working: int
     num_requests_recieved: int
     additional_disk_usage: float
+    workload_estimation_error: float
+    time_to_first_token: float
+    inter_token_latency: float
+    tokens_per_second: float
+    # highest event loop lag since the last report, a high value means that requests are delayed by PyWorker
+    loop_lag: float
+    # seconds a new request would wait before being served, see Metrics.estimated_wait
+    estimated_wait: float
+    # workload that could be added and still be served within $HEADROOM_HORIZON seconds
+    headroom: float
+    # latency percentiles of the requests that finished in the last minute
+    latency_p50: float
+    latency_p95: float
+    # workload per second forecast to be received 1, 5 and 10 minutes ahead, and the estimated error of each
+    # forecast, keyed by horizon: "1m", "5m", "10m"
+    load_forecast: Dict[str, float]
+    load_forecast_error: Dict[str, float]
+    # set once the worker stops admitting requests before it stops, cur_capacity and headroom are then 0
+    draining: bool
+    # while the model loads, the fraction of its download that is done, the bytes per second it's downloaded at
+    # and the seconds until it's done, as parsed from the model's log (see lib.load_progress), None if unknown.
+    # When files are downloaded one after the other, only those that have started are counted
+    load_progress: Optional[float]
+    load_throughput: Optional[float]
+    load_eta: Optional[float]
     url: str
 
 
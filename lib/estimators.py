@@ -0,0 +1,248 @@
+"""
+Time based estimators used to smooth and forecast the load and performance that are reported to the
+autoscaler. All timestamps are taken from the monotonic clock.
+"""
+
+import os
+import time
+from math import exp
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+
+# windows, in seconds, over which rates are also kept for debugging
+RATE_WINDOWS = (10.0, 60.0, 300.0)
+WINDOW_BUCKETS = 60
+# load is forecast from the arrival rate of each FORECAST_STEP seconds, FORECAST_HORIZONS seconds ahead
+FORECAST_STEP = float(os.environ.get("FORECAST_STEP", "10"))
+FORECAST_HORIZONS = (60.0, 300.0, 600.0)
+# smoothing factors of the level and trend of the forecast, and how much the trend is damped each step
+FORECAST_ALPHA = float(os.environ.get("FORECAST_ALPHA", "0.2"))
+FORECAST_BETA = float(os.environ.get("FORECAST_BETA", "0.05"))
+FORECAST_DAMPING = float(os.environ.get("FORECAST_DAMPING", "0.98"))
+# weight of each scored forecast in the error estimate
+FORECAST_ERROR_WEIGHT = 0.05
+FORECAST_MAX_CATCHUP_STEPS = 360
+
+
+@dataclass
+class EwmaRate:
+    """
+    exponentially weighted rate of a quantity that is added at irregular times, i.e. workload per second.
+    Each amount's weight decays by a factor of e every `tau` seconds
+    """
+
+    tau: float
+    value: float = 0.0
+    last_update: Optional[float] = None
+
+    def add(self, amount: float, now: float) -> None:
+        self.value = self.rate(now) + amount / self.tau
+        self.last_update = now
+
+    def remove(self, amount: float, added_at: float, now: float) -> None:
+        """takes back what is left of an amount added at `added_at`, i.e. the workload of a cancelled request"""
+        self.add(-amount * exp(-(now - added_at) / self.tau), now)
+
+    def rate(self, now: float) -> float:
+        if self.last_update is None:
+            return 0.0
+        # removed amounts can leave rounding errors below 0
+        return max(self.value * exp(-(now - self.last_update) / self.tau), 0.0)
+
+
+@dataclass
+class WindowedSum:
+    """sum of the amounts added over the last `window` seconds, kept in a ring buffer of buckets"""
+
+    window: float
+    num_buckets: int = WINDOW_BUCKETS
+    first_update: Optional[float] = None
+    sums: List[float] = field(default_factory=list)
+    # absolute index of the bucket each slot of the ring buffer currently holds
+    bucket_ids: List[int] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.bucket_width = self.window / self.num_buckets
+        self.sums = [0.0] * self.num_buckets
+        self.bucket_ids = [-1] * self.num_buckets
+
+    def add(self, amount: float, now: float) -> None:
+        if self.first_update is None:
+            self.first_update = now
+        bucket_id = int(now / self.bucket_width)
+        slot = bucket_id % self.num_buckets
+        if self.bucket_ids[slot] != bucket_id:
+            self.bucket_ids[slot] = bucket_id
+            self.sums[slot] = 0.0
+        self.sums[slot] += amount
+
+    def remove(self, amount: float, added_at: float) -> None:
+        """takes back an amount added at `added_at`, if its bucket is still in the window"""
+        bucket_id = int(added_at / self.bucket_width)
+        slot = bucket_id % self.num_buckets
+        if self.bucket_ids[slot] == bucket_id:
+            self.sums[slot] -= amount
+
+    def sum(self, now: float) -> float:
+        oldest_bucket_id = int(now / self.bucket_width) - self.num_buckets
+        return sum(
+            amount
+            for amount, bucket_id in zip(self.sums, self.bucket_ids)
+            if bucket_id > oldest_bucket_id
+        )
+
+    def rate(self, now: float) -> float:
+        if self.first_update is None:
+            return 0.0
+        # until a full window has passed, the rate is over the time since the first amount was added
+        elapsed = min(max(now - self.first_update, self.bucket_width), self.window)
+        return max(self.sum(now) / elapsed, 0.0)
+
+
+@dataclass
+class RateEstimator:
+    """rate of a quantity as an EWMA, which is reported, and over fixed windows, which are for debugging"""
+
+    tau: float
+    windows: Tuple[float, ...] = RATE_WINDOWS
+
+    def __post_init__(self):
+        self.ewma = EwmaRate(tau=self.tau)
+        self.window_sums = [WindowedSum(window=window) for window in self.windows]
+
+    def add(self, amount: float, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.ewma.add(amount, now)
+        for window_sum in self.window_sums:
+            window_sum.add(amount, now)
+
+    def remove(
+        self, amount: float, added_at: float, now: Optional[float] = None
+    ) -> None:
+        now = time.monotonic() if now is None else now
+        self.ewma.remove(amount, added_at, now)
+        for window_sum in self.window_sums:
+            window_sum.remove(amount, added_at)
+
+    def rate(self, now: Optional[float] = None) -> float:
+        return self.ewma.rate(time.monotonic() if now is None else now)
+
+    def window_rates(self, now: Optional[float] = None) -> Dict[float, float]:
+        now = time.monotonic() if now is None else now
+        return {
+            window_sum.window: window_sum.rate(now) for window_sum in self.window_sums
+        }
+
+
+def format_window(window: float) -> str:
+    """10.0 -> "10s", 300.0 -> "5m" """
+    if window >= 60 and window % 60 == 0:
+        return f"{int(window // 60)}m"
+    return f"{int(window)}s"
+
+
+@dataclass
+class LoadForecaster:
+    """
+    forecasts the rate of a quantity, i.e. arrival workload per second, `horizons` seconds ahead with Holt's
+    linear trend method on the rate of each `step` seconds. The trend is damped, so that forecasts level off
+    instead of extrapolating a short burst over 10 minutes. The error of each horizon is estimated from how far
+    off the forecasts made that many steps ago were, as the root of an EWMA of their squared errors
+    """
+
+    step: float = FORECAST_STEP
+    horizons: Tuple[float, ...] = FORECAST_HORIZONS
+    alpha: float = FORECAST_ALPHA
+    beta: float = FORECAST_BETA
+    damping: float = FORECAST_DAMPING
+    level: Optional[float] = None
+    trend: float = 0.0
+    # number of steps observed
+    steps: int = 0
+    # start of the step amounts are currently added to, and their sum
+    step_start: Optional[float] = None
+    step_amount: float = 0.0
+
+    def __post_init__(self):
+        self.horizon_steps = numpy.array(
+            [max(round(horizon / self.step), 1) for horizon in self.horizons]
+        )
+        # damped trend multiplier of each horizon: damping + damping^2 + ... + damping^h
+        self.trend_factors = numpy.array(
+            [
+                sum(self.damping**i for i in range(1, horizon_steps + 1))
+                for horizon_steps in self.horizon_steps
+            ]
+        )
+        # forecasts made at each of the last steps, a ring buffer with a row per step and a column per horizon
+        self.past_forecasts = numpy.full(
+            (int(self.horizon_steps.max()), len(self.horizons)), numpy.nan
+        )
+        self.squared_error = numpy.zeros(len(self.horizons))
+        self.error_weight = numpy.zeros(len(self.horizons))
+
+    def add(self, amount: float, now: float) -> None:
+        self.advance(now)
+        self.step_amount += amount
+
+    def advance(self, now: float) -> None:
+        """closes the steps that ended before `now`"""
+        if self.step_start is None:
+            self.step_start = now
+            return
+        missed_steps = int((now - self.step_start) // self.step)
+        if missed_steps > FORECAST_MAX_CATCHUP_STEPS:
+            # after a long idle period the level has decayed to ~0 anyway
+            self.step_start += (missed_steps - FORECAST_MAX_CATCHUP_STEPS) * self.step
+            missed_steps = FORECAST_MAX_CATCHUP_STEPS
+        for _ in range(missed_steps):
+            self.observe(self.step_amount / self.step)
+            self.step_amount = 0.0
+            self.step_start += self.step
+
+    def observe(self, rate: float) -> None:
+        """updates the forecast with the rate of the next step"""
+        if self.level is None:
+            self.level = rate
+        else:
+            # score the forecasts that were made for this step
+            made = self.past_forecasts[
+                (self.steps - self.horizon_steps) % len(self.past_forecasts),
+                numpy.arange(len(self.horizons)),
+            ]
+            scored = ~numpy.isnan(made)
+            self.squared_error[scored] = (
+                1 - FORECAST_ERROR_WEIGHT
+            ) * self.squared_error[scored] + FORECAST_ERROR_WEIGHT * (
+                made[scored] - rate
+            ) ** 2
+            self.error_weight[scored] = (1 - FORECAST_ERROR_WEIGHT) * self.error_weight[
+                scored
+            ] + FORECAST_ERROR_WEIGHT
+            level = self.level
+            self.level = self.alpha * rate + (1 - self.alpha) * (
+                level + self.damping * self.trend
+            )
+            self.trend = (
+                self.beta * (self.level - level)
+                + (1 - self.beta) * self.damping * self.trend
+            )
+        self.past_forecasts[self.steps % len(self.past_forecasts)] = self.forecast()
+        self.steps += 1
+
+    def forecast(self) -> numpy.ndarray:
+        """forecast rate at each horizon"""
+        if self.level is None:
+            return numpy.zeros(len(self.horizons))
+        return numpy.maximum(self.level + self.trend * self.trend_factors, 0.0)
+
+    def error(self) -> numpy.ndarray:
+        """estimated root mean squared error of the forecast at each horizon, 0 until it can be scored"""
+        scored = self.error_weight > 0
+        error = numpy.zeros(len(self.horizons))
+        error[scored] = numpy.sqrt(
+            self.squared_error[scored] / self.error_weight[scored]
+        )
+        return error
@@ -0,0 +1,297 @@
+"""
+Stand-in for the autoscaler's routing API, so that one or more local workers can be load tested and their
+reports observed without the production autoscaler, i.e:
+
+python3 -m lib.fake_autoscaler --port 8081
+REPORT_ADDR=http://127.0.0.1:8081 PUBKEY_URL=http://127.0.0.1:8081/pubkey/ ... python3 -m workers.tgi.server
+python3 -m workers.tgi.test_load -l -k none -e local -n 1000 -rps 10
+
+GET /pubkey/            public key of the RSA key requests are signed with, generated on startup
+POST /route/            picks a worker for a request and returns the signed auth data the worker checks, with
+                        a new reqnum
+POST /worker_status/    records the report of a worker. Workers that have finished loading are routed to
+GET /reports            every report received
+GET /accuracy           how well the load each worker reported tracked the workload routed to it
+
+Reported cur_load is compared to an EWMA, with the worker's time constant, of the workload that was actually
+routed to the worker, so the error is that of the signal: report delay and workload estimation, not of the
+smoothing. The accuracy summary is also printed on exit.
+"""
+
+import json
+import time
+import base64
+import logging
+import argparse
+from itertools import count
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+from aiohttp import web
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+from lib.metrics import LOAD_EWMA_TAU
+
+ROUTING_POLICIES = ["round_robin", "least_wait"]
+KEY_BITS = 2048
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class WorkerState:
+    url: str
+    # (time received, report) of every report of the worker
+    reports: List[Tuple[float, Dict[str, Any]]] = field(default_factory=list)
+    # (time routed, cost) of every request routed to the worker
+    routed: List[Tuple[float, float]] = field(default_factory=list)
+
+    @property
+    def last_report(self) -> Dict[str, Any]:
+        return self.reports[-1][1] if self.reports else {}
+
+    @property
+    def is_ready(self) -> bool:
+        """workers are routed to once their benchmark is done, as long as they haven't errored or started draining"""
+        report = self.last_report
+        return (
+            report.get("max_perf", 0) > 0
+            and not report.get("error_msg")
+            and not report.get("draining")
+        )
+
+
+@dataclass
+class FakeAutoscaler:
+    policy: str = "round_robin"
+    # URLs of workers that are routed to before they report
+    static_workers: List[str] = field(default_factory=list)
+    key: RSA.RsaKey = field(default_factory=lambda: RSA.generate(KEY_BITS))
+    workers: Dict[str, WorkerState] = field(default_factory=dict)
+    route_time: float = 0.0
+    routes: int = 0
+
+    def __post_init__(self):
+        self.start = time.monotonic()
+        self.reqnums = count()
+        self.next_worker = count()
+        for url in self.static_workers:
+            self.workers[url] = WorkerState(url=url)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/pubkey/", self.handle_pubkey),
+                web.post("/route/", self.handle_route),
+                web.post("/worker_status/", self.handle_worker_status),
+                web.get("/reports", self.handle_reports),
+                web.get("/accuracy", self.handle_accuracy),
+            ]
+        )
+        return app
+
+    def sign(self, message: Dict[str, Any]) -> str:
+        """signs the auth data the way Backend checks it"""
+        h = SHA256.new(json.dumps(message, indent=4).encode())
+        return base64.b64encode(pkcs1_15.new(self.key).sign(h)).decode()
+
+    def pick_worker(self) -> Optional[WorkerState]:
+        candidates = [
+            worker
+            for worker in self.workers.values()
+            if worker.is_ready or worker.url in self.static_workers
+        ]
+        if not candidates:
+            return None
+        match self.policy:
+            case "least_wait":
+                return min(
+                    candidates,
+                    key=lambda worker: (
+                        worker.last_report.get("estimated_wait", 0.0),
+                        len(worker.routed),
+                    ),
+                )
+            case _:
+                return candidates[next(self.next_worker) % len(candidates)]
+
+    async def handle_pubkey(self, _: web.Request) -> web.Response:
+        return web.Response(text=self.key.public_key().export_key().decode())
+
+    async def handle_route(self, request: web.Request) -> web.Response:
+        start = time.perf_counter()
+        data = await request.json()
+        worker = self.pick_worker()
+        if worker is None:
+            return web.json_response(dict(error="no worker is ready"), status=503)
+        # in the order of AuthData's fields, which the signed message is built from
+        message = dict(
+            cost=data.get("cost", 0),
+            endpoint=data.get("endpoint", ""),
+            reqnum=next(self.reqnums),
+            url=worker.url,
+        )
+        signature = self.sign(message)
+        worker.routed.append((time.monotonic(), float(message["cost"])))
+        self.route_time += time.perf_counter() - start
+        self.routes += 1
+        return web.json_response(dict(signature=signature, **message))
+
+    async def handle_worker_status(self, request: web.Request) -> web.Response:
+        report = await request.json()
+        url = report.get("url") or str(report.get("id"))
+        worker = self.workers.setdefault(url, WorkerState(url=url))
+        if not worker.is_ready and report.get("max_perf", 0) > 0:
+            log.info(f"worker {url} is ready, max_perf: {report['max_perf']}")
+        worker.reports.append((time.monotonic(), report))
+        return web.json_response(dict(status="ok"))
+
+    async def handle_reports(self, _: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                url: [
+                    dict(received=received - self.start, **report)
+                    for received, report in worker.reports
+                ]
+                for url, worker in self.workers.items()
+            }
+        )
+
+    async def handle_accuracy(self, _: web.Request) -> web.Response:
+        return web.json_response(self.accuracy())
+
+    def accuracy(self, tau: float = LOAD_EWMA_TAU) -> Dict[str, Any]:
+        return dict(
+            routes=self.routes,
+            mean_route_time=self.route_time / self.routes if self.routes else 0.0,
+            workers={
+                url: worker_accuracy(worker, tau)
+                for url, worker in self.workers.items()
+                if worker.reports
+            },
+        )
+
+
+def routed_ewma(
+    routed_times: numpy.ndarray,
+    costs: numpy.ndarray,
+    times: numpy.ndarray,
+    tau: float,
+) -> numpy.ndarray:
+    """
+    EWMA of the routed workload at each of `times`, as Metrics computes cur_load, in linear time and memory:
+    the decayed sum of the costs is accumulated at every routed request, then decayed to each time from the
+    last request routed before it. Both times must be sorted
+    """
+    decayed_sums = numpy.empty(len(costs))
+    total = 0.0
+    for i, cost in enumerate(costs):
+        if i > 0:
+            total *= numpy.exp(-(routed_times[i] - routed_times[i - 1]) / tau)
+        total += cost
+        decayed_sums[i] = total
+    last = numpy.searchsorted(routed_times, times, side="right") - 1
+    routed_before = last >= 0
+    last = numpy.maximum(last, 0)
+    return numpy.where(
+        routed_before,
+        decayed_sums[last] * numpy.exp(-(times - routed_times[last]) / tau) / tau,
+        0.0,
+    )
+
+
+def worker_accuracy(worker: WorkerState, tau: float) -> Dict[str, Any]:
+    """compares each report of a loaded worker with the workload that was routed to it"""
+    reports = [
+        (t, report) for t, report in worker.reports if report.get("max_perf", 0) > 0
+    ]
+    report_times = numpy.array([t for t, _ in worker.reports])
+    intervals = numpy.diff(report_times)
+    result: Dict[str, Any] = dict(
+        reports=len(worker.reports),
+        requests_routed=len(worker.routed),
+        workload_routed=sum(cost for _, cost in worker.routed),
+        mean_report_interval=float(intervals.mean()) if len(intervals) else 0.0,
+        max_report_interval=float(intervals.max()) if len(intervals) else 0.0,
+    )
+    if not reports or not worker.routed:
+        return result
+    times = numpy.array([t for t, _ in reports])
+    reported_load = numpy.array([report["cur_load"] for _, report in reports])
+    routed_times, costs = map(numpy.array, zip(*worker.routed))
+    actual_load = routed_ewma(routed_times, costs, times, tau)
+    error = reported_load - actual_load
+    max_perf = reports[-1][1]["max_perf"]
+    result.update(
+        load_mean_actual=float(actual_load.mean()),
+        load_mean_reported=float(reported_load.mean()),
+        # positive if load is overreported
+        load_bias=float(error.mean()),
+        load_mae=float(numpy.abs(error).mean()),
+        load_relative_error=(
+            float(numpy.abs(error).sum() / actual_load.sum())
+            if actual_load.sum() > 0
+            else 0.0
+        ),
+        load_correlation=(
+            float(numpy.corrcoef(reported_load, actual_load)[0, 1])
+            if len(reports) > 1 and reported_load.std() > 0 and actual_load.std() > 0
+            else 0.0
+        ),
+        max_perf=max_perf,
+        peak_actual_load=float(actual_load.max()),
+        # fraction of reports at which more workload was routed than the worker reported it can serve
+        overload_fraction=float((actual_load > max_perf).mean()),
+    )
+    return result
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Local autoscaler for PyWorker")
+    arg_parser.add_argument("--host", default="0.0.0.0")
+    arg_parser.add_argument("--port", type=int, default=8081)
+    arg_parser.add_argument(
+        "--worker",
+        dest="workers",
+        action="append",
+        default=[],
+        help="URL of a worker to route to before it reports, can be repeated",
+    )
+    arg_parser.add_argument("--policy", choices=ROUTING_POLICIES, default="round_robin")
+    arg_parser.add_argument(
+        "--key-file",
+        help="PEM RSA key to sign with, so that workers can be restarted against a new autoscaler",
+    )
+    arg_parser.add_argument(
+        "--accuracy-file", help="write the accuracy summary as JSON on exit"
+    )
+    args = arg_parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)-5s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    key = None
+    if args.key_file:
+        with open(args.key_file) as f:
+            key = RSA.import_key(f.read())
+    autoscaler = FakeAutoscaler(
+        policy=args.policy,
+        static_workers=args.workers,
+        **(dict(key=key) if key else {}),
+    )
+    app = autoscaler.app()
+
+    async def print_accuracy(_: web.Application) -> None:
+        accuracy = autoscaler.accuracy()
+        print(json.dumps(accuracy, indent=2))
+        if args.accuracy_file:
+            with open(args.accuracy_file, "w") as f:
+                json.dump(accuracy, f, indent=2)
+
+    app.on_shutdown.append(print_accuracy)
+    web.run_app(app, host=args.host, port=args.port, access_log=None)
@@ -0,0 +1,524 @@
+"""
+Stand-in for the model APIs that the workers forward requests to, so that PyWorker can be run and benchmarked
+end to end, benchmark included, on a machine without a GPU, i.e:
+
+MODEL_LOG=/tmp/model.log python3 -m lib.fake_model_server tgi
+MODEL_LOG=/tmp/model.log ... python3 -m workers.tgi.server
+
+It serves the routes of every worker:
+
+POST /v1/chat/completions       TGI chat completions, as server-sent events if "stream" is true
+POST /runsync                   ComfyUI workflows, writes a PNG of the requested size and returns its local_path
+POST /generate                  hello_world generation
+POST /generate_stream           hello_world generation, as server-sent events
+GET /healthcheck, GET /health   200 once the model is "loaded", 503 before
+
+and writes the log lines of the model it stands in for to $MODEL_LOG: downloads, then the line that tells
+PyWorker the model is loaded, and the model's error line if it's made to crash.
+
+Each request takes a base latency plus time proportional to its size (prompt and completion tokens, or
+megapixels times steps), with some jitter. Up to --max-batch requests are served at once, each slowing the
+others down by --batch-slowdown, and the rest wait. Failures can be injected with --error-rate, --hang-rate,
+--crash-after and --wedge-after.
+"""
+
+import os
+import json
+import time
+import zlib
+import struct
+import random
+import asyncio
+import logging
+import argparse
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+from aiohttp import web
+
+FLAVORS = ["tgi", "comfyui", "hello_world"]
+DEFAULT_PORTS = dict(tgi=5001, comfyui=38188, hello_world=5001)
+# requests served at once by default, ComfyUI runs one workflow at a time
+DEFAULT_MAX_BATCH = dict(tgi=32, comfyui=1, hello_world=32)
+CHARS_PER_TOKEN = 4
+MODEL_FILES = 4
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class LatencyModel:
+    """time a request takes to be served, in seconds"""
+
+    base: float = 0.02
+    prefill_per_token: float = 0.0001
+    decode_per_token: float = 0.01
+    per_megapixel_step: float = 0.02
+    # standard deviation of the latency, relative to it
+    jitter: float = 0.05
+    # how much each other request being served slows a request down
+    batch_slowdown: float = 0.05
+
+    def request_time(self, work: float, batch_size: int) -> float:
+        """`work` is the request's time without batching or jitter, excluding the base latency"""
+        slowdown = 1 + self.batch_slowdown * max(batch_size - 1, 0)
+        return max((self.base + work * slowdown) * random.gauss(1.0, self.jitter), 0.0)
+
+
+@dataclass
+class FailureModel:
+    # fraction of requests that fail with a 500
+    error_rate: float = 0.0
+    # fraction of requests that never get a response
+    hang_rate: float = 0.0
+    # number of requests after which the model crashes, logging its error line and failing every request
+    crash_after: Optional[int] = None
+    # number of requests after which the model stops responding to requests and health checks, without logging
+    # anything, as a wedged GPU
+    wedge_after: Optional[int] = None
+
+
+@dataclass
+class FakeModelServer:
+    flavor: str
+    log_file: Optional[str] = None
+    output_dir: str = "/tmp/fake_model_server"
+    # time spent "downloading" the model before it's loaded
+    load_time: float = 5.0
+    max_batch: int = 32
+    # fraction of max_tokens that completions use, each completion's is drawn between this and 1
+    min_completion_fraction: float = 1.0
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    failures: FailureModel = field(default_factory=FailureModel)
+    loaded: bool = False
+    crashed: bool = False
+    requests_served: int = 0
+    batch_size: int = 0
+
+    def __post_init__(self):
+        self.slots = asyncio.Semaphore(self.max_batch)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 2**20)
+        app.add_routes(
+            [
+                web.post("/v1/chat/completions", self.handle_chat),
+                web.post("/runsync", self.handle_runsync),
+                web.post("/generate", self.handle_generate),
+                web.post("/generate_stream", self.handle_generate_stream),
+                web.get("/healthcheck", self.handle_health),
+                web.get("/health", self.handle_health),
+            ]
+        )
+
+        async def start_loading(_: web.Application) -> None:
+            self.loading_task = asyncio.create_task(self.load_model())
+
+        app.on_startup.append(start_loading)
+        return app
+
+    async def load_model(self) -> None:
+        """writes the log lines of downloading and loading the model, over load_time seconds"""
+        self.write_log(*self.__log_lines("start"))
+        for i in range(1, MODEL_FILES + 1):
+            await asyncio.sleep(self.load_time / MODEL_FILES)
+            self.write_log(*self.__log_lines("download", i))
+        self.loaded = True
+        self.write_log(*self.__log_lines("loaded"))
+
+    def write_log(self, *lines: str) -> None:
+        for line in lines:
+            log.debug(line)
+        if self.log_file is None:
+            return
+        with open(self.log_file, "a") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+
+    async def handle_health(self, _: web.Request) -> web.Response:
+        if self.wedged:
+            return await hang()
+        if self.crashed or not self.loaded:
+            return web.Response(status=503)
+        return web.Response(text="ok")
+
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        prompt_tokens = sum(
+            count_tokens(message.get("content")) for message in data.get("messages", [])
+        )
+        completion_tokens = self.__completion_tokens(data.get("max_tokens") or 16)
+        if data.get("stream"):
+            return await self.__stream(
+                request, prompt_tokens, completion_tokens, chat=True
+            )
+        failure = await self.__serve(
+            self.latency.prefill_per_token * prompt_tokens
+            + self.latency.decode_per_token * completion_tokens
+        )
+        if failure is not None:
+            return failure
+        return web.json_response(
+            dict(
+                id=f"chatcmpl-{self.requests_served}",
+                object="chat.completion",
+                created=int(time.time()),
+                model="fake-model",
+                choices=[
+                    dict(
+                        index=0,
+                        message=dict(
+                            role="assistant", content=generate_text(completion_tokens)
+                        ),
+                        finish_reason="length",
+                    )
+                ],
+                usage=usage(prompt_tokens, completion_tokens),
+            )
+        )
+
+    async def handle_runsync(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        width, height, steps = workflow_shape(
+            data.get("input", {}).get("workflow_json", {})
+        )
+        failure = await self.__serve(
+            self.latency.per_megapixel_step * width * height / 1e6 * steps
+        )
+        if failure is not None:
+            return failure
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir, f"ComfyUI_{os.getpid()}_{self.requests_served:05d}.png"
+        )
+        # encoding a large image takes a few ms
+        await asyncio.to_thread(write_png, path, width, height)
+        return web.json_response(
+            dict(
+                id=f"sync-{self.requests_served}",
+                status="COMPLETED",
+                output=dict(images=[dict(local_path=path)]),
+            )
+        )
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        prompt_tokens = count_tokens(data.get("prompt"))
+        completion_tokens = self.__completion_tokens(
+            data.get("max_response_tokens") or 16
+        )
+        failure = await self.__serve(
+            self.latency.prefill_per_token * prompt_tokens
+            + self.latency.decode_per_token * completion_tokens
+        )
+        if failure is not None:
+            return failure
+        return web.json_response(dict(generated_text=generate_text(completion_tokens)))
+
+    async def handle_generate_stream(self, request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        return await self.__stream(
+            request,
+            count_tokens(data.get("prompt")),
+            self.__completion_tokens(data.get("max_response_tokens") or 16),
+            chat=False,
+        )
+
+    #######################################Private#######################################
+
+    def __completion_tokens(self, max_tokens: int) -> int:
+        return max(
+            round(max_tokens * random.uniform(self.min_completion_fraction, 1.0)), 1
+        )
+
+    async def __serve(self, work: float) -> Optional[web.Response]:
+        """waits for a slot and for the request to be served, returns a response if it failed"""
+        failure = self.__failure()
+        if failure is not None:
+            return await failure
+        async with self.slots:
+            self.batch_size += 1
+            try:
+                await asyncio.sleep(self.latency.request_time(work, self.batch_size))
+            finally:
+                self.batch_size -= 1
+        self.requests_served += 1
+        return None
+
+    async def __stream(
+        self,
+        request: web.Request,
+        prompt_tokens: int,
+        completion_tokens: int,
+        chat: bool,
+    ) -> web.StreamResponse:
+        """streams one event per token, in the format of TGI's chat completions or of its /generate_stream"""
+        make_event = self.__chat_event if chat else self.__generate_event
+        failure = self.__failure()
+        if failure is not None:
+            return await failure
+        async with self.slots:
+            self.batch_size += 1
+            try:
+                res = web.StreamResponse()
+                res.content_type = "text/event-stream"
+                await res.prepare(request)
+                # time to first token
+                await asyncio.sleep(
+                    self.latency.request_time(
+                        self.latency.prefill_per_token * prompt_tokens, self.batch_size
+                    )
+                )
+                for i in range(completion_tokens):
+                    last = i == completion_tokens - 1
+                    await res.write(
+                        f"data: {json.dumps(make_event(i, last))}\n\n".encode()
+                    )
+                    await asyncio.sleep(
+                        self.latency.decode_per_token
+                        * (1 + self.latency.batch_slowdown * (self.batch_size - 1))
+                    )
+                if chat:
+                    # the usage of the request is sent in a last event without choices
+                    usage_event = dict(
+                        object="chat.completion.chunk",
+                        choices=[],
+                        usage=usage(prompt_tokens, completion_tokens),
+                    )
+                    await res.write(f"data: {json.dumps(usage_event)}\n\n".encode())
+                    await res.write(b"data: [DONE]\n\n")
+                await res.write_eof()
+            finally:
+                self.batch_size -= 1
+        self.requests_served += 1
+        return res
+
+    def __chat_event(self, i: int, last: bool) -> Dict[str, Any]:
+        return dict(
+            id=f"chatcmpl-{self.requests_served}",
+            object="chat.completion.chunk",
+            created=int(time.time()),
+            model="fake-model",
+            choices=[
+                dict(
+                    index=0,
+                    delta=dict(role="assistant", content=f"{random.choice(WORDS)} "),
+                    finish_reason="length" if last else None,
+                )
+            ],
+        )
+
+    def __generate_event(self, i: int, last: bool) -> Dict[str, Any]:
+        text = f"{random.choice(WORDS)} "
+        return dict(
+            token=dict(id=i, text=text, logprob=0.0, special=False),
+            generated_text=generate_text(i + 1) if last else None,
+            details=None,
+        )
+
+    @property
+    def wedged(self) -> bool:
+        return (
+            self.failures.wedge_after is not None
+            and self.requests_served >= self.failures.wedge_after
+        )
+
+    def __failure(self):
+        """coroutine that returns the response of a failed request, or None if the request doesn't fail"""
+        if self.wedged:
+            return hang()
+        if (
+            self.failures.crash_after is not None
+            and self.requests_served >= self.failures.crash_after
+            and not self.crashed
+        ):
+            self.crashed = True
+            self.write_log(*self.__log_lines("error"))
+        if self.crashed or not self.loaded:
+            return respond(web.Response(status=503))
+        draw = random.random()
+        if draw < self.failures.error_rate:
+            return respond(web.json_response(dict(error="injected error"), status=500))
+        if draw < self.failures.error_rate + self.failures.hang_rate:
+            return hang()
+        return None
+
+    def __log_lines(self, event: str, i: int = 0) -> List[str]:
+        now = datetime.now(timezone.utc)
+        match self.flavor, event:
+            case "tgi", _:
+                messages = dict(
+                    start=['Args { model_id: \\"fake-model\\" }'],
+                    download=[
+                        f"Download file: model-{i:05d}-of-{MODEL_FILES:05d}.safetensors",
+                        f"Downloaded /data/model-{i:05d}-of-{MODEL_FILES:05d}.safetensors in "
+                        f"0:00:{int(self.load_time / MODEL_FILES):02d}.",
+                        f"Download: [{i}/{MODEL_FILES}] -- ETA: "
+                        f"0:00:{int(self.load_time / MODEL_FILES * (MODEL_FILES - i)):02d}",
+                    ],
+                    loaded=["Connected"],
+                    error=["Error: ShardFailed"],
+                )[event]
+                target = (
+                    "text_generation_router::server"
+                    if event == "loaded"
+                    else "text_generation_launcher"
+                )
+                return [
+                    f'{{"timestamp":"{now.isoformat()}","level":"INFO",'
+                    f'"message":"{message}","target":"{target}"}}'
+                    for message in messages
+                ]
+            case "comfyui", "start":
+                return ["Starting server"]
+            case "comfyui", "download":
+                done = i / MODEL_FILES
+                bar = "█" * int(done * 10)
+                return [
+                    f"Downloading: {int(done * 100)}%|{bar:<10}| {done * 10:.2f}G/10.0G "
+                    f"[00:{int(self.load_time * done):02d}<00:{int(self.load_time * (1 - done)):02d}, "
+                    f"{10000 / max(self.load_time, 1e-3):.0f}MB/s]"
+                ]
+            case "comfyui", "loaded":
+                return ["To see the GUI go to: http://127.0.0.1:18188"]
+            case "comfyui", "error":
+                return ["safetensors_rust.SafetensorError: MetadataIncompleteBuffer"]
+            case _, "start":
+                return ["loading model"]
+            case _, "download":
+                return [f"loaded model shard {i}/{MODEL_FILES}"]
+            case _, "loaded":
+                return ["infer server has started"]
+            case _, "error":
+                return ["Exception: corrupted model file"]
+        return []
+
+
+async def respond(response: web.Response) -> web.Response:
+    return response
+
+
+async def hang() -> web.Response:
+    await asyncio.Event().wait()
+    return web.Response(status=500)
+
+
+def count_tokens(content: Any) -> int:
+    if isinstance(content, list):
+        return sum(
+            count_tokens(part.get("text")) for part in content if isinstance(part, dict)
+        )
+    return len(content or "") // CHARS_PER_TOKEN
+
+
+def usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, int]:
+    return dict(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+def generate_text(tokens: int) -> str:
+    return " ".join(random.choices(WORDS, k=tokens))
+
+
+def workflow_shape(workflow: Dict[str, Any]) -> Tuple[int, int, int]:
+    """width, height and steps of a ComfyUI workflow, 1024x1024 and 28 steps if they aren't in it"""
+    width, height, steps = 1024, 1024, 28
+    for node in workflow.values():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        if isinstance(inputs.get("width"), int) and isinstance(
+            inputs.get("height"), int
+        ):
+            width, height = inputs["width"], inputs["height"]
+        if isinstance(inputs.get("steps"), int):
+            steps = inputs["steps"]
+    return width, height, steps
+
+
+def write_png(path: str, width: int, height: int) -> None:
+    """writes an RGB gradient of the given size as a PNG"""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    pixels = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+    pixels[:, :, 0] = numpy.linspace(0, 255, width, dtype=numpy.uint8)
+    pixels[:, :, 1] = numpy.linspace(0, 255, height, dtype=numpy.uint8)[:, None]
+    pixels[:, :, 2] = 128
+    # each row starts with its filter type, 0 means no filter
+    raw = numpy.concatenate(
+        (numpy.zeros((height, 1), dtype=numpy.uint8), pixels.reshape(height, -1)),
+        axis=1,
+    ).tobytes()
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 1)))
+        f.write(chunk(b"IEND", b""))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Fake model API for PyWorker")
+    arg_parser.add_argument("flavor", choices=FLAVORS)
+    arg_parser.add_argument("--port", type=int, help="defaults to the worker's")
+    arg_parser.add_argument("--host", default="0.0.0.0")
+    arg_parser.add_argument(
+        "--log-file", default=os.environ.get("MODEL_LOG"), help="defaults to $MODEL_LOG"
+    )
+    arg_parser.add_argument("--output-dir", default="/tmp/fake_model_server")
+    arg_parser.add_argument("--load-time", type=float, default=5.0)
+    arg_parser.add_argument("--max-batch", type=int, help="defaults to the model's")
+    arg_parser.add_argument("--min-completion-fraction", type=float, default=1.0)
+    latency = LatencyModel()
+    for name in latency.__dataclass_fields__:
+        arg_parser.add_argument(
+            f"--{name.replace('_', '-')}", type=float, default=getattr(latency, name)
+        )
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--hang-rate", type=float, default=0.0)
+    arg_parser.add_argument("--crash-after", type=int)
+    arg_parser.add_argument("--wedge-after", type=int)
+    arg_parser.add_argument("-v", dest="verbose", action="store_true")
+    args = arg_parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s[%(levelname)-5s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    async def make_app() -> web.Application:
+        # the semaphore is created on the event loop that serves the app
+        server = FakeModelServer(
+            flavor=args.flavor,
+            log_file=args.log_file,
+            output_dir=args.output_dir,
+            load_time=args.load_time,
+            max_batch=args.max_batch or DEFAULT_MAX_BATCH[args.flavor],
+            min_completion_fraction=args.min_completion_fraction,
+            latency=LatencyModel(
+                **{name: getattr(args, name) for name in latency.__dataclass_fields__}
+            ),
+            failures=FailureModel(
+                error_rate=args.error_rate,
+                hang_rate=args.hang_rate,
+                crash_after=args.crash_after,
+                wedge_after=args.wedge_after,
+            ),
+        )
+        return server.app()
+
+    web.run_app(
+        make_app(),
+        host=args.host,
+        port=args.port or DEFAULT_PORTS[args.flavor],
+        access_log=None,
+    )
@@ -0,0 +1,143 @@
+"""
+Replays a recorded request trace through LoadForecaster and compares its forecasts with what actually
+arrived, and with a naive forecast that the current rate stays the same, i.e:
+
+python3 -m lib.forecast_eval capture.jsonl --alpha 0.2 --beta 0.05
+
+The trace should be a capture file, as written to $CAPTURE_FILE (see lib.capture), which records every request,
+with the time it arrived at in "arrival" and its "workload". Requests without a workload count as 1, so that
+the forecast is of requests per second.
+
+Files written to $TRACE_FILE (see lib.tracing) only hold a sample of the requests, so their records must carry
+the "sample_rate" they were sampled at, and each of them counts as 1 / sample_rate requests. The arrival rate of
+a sampled trace is noisier than that of a capture, even more so at low rates.
+"""
+
+import sys
+import json
+import argparse
+from typing import Any, Dict, List, TextIO
+
+import numpy
+
+from lib.estimators import (
+    LoadForecaster,
+    FORECAST_STEP,
+    FORECAST_ALPHA,
+    FORECAST_BETA,
+    FORECAST_DAMPING,
+    format_window,
+)
+
+
+def read_arrivals(f: TextIO) -> numpy.ndarray:
+    """(arrival time, workload) rows sorted by arrival time, sampled records are weighted by their sample rate"""
+    arrivals = []
+    for line in f:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        workload = record.get("workload") or 1.0
+        if "arrival" in record:
+            arrivals.append((record["arrival"], workload))
+            continue
+        if not record.get("sample_rate"):
+            raise ValueError(
+                "records of $TRACE_FILE without a sample_rate can't be weighted, use a capture file"
+            )
+        arrivals.append((record["start_time"], workload / record["sample_rate"]))
+    arrivals.sort()
+    return numpy.array(arrivals, dtype=float).reshape(-1, 2)
+
+
+def step_rates(arrivals: numpy.ndarray, step: float) -> numpy.ndarray:
+    """arrival rate of each step of the trace"""
+    times = arrivals[:, 0] - arrivals[0, 0]
+    num_steps = int(times[-1] // step) + 1
+    return (
+        numpy.bincount(
+            (times // step).astype(int), weights=arrivals[:, 1], minlength=num_steps
+        )
+        / step
+    )
+
+
+def evaluate(rates: numpy.ndarray, forecaster: LoadForecaster) -> List[Dict[str, Any]]:
+    """mean absolute and root mean squared error of the forecaster and the naive forecast at each horizon"""
+    forecasts = numpy.empty((len(rates), len(forecaster.horizons)))
+    for i, rate in enumerate(rates):
+        forecaster.observe(rate)
+        forecasts[i] = forecaster.forecast()
+    results = []
+    for k, horizon_steps in enumerate(forecaster.horizon_steps):
+        if horizon_steps >= len(rates):
+            continue
+        actual = rates[horizon_steps:]
+        errors = dict(
+            holt=forecasts[:-horizon_steps, k] - actual,
+            naive=rates[:-horizon_steps] - actual,
+        )
+        results.append(
+            dict(
+                horizon=format_window(forecaster.horizons[k]),
+                samples=len(actual),
+                mean_rate=float(actual.mean()),
+                **{
+                    f"{name}_{stat}": float(value)
+                    for name, error in errors.items()
+                    for stat, value in [
+                        ("mae", numpy.abs(error).mean()),
+                        ("rmse", numpy.sqrt((error**2).mean())),
+                    ]
+                },
+            )
+        )
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    print(
+        f"{'horizon':>8} {'samples':>8} {'mean rate':>10} "
+        f"{'holt mae':>10} {'holt rmse':>10} {'naive mae':>10} {'naive rmse':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['horizon']:>8} {result['samples']:>8} {result['mean_rate']:>10.3f} "
+            f"{result['holt_mae']:>10.3f} {result['holt_rmse']:>10.3f} "
+            f"{result['naive_mae']:>10.3f} {result['naive_rmse']:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Evaluate the load forecast on a recorded trace"
+    )
+    arg_parser.add_argument("trace", help="JSON lines trace, - for stdin")
+    arg_parser.add_argument("--step", type=float, default=FORECAST_STEP)
+    arg_parser.add_argument("--alpha", type=float, default=FORECAST_ALPHA)
+    arg_parser.add_argument("--beta", type=float, default=FORECAST_BETA)
+    arg_parser.add_argument("--damping", type=float, default=FORECAST_DAMPING)
+    arg_parser.add_argument(
+        "--json", action="store_true", help="print the results as JSON"
+    )
+    args = arg_parser.parse_args()
+    try:
+        if args.trace == "-":
+            arrivals = read_arrivals(sys.stdin)
+        else:
+            with open(args.trace) as f:
+                arrivals = read_arrivals(f)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if len(arrivals) == 0:
+        raise SystemExit("trace is empty")
+    results = evaluate(
+        step_rates(arrivals, args.step),
+        LoadForecaster(
+            step=args.step, alpha=args.alpha, beta=args.beta, damping=args.damping
+        ),
+    )
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
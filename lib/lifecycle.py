@@ -0,0 +1,140 @@
+"""
+Stops and restarts a worker without dropping requests, see lib.server.start_server.
+
+SIGTERM drains the worker: it reports `draining` to the autoscaler, so that it isn't routed new requests, stops
+listening, answers requests sent on connections that are still open with 503, lets the requests in flight finish
+for up to $PYWORKER_DRAIN_TIMEOUT seconds, sends a final report and exits.
+
+SIGUSR2 hands the worker over to a new process, i.e. to run updated code: PyWorker starts itself again with the
+same command line and environment, passes it the listening socket in $PYWORKER_LISTEN_FD, and keeps serving.
+Once the new process has loaded the model, which only takes one request as the benchmark result is kept in
+.has_benchmark, it starts reporting to the autoscaler and sends SIGUSR1 to the old process, which stops
+listening, finishes its requests in flight and exits without reporting. Both processes accept connections on
+the same socket until then, so none are refused.
+
+With $PYWORKER_PROCESSES, serving processes don't share a socket, the new ones bind the port with SO_REUSEPORT
+alongside the old ones, and connections still queued on the old ones' sockets when they stop listening are
+reset. The new process must be started with the same $PYWORKER_PROCESSES.
+"""
+
+import os
+import sys
+import signal
+import socket
+import logging
+import subprocess
+from asyncio import Event, sleep, create_task, get_running_loop
+from dataclasses import dataclass
+from typing import Optional
+
+from lib.backend import Backend
+
+# seconds requests in flight are given to finish once the worker stops listening
+DRAIN_TIMEOUT = float(os.environ.get("PYWORKER_DRAIN_TIMEOUT", "120"))
+# set by the process that hands its listening socket over on SIGUSR2
+LISTEN_FD = (
+    int(os.environ["PYWORKER_LISTEN_FD"])
+    if "PYWORKER_LISTEN_FD" in os.environ
+    else None
+)
+HANDOFF_PID = (
+    int(os.environ["PYWORKER_HANDOFF_PID"])
+    if "PYWORKER_HANDOFF_PID" in os.environ
+    else None
+)
+HANDOFF_POLL_INTERVAL = 0.1
+REPLACEMENT_POLL_INTERVAL = 1.0
+
+log = logging.getLogger(__file__)
+
+
+def listening_socket(port: int, backlog: int) -> socket.socket:
+    """the socket handed over by the previous process, or a new one on every interface"""
+    if LISTEN_FD is not None:
+        log.debug(f"serving on the socket handed over by {HANDOFF_PID}")
+        return socket.socket(fileno=LISTEN_FD)
+    if socket.has_dualstack_ipv6():
+        return socket.create_server(
+            ("", port),
+            family=socket.AF_INET6,
+            backlog=backlog,
+            dualstack_ipv6=True,
+        )
+    return socket.create_server(("", port), backlog=backlog)
+
+
+@dataclass
+class Lifecycle:
+    backend: Backend
+    # socket handed over to the new process on SIGUSR2, serving processes of $PYWORKER_PROCESSES have none
+    listen_fd: Optional[int] = None
+
+    def __post_init__(self):
+        self.stopping = Event()
+        # set when the process stops because a new one took over, rather than to drain the worker
+        self.handed_off = False
+        self.replacement: Optional[subprocess.Popen] = None
+        # the new process doesn't report until it takes over
+        self.backend.metrics.reporting = HANDOFF_PID is None
+
+    def install(self) -> None:
+        loop = get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+        loop.add_signal_handler(signal.SIGUSR1, self.hand_off)
+        loop.add_signal_handler(signal.SIGUSR2, self.start_replacement)
+
+    async def wait(self) -> None:
+        """waits for the process to be told to stop, then stops admitting requests"""
+        await self.stopping.wait()
+        if self.handed_off:
+            log.debug("handed over to the new process, finishing requests in flight")
+            self.backend.metrics.reporting = False
+            self.backend.draining = True
+        else:
+            self.backend.start_draining()
+
+    async def take_over(self) -> None:
+        """in a process started on SIGUSR2, takes over from the previous process once the model is loaded"""
+        if HANDOFF_PID is None:
+            return
+        while self.backend.metrics.system_metrics.model_is_loaded is False:
+            await sleep(HANDOFF_POLL_INTERVAL)
+        log.debug(f"model loaded, taking over from {HANDOFF_PID}")
+        self.backend.metrics.reporting = True
+        self.backend.metrics.flush_event.set()
+        try:
+            os.kill(HANDOFF_PID, signal.SIGUSR1)
+        except ProcessLookupError:
+            log.debug(f"previous process {HANDOFF_PID} already exited")
+
+    def hand_off(self) -> None:
+        self.handed_off = True
+        self.stopping.set()
+
+    def start_replacement(self) -> None:
+        if self.replacement is not None and self.replacement.poll() is None:
+            log.debug(f"replacement {self.replacement.pid} is already starting")
+            return
+        env = dict(os.environ, PYWORKER_HANDOFF_PID=str(os.getpid()))
+        env.pop("PYWORKER_LISTEN_FD", None)
+        pass_fds = ()
+        if self.listen_fd is not None:
+            env["PYWORKER_LISTEN_FD"] = str(self.listen_fd)
+            pass_fds = (self.listen_fd,)
+        self.replacement = subprocess.Popen(
+            [sys.executable, *sys.orig_argv[1:]], env=env, pass_fds=pass_fds
+        )
+        log.debug(f"started replacement process {self.replacement.pid}")
+        create_task(self.__watch_replacement(self.replacement))
+
+    #######################################Private#######################################
+
+    async def __watch_replacement(self, replacement: subprocess.Popen) -> None:
+        # polled, a thread waiting for it would keep this process from exiting once it has taken over
+        while replacement.poll() is None:
+            if self.handed_off:
+                return
+            await sleep(REPLACEMENT_POLL_INTERVAL)
+        log.debug(
+            f"replacement process {replacement.pid} exited with {replacement.returncode} before taking over, still serving"
+        )
@@ -0,0 +1,192 @@
+"""
+Progress of downloading the model, parsed from the model's log lines while it loads, so that the autoscaler can
+tell a worker seconds from ready from one with gigabytes left to download.
+
+Workers pass Backend the extractors that understand their model server's log lines, each returns a LoadProgress
+for the lines it recognises and None for every other line:
+
+tgi_download_progress   TGI's `Download: [3/8] -- ETA: 0:00:47.25`, files downloaded out of the total
+tqdm_progress           tqdm progress bars, as printed by ComfyUI and huggingface_hub while they download:
+                        `Downloading: 45%|████▌     | 4.50G/10.0G [00:30<00:36, 150MB/s]`
+
+LoadTracker adds up the files of the download and turns them into its progress, its throughput, over the last
+$LOAD_PROGRESS_WINDOW seconds, and the time left, which are reported to the autoscaler until the model is loaded,
+see lib.metrics. Files that haven't started downloading can't be counted, so with tqdm bars the progress and
+time left are those of the files seen so far.
+"""
+
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from lib.estimators import WindowedSum
+
+# seconds over which the download throughput is measured
+LOAD_PROGRESS_WINDOW = float(os.environ.get("LOAD_PROGRESS_WINDOW", "30"))
+# tqdm's unit_scale prefixes, huggingface_hub divides bytes by 1024
+TQDM_UNIT_DIVISOR = 1024
+TQDM_PREFIXES = "kMGTPEZY"
+
+TGI_DOWNLOAD = re.compile(
+    r"Download: \[(\d+)/(\d+)\](?: -- ETA: (?:(\d+) days?, )?(\d+):(\d+):([\d.]+))?"
+)
+# only bars of bytes, which tqdm rates in B/s, as ComfyUI also prints a bar of sampling steps in it/s
+TQDM_BAR = re.compile(
+    r"(\d+)%\|[^|]*\|\s*([\d.]+)([kMGTPEZY]?)B?/([\d.]+)([kMGTPEZY]?)B?\s*"
+    r"\[[^<\]]*<(?:(?:(\d+):)?(\d+):(\d+)|\?), [^\]]*B/s\]"
+)
+
+
+@dataclass
+class LoadProgress:
+    """progress of the download as of one log line"""
+
+    # fraction of the download that is done, from 0 to 1
+    fraction: float
+    # bytes downloaded out of the total, if the line has them
+    done_bytes: Optional[float] = None
+    total_bytes: Optional[float] = None
+    # seconds left, as estimated by the model server itself
+    eta: Optional[float] = None
+    # the file the line is about, lines about the whole download have none
+    file: Optional[str] = None
+
+
+LoadProgressExtractor = Callable[[str], Optional[LoadProgress]]
+
+
+def tgi_download_progress(log_line: str) -> Optional[LoadProgress]:
+    match = TGI_DOWNLOAD.search(log_line)
+    if match is None:
+        return None
+    done, total, days, hours, minutes, seconds = match.groups()
+    eta = None
+    if seconds is not None:
+        eta = (
+            int(days or 0) * 86400
+            + int(hours) * 3600
+            + int(minutes) * 60
+            + float(seconds)
+        )
+    return LoadProgress(fraction=int(done) / max(int(total), 1), eta=eta)
+
+
+def tqdm_progress(log_line: str) -> Optional[LoadProgress]:
+    match = TQDM_BAR.search(log_line)
+    if match is None:
+        return None
+    percent, done, done_prefix, total, total_prefix, hours, minutes, seconds = (
+        match.groups()
+    )
+    # bars are told apart by the last word of their description, i.e. "model.safetensors:", and their total,
+    # as the start of the line can change from one line to the next, i.e. with a timestamp
+    description = log_line[: match.start()].split()
+    return LoadProgress(
+        file=f"{description[-1] if description else ''} {total}{total_prefix}",
+        fraction=int(percent) / 100,
+        done_bytes=float(done) * unit_scale(done_prefix),
+        total_bytes=float(total) * unit_scale(total_prefix),
+        eta=(
+            None
+            if seconds is None
+            else int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+        ),
+    )
+
+
+def unit_scale(prefix: str) -> float:
+    return (
+        float(TQDM_UNIT_DIVISOR ** (TQDM_PREFIXES.index(prefix) + 1)) if prefix else 1.0
+    )
+
+
+@dataclass
+class LoadTracker:
+    """
+    progress, throughput and time left of the whole download, from the LoadProgress of the model's log lines.
+    Lines about different files, as tqdm prints a bar per file, are added up by bytes. A file is only counted once
+    a line about it has been printed, so progress goes down when a new file starts
+    """
+
+    window: float = LOAD_PROGRESS_WINDOW
+
+    def __post_init__(self):
+        # the last progress of every file, by LoadProgress.file
+        self.files: Dict[Optional[str], LoadProgress] = {}
+        self.last: Optional[LoadProgress] = None
+        self.last_update: Optional[float] = None
+        # bytes downloaded, and fractions of files, over the window. Fractions only measure the rate of lines
+        # that don't count bytes, i.e. TGI's, which are about the whole download
+        self.bytes = WindowedSum(window=self.window)
+        self.fraction = WindowedSum(window=self.window)
+
+    def update(self, progress: LoadProgress, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        previous = self.files.get(progress.file)
+        if not self.files:
+            # the first line only starts the windows, what it counts was downloaded over an unknown time
+            self.bytes.add(0.0, now)
+            self.fraction.add(0.0, now)
+        else:
+            # the bytes of a new file were downloaded since the last line
+            if progress.done_bytes is not None:
+                done_before = previous.done_bytes if previous else None
+                self.bytes.add(
+                    max(progress.done_bytes - (done_before or 0.0), 0.0), now
+                )
+            fraction_before = previous.fraction if previous else 0.0
+            self.fraction.add(max(progress.fraction - fraction_before, 0.0), now)
+        self.files[progress.file] = progress
+        self.last = progress
+        self.last_update = now
+
+    @property
+    def counts_bytes(self) -> bool:
+        return bool(self.files) and all(
+            file.total_bytes is not None for file in self.files.values()
+        )
+
+    @property
+    def progress(self) -> Optional[float]:
+        """fraction of the files seen so far that is downloaded"""
+        if not self.files:
+            return None
+        if self.counts_bytes:
+            total = sum(file.total_bytes or 0.0 for file in self.files.values())
+            done = sum(file.done_bytes or 0.0 for file in self.files.values())
+            return min(done / total, 1.0) if total > 0 else 1.0
+        return sum(file.fraction for file in self.files.values()) / len(self.files)
+
+    def throughput(self, now: Optional[float] = None) -> Optional[float]:
+        """bytes per second, None if the log lines don't count bytes"""
+        if not self.counts_bytes:
+            return None
+        return self.bytes.rate(time.monotonic() if now is None else now)
+
+    def eta(self, now: Optional[float] = None) -> Optional[float]:
+        """seconds until the files seen so far are downloaded, None until it can be estimated"""
+        progress = self.progress
+        if progress is None or self.last is None or self.last_update is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if progress >= 1.0:
+            return 0.0
+        # as of the last line, the download hasn't slowed down just because the next line hasn't been printed yet
+        if self.counts_bytes:
+            rate = self.bytes.rate(self.last_update)
+            left = sum(
+                (file.total_bytes or 0.0) - (file.done_bytes or 0.0)
+                for file in self.files.values()
+            )
+        else:
+            rate = self.fraction.rate(self.last_update) / len(self.files)
+            left = 1.0 - progress
+        if rate > 0:
+            eta = left / rate
+        elif len(self.files) == 1 and self.last.eta is not None:
+            eta = self.last.eta
+        else:
+            return None
+        return max(eta - (now - self.last_update), 0.0)
@@ -0,0 +1,86 @@
+"""
+Measures how late the event loop runs a task that sleeps for a fixed interval. Anything that blocks the loop,
+such as a synchronous call in a handler, shows up as lag. With $PYWORKER_DEBUG set to "true", a watchdog
+thread also logs the stack of the event loop thread whenever it's blocked for longer than
+$LOOP_BLOCK_THRESHOLD seconds.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+from asyncio import sleep
+from dataclasses import dataclass
+from typing import Awaitable, NoReturn
+
+from lib.prometheus import Registry
+
+LOOP_LAG_INTERVAL = 0.1
+LOOP_BLOCK_THRESHOLD = float(os.environ.get("LOOP_BLOCK_THRESHOLD", "0.25"))
+CAPTURE_BLOCKING_STACKS = os.environ.get("PYWORKER_DEBUG", "false") == "true"
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class LoopMonitor:
+    registry: Registry
+    interval: float = LOOP_LAG_INTERVAL
+    block_threshold: float = LOOP_BLOCK_THRESHOLD
+    capture_stacks: bool = CAPTURE_BLOCKING_STACKS
+    # highest lag since the last report to the autoscaler, reset by Metrics
+    max_lag: float = 0.0
+
+    def __post_init__(self):
+        self.lag = self.registry.histogram(
+            "pyworker_event_loop_lag_seconds",
+            "Delay of the event loop in running a scheduled task",
+            LOOP_LAG_BUCKETS,
+        )
+        self.heartbeat = time.monotonic()
+
+    async def run(self) -> Awaitable[NoReturn]:
+        # the monitor is created with Metrics, which can be long before the event loop runs it
+        self.heartbeat = time.monotonic()
+        if self.capture_stacks:
+            threading.Thread(
+                target=self.__watch_loop,
+                args=(threading.get_ident(),),
+                name="pyworker-loop-watchdog",
+                daemon=True,
+            ).start()
+        while True:
+            expected = time.monotonic() + self.interval
+            await sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            lag = max(self.heartbeat - expected, 0.0)
+            self.lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    #######################################Private#######################################
+
+    def __watch_loop(self, loop_thread_id: int) -> None:
+        """runs in a thread, logs the stack of the event loop thread while it's blocked"""
+        reported_heartbeat = None
+        while True:
+            time.sleep(self.block_threshold / 2)
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.block_threshold or heartbeat == reported_heartbeat:
+                continue
+            # report each blocking call once
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None:
+                return
+            log.warning(
+                "\n".join(
+                    [
+                        f"event loop blocked for more than {blocked_for:.3f}s in:",
+                        "".join(traceback.format_stack(frame)),
+                    ]
+                )
+            )
@@ -2,17 +2,53 @@ import os
 import time
 import logging
 import json
-from asyncio import sleep
+import asyncio
+from collections import deque
 from dataclasses import dataclass, asdict, field
 from functools import cache
 from urllib.parse import urljoin
 
+import numpy
 import requests
 
-from lib.data_types import AutoScalaerData, SystemMetrics, ModelMetrics
-from typing import Awaitable, NoReturn, List
+from lib.data_types import (
+    AutoScalaerData,
+    SystemMetrics,
+    ModelMetrics,
+    WarmupResult,
+    StreamStats,
+)
+from lib.loop_monitor import LoopMonitor
+from lib.load_progress import LoadProgress, LoadTracker
+from lib.estimators import RateEstimator, LoadForecaster, format_window
+from lib.prometheus import (
+    Registry,
+    LATENCY_BUCKETS,
+    WORKLOAD_BUCKETS,
+    BYTES_BUCKETS,
+)
+from typing import Awaitable, Deque, Dict, NoReturn, List, Optional, Tuple
 
-METRICS_UPDATE_INTERVAL = 1
+# reports are sent immediately when the pending workload or number of requests in flight grows by more
+# than this fraction since the last report, and by at least METRICS_MIN_REQUEST_CHANGE requests or
+# METRICS_MIN_WORKLOAD_CHANGE seconds of work at the benchmark throughput. Other changes, including any
+# decrease, are coalesced into a report every METRICS_COALESCE_INTERVAL seconds, and a report is sent at
+# least every METRICS_MAX_INTERVAL seconds
+METRICS_CHANGE_THRESHOLD = float(os.environ.get("METRICS_CHANGE_THRESHOLD", "0.2"))
+METRICS_MIN_REQUEST_CHANGE = int(os.environ.get("METRICS_MIN_REQUEST_CHANGE", "2"))
+METRICS_MIN_WORKLOAD_CHANGE = float(os.environ.get("METRICS_MIN_WORKLOAD_CHANGE", "1"))
+METRICS_MIN_INTERVAL = float(os.environ.get("METRICS_MIN_INTERVAL", "1"))
+METRICS_COALESCE_INTERVAL = float(os.environ.get("METRICS_COALESCE_INTERVAL", "5"))
+METRICS_MAX_INTERVAL = float(os.environ.get("METRICS_MAX_INTERVAL", "10"))
+# time constants, in seconds, of the EWMAs of the load and performance reported to the autoscaler
+LOAD_EWMA_TAU = 10.0
+PERF_EWMA_TAU = 60.0
+# latency percentiles are reported over the requests that finished in the last LATENCY_WINDOW seconds, up to
+# LATENCY_WINDOW_SIZE of them
+LATENCY_WINDOW = 60.0
+LATENCY_WINDOW_SIZE = 4096
+# headroom is the workload that could be added and still be served within this many seconds
+HEADROOM_HORIZON = float(os.environ.get("HEADROOM_HORIZON", "1"))
 
 log = logging.getLogger(__file__)
 
@@ -25,6 +61,63 @@ def get_url() -> str:
     return f"http{'s' if use_ssl else ''}://{public_ip}:{worker_port}"
 
 
+@dataclass
+class ReportPolicy:
+    """decides when metrics are reported to the autoscaler"""
+
+    change_threshold: float = METRICS_CHANGE_THRESHOLD
+    min_request_change: int = METRICS_MIN_REQUEST_CHANGE
+    # seconds of work at max_throughput
+    min_workload_change: float = METRICS_MIN_WORKLOAD_CHANGE
+    # minimum time between reports, so that a burst of requests results in a single report
+    min_interval: float = METRICS_MIN_INTERVAL
+    coalesce_interval: float = METRICS_COALESCE_INTERVAL
+    max_interval: float = METRICS_MAX_INTERVAL
+    # values as of the last report
+    reported_workload_pending: float = 0.0
+    reported_requests_working: int = 0
+
+    def is_significant(
+        self, workload_pending: float, requests_working: int, max_throughput: float
+    ) -> bool:
+        """whether the change since the last report should be reported immediately"""
+
+        def grew(value: float, reported: float, min_change: float) -> bool:
+            # the first request after being idle is significant, a worker with fewer requests doesn't need
+            # scaling up so decreases wait for the coalesced report
+            if reported == 0:
+                return value > 0
+            increase = value - reported
+            return (
+                increase > self.change_threshold * reported and increase >= min_change
+            )
+
+        return grew(
+            workload_pending,
+            self.reported_workload_pending,
+            self.min_workload_change * max_throughput,
+        ) or grew(
+            requests_working, self.reported_requests_working, self.min_request_change
+        )
+
+    def is_due(self, elapsed: float, update_pending: bool) -> bool:
+        """whether a report is due, significant changes aside"""
+        if update_pending:
+            return elapsed >= self.coalesce_interval
+        return elapsed >= self.max_interval
+
+    def next_report_in(self, elapsed: float, update_pending: bool) -> float:
+        """seconds until a report may be due if nothing significant changes"""
+        if update_pending or elapsed < self.coalesce_interval:
+            # changes that arrive in the meantime are due with the coalesced report
+            return max(self.coalesce_interval - elapsed, 0.0)
+        return max(self.max_interval - elapsed, 0.0)
+
+    def reported(self, workload_pending: float, requests_working: int) -> None:
+        self.reported_workload_pending = workload_pending
+        self.reported_requests_working = requests_working
+
+
 @dataclass
 class Metrics:
     last_metric_update: float = 0.0
@@ -36,89 +129,492 @@ class Metrics:
     url: str = field(default_factory=get_url)
     system_metrics: SystemMetrics = field(default_factory=SystemMetrics.empty)
     model_metrics: ModelMetrics = field(default_factory=ModelMetrics.empty)
+    # served at /metrics, see lib.prometheus
+    registry: Registry = field(default_factory=Registry)
+    report_policy: ReportPolicy = field(default_factory=ReportPolicy)
+    # number of requests the model API is sent at once, None if there's no limit
+    max_concurrency: Optional[int] = None
+    # (end time, latency, workload) of recently finished requests, in monotonic clock time
+    recent_requests: Deque[Tuple[float, float, float]] = field(
+        default_factory=lambda: deque(maxlen=LATENCY_WINDOW_SIZE)
+    )
+    # set while the worker finishes its requests before it stops, so that the autoscaler stops routing to it
+    draining: bool = False
+    # reports are computed but not sent while False, i.e. while another process reports for the worker during
+    # a socket handoff, see lib.server
+    reporting: bool = True
+
+    def __post_init__(self):
+        # set when a change should be reported without waiting for the next coalesced report
+        self.flush_event = asyncio.Event()
+        self.loop_monitor = LoopMonitor(registry=self.registry)
+        # download progress of the model while it loads, from its log lines, see lib.load_progress
+        self.load_tracker = LoadTracker()
+        # workload received and not cancelled, reported as cur_load
+        self.load = RateEstimator(tau=LOAD_EWMA_TAU)
+        # monotonic time each request in flight was added to the load at, by reqnum, so that cancelling it
+        # only takes back what is left of it
+        self.load_added_at: Dict[int, float] = {}
+        # workload served and time spent serving it, their ratio is reported as cur_perf
+        self.served = RateEstimator(tau=PERF_EWMA_TAU)
+        self.busy = RateEstimator(tau=PERF_EWMA_TAU)
+        # arrival workload, including requests that are later cancelled
+        self.forecaster = LoadForecaster()
+        endpoint = ("endpoint",)
+        self.request_latency = self.registry.histogram(
+            "pyworker_request_latency_seconds",
+            "Time from receiving a request to returning its response",
+            LATENCY_BUCKETS,
+            endpoint,
+        )
+        self.queue_wait = self.registry.histogram(
+            "pyworker_queue_wait_seconds",
+            "Time a request waited before being forwarded to the model API",
+            LATENCY_BUCKETS,
+            endpoint,
+        )
+        self.upstream_latency = self.registry.histogram(
+            "pyworker_upstream_latency_seconds",
+            "Time until the model API responded to a request",
+            LATENCY_BUCKETS,
+            endpoint,
+        )
+        self.request_workload = self.registry.histogram(
+            "pyworker_request_workload",
+            "Estimated workload of a request",
+            WORKLOAD_BUCKETS,
+            endpoint,
+        )
+        self.response_bytes = self.registry.histogram(
+            "pyworker_response_bytes",
+            "Size of the responses sent to clients",
+            BYTES_BUCKETS,
+            endpoint,
+        )
+        self.hook_wait = self.registry.histogram(
+            "pyworker_hook_wait_seconds",
+            "Time CPU bound hooks waited for the hook executor",
+            LATENCY_BUCKETS,
+        )
+        self.requests_total = self.registry.counter(
+            "pyworker_requests_total",
+            "Requests handled, by response status",
+            ("endpoint", "status"),
+        )
+        self.workload_total = self.registry.counter(
+            "pyworker_workload_total",
+            "Workload of requests, by outcome",
+            ("outcome",),
+        )
+        self.registry.gauge(
+            "pyworker_workload_pending",
+            "Workload of the requests that are being processed",
+            lambda: self.model_metrics.workload_pending,
+        )
+        self.registry.gauge(
+            "pyworker_requests_working",
+            "Number of requests that are being processed",
+            lambda: len(self.model_metrics.requests_working),
+        )
+        self.registry.gauge(
+            "pyworker_hooks_queued",
+            "CPU bound hooks waiting for or running in the hook executor",
+            lambda: self.model_metrics.hooks_queued,
+        )
+        self.registry.gauge(
+            "pyworker_max_throughput",
+            "Workload per second measured by the benchmark",
+            lambda: self.model_metrics.max_throughput,
+        )
+        self.registry.gauge(
+            "pyworker_model_loaded",
+            "1 if the model has finished loading",
+            lambda: float(self.system_metrics.model_is_loaded),
+        )
+        self.registry.gauge(
+            "pyworker_load_progress",
+            "Fraction of the model download that is done, as parsed from the model's log",
+            lambda: self.load_tracker.progress or 0.0,
+        )
+        self.registry.gauge(
+            "pyworker_load_throughput_bytes",
+            "Bytes per second the model is downloaded at, as parsed from the model's log",
+            lambda: self.load_tracker.throughput() or 0.0,
+        )
+        self.registry.gauge(
+            "pyworker_cur_load",
+            "Smoothed workload per second received, as reported to the autoscaler",
+            lambda: self.cur_load,
+        )
+        self.registry.gauge(
+            "pyworker_cur_perf",
+            "Smoothed workload per second of requests, as reported to the autoscaler",
+            lambda: self.cur_perf,
+        )
+        self.registry.gauge(
+            "pyworker_cur_perf_raw",
+            "Workload per second of the last request",
+            lambda: self.model_metrics.cur_perf,
+        )
+        for i, window in enumerate(self.load.windows):
+            self.registry.gauge(
+                f"pyworker_load_{format_window(window)}",
+                f"Workload per second received over the last {format_window(window)}",
+                lambda i=i: self.load.window_sums[i].rate(time.monotonic()),
+            )
+            self.registry.gauge(
+                f"pyworker_perf_{format_window(window)}",
+                f"Workload per second of requests over the last {format_window(window)}",
+                lambda window=window: self.window_perf(window),
+            )
+
+        self.registry.gauge(
+            "pyworker_max_capacity",
+            "Workload per second this worker can serve at its current request mix",
+            lambda: self.max_capacity,
+        )
+        self.registry.gauge(
+            "pyworker_estimated_wait_seconds",
+            "Estimated time a new request would wait to be served",
+            lambda: self.estimated_wait,
+        )
+        for i, horizon in enumerate(self.forecaster.horizons):
+            self.registry.gauge(
+                f"pyworker_load_forecast_{format_window(horizon)}",
+                f"Workload per second forecast to be received in {format_window(horizon)}",
+                lambda i=i: float(self.forecaster.forecast()[i]),
+            )
+
+    @property
+    def cur_load(self) -> float:
+        return self.load.rate()
+
+    @property
+    def cur_perf(self) -> float:
+        busy = self.busy.rate()
+        if busy <= 0:
+            return self.model_metrics.cur_perf
+        return self.served.rate() / busy
+
+    @property
+    def mean_request_workload(self) -> float:
+        """mean workload of recent requests, or of the requests in flight if none finished recently"""
+        now = time.monotonic()
+        workloads = [
+            workload
+            for end, _, workload in self.recent_requests
+            if end > now - LATENCY_WINDOW
+        ]
+        if workloads:
+            return sum(workloads) / len(workloads)
+        working = len(self.model_metrics.requests_working)
+        return self.model_metrics.workload_pending / working if working else 0.0
+
+    @property
+    def max_capacity(self) -> float:
+        """workload per second this worker can serve, at the throughput measured for requests like recent ones"""
+        return self.model_metrics.expected_throughput(self.mean_request_workload)
+
+    @property
+    def cur_capacity(self) -> float:
+        """workload per second this worker can serve on top of its current load"""
+        return max(self.max_capacity - self.cur_load, 0.0)
+
+    @property
+    def estimated_wait(self) -> float:
+        """
+        seconds before a new request would start being served. Requests are served first in first out, so a
+        new request waits for the pending workload to be served, unless it's sent to the model API right
+        away because fewer than max_concurrency requests are in flight. Without a concurrency limit, it's sent
+        right away but shares the model with the pending workload, and is delayed by as much
+        """
+        working = len(self.model_metrics.requests_working)
+        if self.max_concurrency is not None and working < self.max_concurrency:
+            return 0.0
+        max_capacity = self.max_capacity
+        if max_capacity <= 0:
+            return 0.0
+        return self.model_metrics.workload_pending / max_capacity
+
+    @property
+    def headroom(self) -> float:
+        """workload that could be added and be served within HEADROOM_HORIZON seconds"""
+        return max(
+            self.max_capacity * HEADROOM_HORIZON - self.model_metrics.workload_pending,
+            0.0,
+        )
+
+    def load_forecast(self) -> Tuple[Dict[str, float], Dict[str, float]]:
+        """forecast workload per second and its estimated error, keyed by horizon, i.e. "5m" """
+        self.forecaster.advance(time.monotonic())
+        horizons = [format_window(horizon) for horizon in self.forecaster.horizons]
+        return (
+            dict(zip(horizons, self.forecaster.forecast().tolist())),
+            dict(zip(horizons, self.forecaster.error().tolist())),
+        )
+
+    def latency_percentiles(self, *percentiles: float) -> List[float]:
+        """percentiles of the latency of the requests that finished in the last LATENCY_WINDOW seconds"""
+        now = time.monotonic()
+        latencies = [
+            latency
+            for end, latency, _ in self.recent_requests
+            if end > now - LATENCY_WINDOW
+        ]
+        if not latencies:
+            return [0.0 for _ in percentiles]
+        return [float(p) for p in numpy.percentile(latencies, percentiles)]
+
+    def window_perf(self, window: float) -> float:
+        busy = self.busy.window_rates()[window]
+        return self.served.window_rates()[window] / busy if busy > 0 else 0.0
 
     def _request_start(self, workload: float, reqnum: int) -> None:
         """
         this function is called prior to forwarding a request to a model API.
         """
         log.debug("request start")
+        self.workload_total.inc(workload, "received")
+        now = time.monotonic()
+        self.load.add(workload, now)
+        self.load_added_at[reqnum] = now
+        self.forecaster.add(workload, now)
         self.model_metrics.workload_pending += workload
         self.model_metrics.workload_received += workload
-        self.model_metrics.requests_recieved.add(reqnum)
+        # reqnums are unique, signatures of requests with a reqnum that was already seen are rejected
+        self.model_metrics.requests_recieved += 1
+        self.model_metrics.requests_recieved_total += 1
         self.model_metrics.requests_working.add(reqnum)
+        self.update_pending = True
+        self.__check_flush()
 
     def _request_end(
-        self, workload: float, req_response_time: float, reqnum: int
+        self,
+        workload: float,
+        req_response_time: float,
+        reqnum: int,
+        actual_workload: Optional[float] = None,
+        stream_stats: Optional[StreamStats] = None,
     ) -> None:
         """
         this function is called after a response from model API is received.
+        `workload` is the estimate the request was started with, `actual_workload` is the workload
+        calculated from the usage reported by the model API, if there is one.
+        `stream_stats` are the token timings of a streamed response
         """
-        self.model_metrics.workload_served += workload
+        served = workload if actual_workload is None else actual_workload
+        self.workload_total.inc(served, "served")
+        self.model_metrics.workload_served += served
         self.model_metrics.workload_pending -= workload
         self.model_metrics.requests_working.discard(reqnum)
-        self.model_metrics.cur_perf = workload / req_response_time
+        self.load_added_at.pop(reqnum, None)
+        self.model_metrics.cur_perf = served / req_response_time
+        self.served.add(served)
+        self.busy.add(req_response_time)
+        self.recent_requests.append((time.monotonic(), req_response_time, served))
+        if actual_workload is not None:
+            self.model_metrics.workload_estimated += workload
+            self.model_metrics.workload_actual += actual_workload
+        if stream_stats is not None:
+            self.__record_stream(stream_stats)
         self.update_pending = True
+        self.__check_flush()
 
     def _request_errored(self, workload: float, reqnum: int) -> None:
         """
         this function is called if model API returns an error
         """
+        self.workload_total.inc(workload, "errored")
         self.model_metrics.workload_pending -= workload
         self.model_metrics.workload_errored += workload
         self.model_metrics.requests_working.discard(reqnum)
+        self.load_added_at.pop(reqnum, None)
+        self.update_pending = True
+        self.__check_flush()
 
     def _request_canceled(self, workload: float, reqnum: int) -> None:
         """
-        this function is called if client drops connection before model API has responded
+        this function is called if client drops connection before the response is sent
         """
+        if reqnum not in self.model_metrics.requests_working:
+            # already counted, i.e. the disconnection was noticed both mid-stream and by Backend
+            return
+        self.workload_total.inc(workload, "cancelled")
+        added_at = self.load_added_at.pop(reqnum, None)
+        if added_at is not None:
+            self.load.remove(workload, added_at)
         self.model_metrics.workload_pending -= workload
         self.model_metrics.workload_cancelled += workload
         self.model_metrics.requests_working.discard(reqnum)
+        self.update_pending = True
+        self.__check_flush()
+
+    def _hook_queued(self) -> None:
+        """
+        this function is called when a CPU bound hook is submitted to the hook executor
+        """
+        self.model_metrics.hooks_queued += 1
+
+    def _hook_done(self, wait_time: float, run_time: float) -> None:
+        """
+        this function is called when a CPU bound hook has finished running in the hook executor
+        """
+        self.hook_wait.observe(wait_time)
+        self.model_metrics.hooks_queued -= 1
+        self.model_metrics.hooks_run += 1
+        self.model_metrics.hook_wait_time += wait_time
+        self.model_metrics.hook_run_time += run_time
+
+    def _response_sent(
+        self, endpoint: str, status: int, latency: float, response_bytes: int
+    ) -> None:
+        """
+        this function is called when PyWorker returns a response to a client, whatever its status
+        """
+        self.request_latency.observe(latency, endpoint)
+        self.response_bytes.observe(response_bytes, endpoint)
+        self.requests_total.inc(1, endpoint, str(status))
 
     async def _send_metrics_loop(self) -> Awaitable[NoReturn]:
         while True:
-            await sleep(METRICS_UPDATE_INTERVAL)
             elapsed = time.time() - self.last_metric_update
-            if self.system_metrics.model_is_loaded is False and elapsed >= 10:
+            try:
+                await asyncio.wait_for(
+                    self.flush_event.wait(),
+                    timeout=self.report_policy.next_report_in(
+                        elapsed, self.update_pending
+                    ),
+                )
+                # coalesce the changes that follow a significant one into the same report
+                await asyncio.sleep(
+                    max(
+                        self.last_metric_update
+                        + self.report_policy.min_interval
+                        - time.time(),
+                        0.0,
+                    )
+                )
+                reason = "significant change"
+            except asyncio.TimeoutError:
+                if not self.report_policy.is_due(
+                    time.time() - self.last_metric_update, self.update_pending
+                ):
+                    continue
+                reason = "interval"
+            self.flush_event.clear()
+            elapsed = time.time() - self.last_metric_update
+            if self.system_metrics.model_is_loaded is False:
                 log.debug(f"sending loading model metrics after {int(elapsed)}s wait")
-                self.__send_metrics_and_reset(elapsed)
-            elif self.update_pending or elapsed > 10:
-                log.debug(f"sending loaded model metrics after {int(elapsed)}s wait")
-                self.__send_metrics_and_reset(elapsed)
+            else:
+                log.debug(
+                    f"sending loaded model metrics after {elapsed:.2f}s wait, reason: {reason}"
+                )
+            await self.__send_metrics_and_reset(elapsed)
 
-    def _model_loaded(self, max_throughput: float) -> None:
+    def _model_loaded(
+        self,
+        max_throughput: float,
+        benchmark_workload: Optional[float] = None,
+        warmup_results: Optional[List[WarmupResult]] = None,
+    ) -> None:
         self.system_metrics.model_loading_time = (
             time.time() - self.system_metrics.model_loading_start
         )
         self.system_metrics.model_is_loaded = True
+        self.flush_event.set()
         self.model_metrics.max_throughput = max_throughput
+        curve = {}
+        if benchmark_workload is not None:
+            curve[benchmark_workload] = max_throughput
+        for result in warmup_results or []:
+            # the benchmark point is measured over several runs, so it takes precedence
+            curve.setdefault(result.workload, result.throughput)
+        self.model_metrics.throughput_curve = sorted(curve.items())
+        log.debug(f"throughput curve: {self.model_metrics.throughput_curve}")
+
+    def _load_progress(self, progress: LoadProgress) -> None:
+        first = self.load_tracker.progress is None
+        self.load_tracker.update(progress)
+        if first:
+            # lets the autoscaler know how long loading will take without waiting for the next report
+            self.flush_event.set()
 
     def _model_errored(self, error_msg: str) -> None:
         self.model_metrics.set_errored(error_msg)
         self.system_metrics.model_is_loaded = True
+        self.flush_event.set()
+
+    def _draining(self) -> None:
+        self.draining = True
+        self.flush_event.set()
+
+    async def _send_final_metrics(self) -> None:
+        """reports the metrics since the last report, once the worker has stopped serving requests"""
+        await self.__send_metrics_and_reset(time.time() - self.last_metric_update)
 
     #######################################Private#######################################
 
-    def __send_metrics_and_reset(self, elapsed):
+    def __check_flush(self) -> None:
+        # changes after the coalesce interval has passed are overdue, the send loop is waiting for max_interval
+        if self.report_policy.is_significant(
+            self.model_metrics.workload_pending,
+            len(self.model_metrics.requests_working),
+            self.model_metrics.max_throughput,
+        ) or self.report_policy.is_due(
+            time.time() - self.last_metric_update, self.update_pending
+        ):
+            self.flush_event.set()
+
+    def __record_stream(self, stream_stats: StreamStats) -> None:
+        first_token, last_token = stream_stats.first_token, stream_stats.last_token
+        if first_token is None or last_token is None:
+            # response wasn't streamed
+            return
+        self.model_metrics.streams += 1
+        self.model_metrics.stream_tokens += stream_stats.tokens
+        self.model_metrics.stream_time += last_token - stream_stats.request_start
+        self.model_metrics.time_to_first_token_sum += (
+            first_token - stream_stats.request_start
+        )
+        self.model_metrics.inter_token_latency_sum += last_token - first_token
+
+    async def __send_metrics_and_reset(self, elapsed):
 
         def compute_autoscaler_data() -> AutoScalaerData:
+            latency_p50, latency_p95 = self.latency_percentiles(50, 95)
+            load_forecast, load_forecast_error = self.load_forecast()
+            loading = self.system_metrics.model_is_loaded is False
             return AutoScalaerData(
                 id=self.id,
                 loadtime=(self.system_metrics.model_loading_time or 0.0),
-                cur_load=(self.model_metrics.workload_processing / elapsed),
+                cur_load=self.cur_load,
                 max_perf=self.model_metrics.max_throughput,
-                cur_perf=self.model_metrics.cur_perf,
+                cur_perf=self.cur_perf,
                 error_msg=self.model_metrics.error_msg or "",
                 num_requests_working=len(self.model_metrics.requests_working),
-                num_requests_recieved=len(self.model_metrics.requests_recieved),
+                num_requests_recieved=self.model_metrics.requests_recieved_total,
                 additional_disk_usage=self.system_metrics.additional_disk_usage,
-                cur_capacity=0,
-                max_capacity=0,
+                workload_estimation_error=self.model_metrics.workload_estimation_error,
+                time_to_first_token=self.model_metrics.time_to_first_token,
+                inter_token_latency=self.model_metrics.inter_token_latency,
+                tokens_per_second=self.model_metrics.tokens_per_second,
+                loop_lag=self.loop_monitor.max_lag,
+                cur_capacity=0.0 if self.draining else self.cur_capacity,
+                max_capacity=self.max_capacity,
+                estimated_wait=self.estimated_wait,
+                headroom=0.0 if self.draining else self.headroom,
+                latency_p50=latency_p50,
+                latency_p95=latency_p95,
+                load_forecast=load_forecast,
+                load_forecast_error=load_forecast_error,
+                draining=self.draining,
+                load_progress=self.load_tracker.progress if loading else None,
+                load_throughput=self.load_tracker.throughput() if loading else None,
+                load_eta=self.load_tracker.eta() if loading else None,
                 url=self.url,
             )
 
-        def send_data(report_addr: str) -> None:
-            data = compute_autoscaler_data()
+        def send_data(data: AutoScalaerData, report_addr: str) -> None:
             full_path = urljoin(report_addr, "/worker_status/")
             log.debug(
                 "\n".join(
@@ -144,10 +640,34 @@ class Metrics:
         ###########
 
         self.system_metrics.update_disk_usage()
+        log.debug(f"requests received: {self.model_metrics.requests_recieved}")
+        log.debug(
+            f"raw cur_load: {self.model_metrics.workload_processing / elapsed}, "
+            f"raw cur_perf: {self.model_metrics.cur_perf}, "
+            f"load over windows: {self.load.window_rates()}"
+        )
+        log.debug(
+            f"hooks run: {self.model_metrics.hooks_run}, queued: {self.model_metrics.hooks_queued}, "
+            f"wait time: {self.model_metrics.hook_wait_time}, run time: {self.model_metrics.hook_run_time}"
+        )
 
-        for report_addr in self.report_addr:
-            send_data(report_addr)
+        data = compute_autoscaler_data()
+        self.report_policy.reported(
+            self.model_metrics.workload_pending,
+            len(self.model_metrics.requests_working),
+        )
         self.update_pending = False
+        self.loop_monitor.max_lag = 0.0
         self.model_metrics.reset()
         self.system_metrics.reset()
         self.last_metric_update = time.time()
+        if self.reporting is False:
+            log.debug("not sending metrics, another process reports for this worker")
+            return
+        # data is computed and metrics are reset on the event loop, only the (retried) POSTs run in threads
+        await asyncio.gather(
+            *[
+                asyncio.to_thread(send_data, data, report_addr)
+                for report_addr in self.report_addr
+            ]
+        )
@@ -0,0 +1,321 @@
+"""
+Serves a worker from several processes, so that JSON handling, signature checks and response encoding aren't
+capped at one core. With $PYWORKER_PROCESSES greater than 1, the process start_server is called in becomes a
+coordinator: it tails the model's logs, runs the benchmark and sends reports to the autoscaler, exactly once,
+and forks the serving processes, which all listen on the worker port with SO_REUSEPORT.
+
+Serving processes send the request events of their Metrics (see FORWARDED_EVENTS), the highest lag of their
+event loop and the last progress of the model (see lib.watchdog) to the coordinator through a queue, and the
+coordinator applies them to its own Metrics and Watchdog, so the autoscaler sees a single worker with the
+aggregate load. Trace and capture records are written by the coordinator, so there is still a single file of
+each. For workers that don't allow parallel requests, serving
+processes share one semaphore, and they all share the reqnums of the requests they last verified, so that a
+signed request can't be replayed to another process.
+
+/ping and /metrics are served by whichever process accepts the connection, and only cover its own requests.
+
+When the coordinator is told to stop (see lib.lifecycle), it sends SIGTERM to the serving processes, which stop
+listening and finish their requests in flight, and waits for them to exit before it sends its final report.
+"""
+
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from asyncio import (
+    Event,
+    wait,
+    gather,
+    sleep,
+    create_task,
+    get_running_loop,
+    CancelledError,
+    FIRST_COMPLETED,
+)
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, NoReturn, Tuple
+
+from aiohttp import web
+
+from lib.backend import Backend, MSG_HISTORY_LEN
+from lib.metrics import Metrics
+from lib.lifecycle import Lifecycle, DRAIN_TIMEOUT
+from lib.server_profile import ServerProfile
+
+PYWORKER_PROCESSES = int(os.environ.get("PYWORKER_PROCESSES", "1"))
+# Metrics methods that record requests and hooks, called in serving processes and forwarded to the coordinator
+FORWARDED_EVENTS = [
+    "_request_start",
+    "_request_end",
+    "_request_errored",
+    "_request_canceled",
+    "_hook_queued",
+    "_hook_done",
+    "_response_sent",
+]
+# how often a serving process retries the semaphore shared by every process while it waits for it
+SEMAPHORE_POLL_INTERVAL = 0.01
+# how often serving processes send their loop lag to the coordinator and check that it's still running
+COORDINATOR_POLL_INTERVAL = 1.0
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class QueueWriter:
+    """stands in for the JsonlWriters of serving processes, the coordinator writes their records"""
+
+    queue: Any
+    kind: str
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.queue.put((self.kind, record))
+
+
+@dataclass
+class ProcessSemaphore:
+    """
+    stands in for Backend.sem in serving processes of workers that don't allow parallel requests, so that only
+    one request is sent to the model API at a time across every process
+    """
+
+    semaphore: Any
+
+    async def acquire(self) -> bool:
+        # polled rather than waited for in a thread, so that a cancelled request never ends up holding it
+        while not self.semaphore.acquire(block=False):
+            await sleep(SEMAPHORE_POLL_INTERVAL)
+        return True
+
+    def release(self) -> None:
+        self.semaphore.release()
+
+
+@dataclass
+class SharedMessageHistory:
+    """
+    stands in for Backend.msg_history in serving processes. Holds the reqnums of the last MSG_HISTORY_LEN requests
+    verified by any process, and the highest one, as the autoscaler never signs two messages with the same
+    reqnum. Two processes verifying the same message at the same moment can still both accept it
+    """
+
+    reqnums: Any
+    next_index: Any
+    max_reqnum: Any
+    lock: Any
+
+    @classmethod
+    def create(cls, context: Any) -> "SharedMessageHistory":
+        return cls(
+            reqnums=context.Array("q", [-1] * MSG_HISTORY_LEN, lock=False),
+            next_index=context.Value("i", 0, lock=False),
+            max_reqnum=context.Value("q", -1, lock=False),
+            lock=context.Lock(),
+        )
+
+    def __contains__(self, message: Dict[str, Any]) -> bool:
+        reqnum = message["reqnum"]
+        with self.lock:
+            # too old for any process to accept it
+            if reqnum < self.max_reqnum.value - MSG_HISTORY_LEN:
+                return True
+            return reqnum in self.reqnums[:]
+
+    def append(self, message: Dict[str, Any]) -> None:
+        with self.lock:
+            self.reqnums[self.next_index.value] = message["reqnum"]
+            self.next_index.value = (self.next_index.value + 1) % MSG_HISTORY_LEN
+            self.max_reqnum.value = max(self.max_reqnum.value, message["reqnum"])
+
+
+def forward_events(metrics: Metrics, queue: Any) -> None:
+    """makes every request event recorded by `metrics` also be sent to the coordinator"""
+
+    def forwarding(name: str) -> Callable[..., None]:
+        record = getattr(metrics, name)
+
+        def forward(*args: Any, **kwargs: Any) -> None:
+            record(*args, **kwargs)
+            queue.put(("metrics", (name, args, kwargs)))
+
+        return forward
+
+    for name in FORWARDED_EVENTS:
+        setattr(metrics, name, forwarding(name))
+
+
+def serve_processes(
+    backend: Backend,
+    make_app: Callable[[], web.Application],
+    processes: int,
+    profile: ServerProfile,
+    **site_kwargs: Any,
+) -> None:
+    """forks `processes` serving processes and coordinates them until the coordinator is stopped"""
+    context = multiprocessing.get_context("fork")
+    events = context.Queue()
+    semaphore = (
+        None
+        if backend.allow_parallel_requests
+        else ProcessSemaphore(context.Semaphore(1))
+    )
+    history = SharedMessageHistory.create(context)
+    # forked before the coordinator starts its event loop, sessions and threads, serving processes start their own
+    children = [
+        context.Process(
+            target=serve_process,
+            args=(
+                i,
+                backend,
+                make_app,
+                profile,
+                events,
+                semaphore,
+                history,
+                site_kwargs,
+            ),
+            name=f"pyworker-{i}",
+        )
+        for i in range(processes)
+    ]
+    for child in children:
+        child.start()
+    log.debug(f"started {processes} serving processes")
+    try:
+        profile.run(coordinate(backend, events, children))
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.join(timeout=5)
+
+
+async def coordinate(
+    backend: Backend, events: Any, children: List[multiprocessing.Process]
+) -> None:
+    loop = get_running_loop()
+
+    def apply(event: Tuple[str, Any]) -> None:
+        """events are (kind, data) tuples sent by serving processes"""
+        kind, data = event
+        match kind:
+            case "metrics":
+                name, args, kwargs = data
+                getattr(backend.metrics, name)(*args, **kwargs)
+            case "loop_lag":
+                monitor = backend.metrics.loop_monitor
+                monitor.max_lag = max(monitor.max_lag, data)
+            case "progress":
+                backend.watchdog.progress(at=data)
+            case "trace" if backend.tracer.writer:
+                backend.tracer.writer.write(data)
+            case "capture" if backend.capture:
+                backend.capture.writer.write(data)
+
+    def receive_events() -> NoReturn:
+        while True:
+            loop.call_soon_threadsafe(apply, events.get())
+
+    async def watch_children() -> Awaitable[NoReturn]:
+        exited = set()
+        while True:
+            await sleep(COORDINATOR_POLL_INTERVAL)
+            for child in children:
+                if child.exitcode is not None and child.name not in exited:
+                    exited.add(child.name)
+                    log.debug(f"{child.name} exited with {child.exitcode}")
+                    if not lifecycle.stopping.is_set():
+                        backend.backend_errored(
+                            f"serving process {child.name} exited with {child.exitcode}"
+                        )
+
+    async def stop_children() -> None:
+        for child in children:
+            child.terminate()
+        # serving processes give their requests in flight up to DRAIN_TIMEOUT to finish
+        deadline = time.monotonic() + DRAIN_TIMEOUT + COORDINATOR_POLL_INTERVAL
+        while (
+            any(child.is_alive() for child in children) and time.monotonic() < deadline
+        ):
+            await sleep(COORDINATOR_POLL_INTERVAL)
+
+    ###########
+
+    lifecycle = Lifecycle(backend)
+    lifecycle.install()
+    threading.Thread(target=receive_events, name="pyworker-events", daemon=True).start()
+    tracking = gather(
+        backend._start_tracking(), watch_children(), lifecycle.take_over()
+    )
+    stopped = create_task(lifecycle.wait())
+    await wait([tracking, stopped], return_when=FIRST_COMPLETED)
+    if tracking.done():
+        stopped.cancel()
+        tracking.result()
+    await stop_children()
+    # leaves time for the last events of the serving processes to be applied
+    await sleep(COORDINATOR_POLL_INTERVAL)
+    tracking.cancel()
+    with suppress(CancelledError):
+        await tracking
+    await backend.metrics._send_final_metrics()
+    log.debug("coordinator stopped")
+
+
+def serve_process(
+    index: int,
+    backend: Backend,
+    make_app: Callable[[], web.Application],
+    profile: ServerProfile,
+    events: Any,
+    semaphore: Any,
+    history: SharedMessageHistory,
+    site_kwargs: Dict[str, Any],
+) -> None:
+    coordinator_pid = os.getppid()
+    # handoffs are the coordinator's, see lib.lifecycle
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    forward_events(backend.metrics, events)
+    # background writer threads don't survive the fork, the coordinator writes the records
+    if backend.tracer.writer:
+        backend.tracer.writer = QueueWriter(events, "trace")
+    if backend.capture:
+        backend.capture.writer = QueueWriter(events, "capture")
+    if semaphore is not None:
+        backend.sem = semaphore
+    backend.msg_history = history
+
+    async def report_to_coordinator() -> None:
+        monitor = backend.metrics.loop_monitor
+        while os.getppid() == coordinator_pid:
+            await sleep(COORDINATOR_POLL_INTERVAL)
+            events.put(("loop_lag", monitor.max_lag))
+            monitor.max_lag = 0.0
+            events.put(("progress", backend.watchdog.last_progress_at()))
+        log.debug(f"coordinator exited, stopping serving process {index}")
+
+    async def main():
+        stopping = Event()
+        get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        runner = profile.make_runner(make_app(), shutdown_timeout=DRAIN_TIMEOUT)
+        await runner.setup()
+        site = profile.make_site(runner, reuse_port=True, **site_kwargs)
+        await site.start()
+        log.debug(f"serving process {index} started, pid: {os.getpid()}")
+        monitor = create_task(backend.metrics.loop_monitor.run())
+        reporting = create_task(report_to_coordinator())
+        await wait(
+            [reporting, create_task(stopping.wait())], return_when=FIRST_COMPLETED
+        )
+        backend.draining = True
+        # stops listening, then waits for the requests in flight for up to DRAIN_TIMEOUT
+        await runner.cleanup()
+        reporting.cancel()
+        monitor.cancel()
+        log.debug(f"serving process {index} stopped")
+
+    profile.run(main())
@@ -0,0 +1,140 @@
+"""
+Debug routes for diagnosing a live PyWorker without restarting it. They are only added by
+`lib.server.start_server` if $PYWORKER_DEBUG_TOKEN is set, and must be called with an
+`Authorization: Bearer $PYWORKER_DEBUG_TOKEN` header:
+
+GET /debug/profile?seconds=10&interval=0.005
+    samples the stacks of every thread for `seconds` and returns them in collapsed stack format, which can
+    be turned into a flamegraph with flamegraph.pl or speedscope
+POST /debug/heap/snapshot
+    starts tracemalloc and takes the snapshot that /debug/heap/diff compares against
+GET /debug/heap/diff?top=25
+    returns the top N allocation sites that grew since the snapshot, and stops tracemalloc
+"""
+
+import os
+import sys
+import hmac
+import time
+import asyncio
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass
+from typing import List, Optional
+
+from aiohttp import web
+
+DEBUG_TOKEN = os.environ.get("PYWORKER_DEBUG_TOKEN")
+MAX_PROFILE_SECONDS = 60.0
+DEFAULT_PROFILE_INTERVAL = 0.005
+MIN_PROFILE_INTERVAL = 0.001
+TRACEMALLOC_FRAMES = 10
+
+log = logging.getLogger(__file__)
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """
+    samples the stack of every thread but the calling one, returns the number of times each stack was seen,
+    keyed by its collapsed form: thread;outermost frame;...;innermost frame
+    """
+    sampler_id = threading.get_ident()
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            frames.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+@dataclass
+class Profiler:
+    token: str
+    heap_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get("/debug/profile", self.__authenticated(self.handle_profile)),
+            web.post(
+                "/debug/heap/snapshot", self.__authenticated(self.handle_heap_snapshot)
+            ),
+            web.get("/debug/heap/diff", self.__authenticated(self.handle_heap_diff)),
+        ]
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        try:
+            seconds = min(float(request.query.get("seconds", 10)), MAX_PROFILE_SECONDS)
+            interval = max(
+                float(request.query.get("interval", DEFAULT_PROFILE_INTERVAL)),
+                MIN_PROFILE_INTERVAL,
+            )
+        except ValueError:
+            return web.json_response(dict(error="invalid parameters"), status=422)
+        log.debug(f"profiling for {seconds}s, sampling every {interval}s")
+        # sampling runs in a thread so that the event loop keeps running, and gets profiled
+        stacks = await asyncio.to_thread(sample_stacks, seconds, interval)
+        return web.Response(
+            text="".join(f"{stack} {count}\n" for stack, count in stacks.items())
+        )
+
+    async def handle_heap_snapshot(self, _: web.Request) -> web.Response:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.heap_snapshot = tracemalloc.take_snapshot()
+        return web.json_response(dict(status="tracing"))
+
+    async def handle_heap_diff(self, request: web.Request) -> web.Response:
+        if self.heap_snapshot is None or not tracemalloc.is_tracing():
+            return web.json_response(
+                dict(error="take a snapshot with POST /debug/heap/snapshot first"),
+                status=409,
+            )
+        try:
+            top = int(request.query.get("top", 25))
+        except ValueError:
+            return web.json_response(dict(error="invalid parameters"), status=422)
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.heap_snapshot, "lineno")
+        traced, peak = tracemalloc.get_traced_memory()
+        # tracing slows down every allocation, so it only runs between a snapshot and a diff
+        tracemalloc.stop()
+        self.heap_snapshot = None
+        return web.json_response(
+            dict(
+                traced_bytes=traced,
+                peak_bytes=peak,
+                top=[
+                    dict(
+                        location=str(stat.traceback),
+                        size_diff=stat.size_diff,
+                        size=stat.size,
+                        count_diff=stat.count_diff,
+                        count=stat.count,
+                    )
+                    for stat in stats[:top]
+                ],
+            )
+        )
+
+    #######################################Private#######################################
+
+    def __authenticated(self, handler):
+        async def handler_fn(request: web.Request) -> web.StreamResponse:
+            auth = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(auth.encode(), f"Bearer {self.token}".encode()):
+                return web.Response(status=401)
+            return await handler(request)
+
+        return handler_fn
@@ -0,0 +1,168 @@
+"""
+A minimal metrics registry that is rendered in the Prometheus text format by the `/metrics` route every
+PyWorker serves. Unlike ModelMetrics, which is reset every time it's sent to the autoscaler, the values here
+are never reset. Recording a value is a dict lookup and a bisect, so it costs around a microsecond.
+"""
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple, Union
+
+# seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+WORKLOAD_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+# 1KB to 64MB
+BYTES_BUCKETS = tuple(float(2**exp) for exp in range(10, 27, 2))
+
+Labels = Tuple[str, ...]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names: Labels, label_values: Labels, **extra: str) -> str:
+    pairs = list(zip(label_names, label_values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs)
+        + "}"
+    )
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+@dataclass
+class Counter:
+    """monotonic counter, never reset"""
+
+    name: str
+    help: str
+    label_names: Labels = ()
+    values: Dict[Labels, float] = field(default_factory=dict)
+
+    def inc(self, amount: float = 1.0, *label_values: str) -> None:
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return lines
+
+
+@dataclass
+class Gauge:
+    """gauge whose value is read from `fn` when rendered"""
+
+    name: str
+    help: str
+    fn: Callable[[], float]
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {format_value(self.fn())}",
+        ]
+
+
+@dataclass
+class Histogram:
+    """histogram with fixed buckets"""
+
+    name: str
+    help: str
+    buckets: Tuple[float, ...]
+    label_names: Labels = ()
+    # per label values: count of observations in each bucket (not cumulative), the last one being +Inf
+    counts: Dict[Labels, List[int]] = field(default_factory=dict)
+    sums: Dict[Labels, float] = field(default_factory=dict)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts = self.counts.get(label_values)
+        if counts is None:
+            counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+            self.sums[label_values] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = format_labels(
+                    self.label_names, label_values, le=format_value(bound)
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(
+                f"{self.name}_sum{labels} {format_value(self.sums[label_values])}"
+            )
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+@dataclass
+class Registry:
+    metrics: Dict[str, Metric] = field(default_factory=dict)
+
+    def counter(self, name: str, help: str, label_names: Labels = ()) -> Counter:
+        return self.__register(Counter(name=name, help=help, label_names=label_names))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float]) -> Gauge:
+        return self.__register(Gauge(name=name, help=help, fn=fn))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: Tuple[float, ...],
+        label_names: Labels = (),
+    ) -> Histogram:
+        return self.__register(
+            Histogram(name=name, help=help, buckets=buckets, label_names=label_names)
+        )
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    #######################################Private#######################################
+
+    def __register(self, metric):
+        if metric.name in self.metrics:
+            raise Exception(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
@@ -0,0 +1,175 @@
+"""
+Replays requests captured with $CAPTURE_FILE (see lib.capture) against an endpoint group, with the same
+arrival times, and compares the latencies of the replay with the captured ones, i.e:
+
+python3 -m lib.replay capture.jsonl --payload workers.tgi.data_types:InputData -l -k "$API_KEY" -e "$ENDPOINT_GROUP_NAME"
+
+--speed 2 replays the trace twice as fast, --scale 2 sends every request twice (and 1.5 sends it once or twice,
+at random), so that the same request mix can be replayed at a higher load. Extra copies are sent at a random
+time before the next captured request, so that the arrival rate is scaled rather than every request becoming a
+burst. Only requests that succeeded when they were captured are replayed. Requests whose payload wasn't captured
+are sent with a payload made by the payload class' for_test(). Rotated capture files, capture.jsonl.1 and so on,
+are replayed too, oldest first.
+"""
+
+import os
+import json
+import asyncio
+import importlib
+from typing import Any, Dict, List, Optional, Type
+
+import numpy
+
+from lib.data_types import ApiPayload, JsonDataException
+from lib.test_utils import LoadTest, LATENCY_PERCENTILES, test_args
+
+
+def capture_files(path: str) -> List[str]:
+    """the capture file and its rotated backups, oldest first"""
+    backups = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        backups.append(f"{path}.{i}")
+        i += 1
+    return list(reversed(backups)) + [path]
+
+
+def read_capture(path: str) -> List[Dict[str, Any]]:
+    records = []
+    for file in capture_files(path):
+        with open(file) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["arrival"])
+    return records
+
+
+def import_payload_cls(name: str) -> Type[ApiPayload]:
+    """imports "module:Class" """
+    module, cls = name.split(":")
+    return getattr(importlib.import_module(module), cls)
+
+
+def schedule(
+    records: List[Dict[str, Any]], speed: float, scale: float, seed: Optional[int]
+) -> List[Dict[str, Any]]:
+    """
+    records that succeeded when they were captured, each with its time from the start of the replay in "offset",
+    sorted by offset
+    """
+    rng = numpy.random.default_rng(seed)
+    records = [record for record in records if record.get("status") == 200]
+    if not records:
+        return []
+    arrivals = numpy.array([record["arrival"] for record in records])
+    offsets = (arrivals - arrivals[0]) / speed
+    # extra copies are spread over the gap to the next request, the last one over the mean gap
+    gaps = numpy.diff(
+        offsets, append=offsets[-1] + (offsets[-1] / max(len(offsets) - 1, 1))
+    )
+    replayed = []
+    for record, offset, gap in zip(records, offsets, gaps):
+        copies = int(scale) + int(rng.random() < scale - int(scale))
+        for copy in range(copies):
+            jitter = rng.uniform(0.0, gap) if copy > 0 else 0.0
+            replayed.append(dict(record, offset=float(offset + jitter)))
+    replayed.sort(key=lambda record: record["offset"])
+    return replayed
+
+
+def make_payload(
+    payload_cls: Type[ApiPayload], record: Dict[str, Any]
+) -> Optional[ApiPayload]:
+    if "payload" not in record:
+        return None
+    try:
+        return payload_cls.from_json_msg(record["payload"])
+    except JsonDataException:
+        return None
+
+
+def compare_latencies(
+    records: List[Dict[str, Any]], load_test: LoadTest
+) -> Dict[str, Any]:
+    """percentiles of the captured and replayed latencies of successful requests"""
+    captured = numpy.array(
+        [record["latency"] for record in records if record.get("status") == 200]
+    )
+    replayed = load_test.worker_latency.percentiles(*LATENCY_PERCENTILES)
+    comparison = {}
+    for percentile, replayed_value in zip(LATENCY_PERCENTILES, replayed):
+        captured_value = (
+            float(numpy.percentile(captured, percentile)) if len(captured) else 0.0
+        )
+        comparison[f"p{percentile:g}"] = dict(
+            captured=captured_value,
+            replayed=replayed_value,
+            ratio=replayed_value / captured_value if captured_value > 0 else None,
+        )
+    return comparison
+
+
+def print_comparison(comparison: Dict[str, Any]) -> None:
+    print(f"{'latency':>8} {'captured':>10} {'replayed':>10} {'ratio':>8}")
+    for percentile, values in comparison.items():
+        ratio = f"{values['ratio']:.2f}" if values["ratio"] is not None else "-"
+        print(
+            f"{percentile:>8} {values['captured']:>10.3f} {values['replayed']:>10.3f} {ratio:>8}"
+        )
+
+
+if __name__ == "__main__":
+    test_args.description = "Replay captured requests against an endpoint group"
+    test_args.add_argument("capture", help="capture file, see lib.capture")
+    test_args.add_argument(
+        "--payload",
+        dest="payload_cls",
+        required=True,
+        help='payload class of the worker, i.e. "workers.tgi.data_types:InputData"',
+    )
+    test_args.add_argument(
+        "--speed", type=float, default=1.0, help="how much faster to replay"
+    )
+    test_args.add_argument(
+        "--scale", type=float, default=1.0, help="how many times to send each request"
+    )
+    test_args.add_argument(
+        "--connections", dest="max_connections", type=int, default=1000
+    )
+    test_args.add_argument("--timeout", type=float)
+    test_args.add_argument("--summary", dest="summary_file")
+    test_args.add_argument("--no-dashboard", dest="dashboard", action="store_false")
+    test_args.add_argument("--seed", type=int)
+    args = test_args.parse_args()
+    payload_cls = import_payload_cls(args.payload_cls)
+    records = read_capture(args.capture)
+    if not records:
+        raise SystemExit("capture is empty")
+    replayed = schedule(records, args.speed, args.scale, args.seed)
+    if not replayed:
+        raise SystemExit("no request in the capture succeeded")
+    load_test = LoadTest(
+        endpoint_group_name=args.endpoint_group_name,
+        api_key=args.api_key,
+        server_url=args.server_url,
+        worker_endpoint=records[0]["endpoint"],
+        payload_cls=payload_cls,
+        arrivals=numpy.array([record["offset"] for record in replayed]),
+        max_connections=args.max_connections,
+        timeout=args.timeout,
+        dashboard=args.dashboard,
+        payloads=[make_payload(payload_cls, record) for record in replayed],
+        endpoints=[record["endpoint"] for record in replayed],
+    )
+    summary = asyncio.run(load_test.run())
+    comparison = compare_latencies(records, load_test)
+    print_comparison(comparison)
+    if args.summary_file:
+        summary.update(
+            capture=args.capture,
+            speed=args.speed,
+            scale=args.scale,
+            latency_comparison=comparison,
+        )
+        with open(args.summary_file, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"summary written to {args.summary_file}")
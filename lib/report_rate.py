@@ -0,0 +1,124 @@
+"""
+Test of the rate at which metrics are reported to the autoscaler under steady load, which fails if a worker
+with a few requests in flight reports more often than MAX_REPORT_RATE, i.e:
+
+python3 -m lib.report_rate
+python3 -m lib.report_rate -c 1 2 3 4 10 --request-time 2 --hours 1
+
+Clients send requests back to back, with an exponential think time in between, so that the number of
+requests in flight goes up and down around the concurrency. ReportPolicy decides when to report as
+Metrics' send loop does, on simulated time, so an hour of load takes a fraction of a second.
+"""
+
+import heapq
+import argparse
+from typing import List, Optional, Tuple
+
+import numpy
+
+from lib.metrics import ReportPolicy
+
+# reports per second allowed at steady load, a report every coalesce interval is well under it
+MAX_REPORT_RATE = 1.0
+
+
+def simulate_reports(
+    policy: ReportPolicy,
+    concurrency: int,
+    request_time: float,
+    think_time: float,
+    max_throughput: float,
+    duration: float,
+    seed: int = 0,
+) -> List[float]:
+    """times of the reports sent over `duration` seconds of requests of workload 1"""
+    rng = numpy.random.default_rng(seed)
+    # (time, change in requests in flight)
+    events: List[Tuple[float, int]] = [
+        (rng.exponential(think_time), 1) for _ in range(concurrency)
+    ]
+    heapq.heapify(events)
+    reports: List[float] = []
+    requests_working = 0
+    update_pending = False
+    last_report = 0.0
+    flush_at: Optional[float] = None
+    wake_at = policy.next_report_in(0.0, update_pending)
+    while True:
+        event_time = events[0][0]
+        report_time = min(wake_at, flush_at if flush_at is not None else wake_at)
+        if report_time > duration and event_time > duration:
+            return reports
+        if report_time <= event_time:
+            if flush_at is None and not policy.is_due(
+                report_time - last_report, update_pending
+            ):
+                # at least the event loop's timer resolution, so that rounding can't stall the clock
+                wake_at = report_time + max(
+                    policy.next_report_in(report_time - last_report, update_pending),
+                    0.001,
+                )
+                continue
+            reports.append(report_time)
+            policy.reported(float(requests_working), requests_working)
+            update_pending = False
+            last_report = report_time
+            flush_at = None
+            wake_at = last_report + policy.next_report_in(0.0, update_pending)
+            continue
+        _, change = heapq.heappop(events)
+        requests_working += change
+        if change > 0:
+            heapq.heappush(events, (event_time + rng.exponential(request_time), -1))
+        else:
+            heapq.heappush(events, (event_time + rng.exponential(think_time), 1))
+        update_pending = True
+        if flush_at is None and (
+            policy.is_significant(
+                float(requests_working), requests_working, max_throughput
+            )
+            or policy.is_due(event_time - last_report, update_pending)
+        ):
+            # the send loop waits for min_interval since the last report
+            flush_at = max(event_time, last_report + policy.min_interval)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="PyWorker report rate test")
+    arg_parser.add_argument(
+        "-c",
+        dest="concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3, 4, 10],
+        help="requests in flight",
+    )
+    arg_parser.add_argument("--request-time", type=float, default=2.0)
+    arg_parser.add_argument("--think-time", type=float, default=0.2)
+    arg_parser.add_argument(
+        "--max-throughput",
+        type=float,
+        default=8.0,
+        help="requests per second the worker can serve",
+    )
+    arg_parser.add_argument("--hours", type=float, default=1.0)
+    args = arg_parser.parse_args()
+    failed = False
+    for concurrency in args.concurrency:
+        reports = simulate_reports(
+            ReportPolicy(),
+            concurrency,
+            args.request_time,
+            args.think_time,
+            args.max_throughput,
+            args.hours * 3600,
+        )
+        rate = len(reports) / (args.hours * 3600)
+        passed = rate <= MAX_REPORT_RATE
+        failed = failed or not passed
+        print(
+            f"{concurrency} in flight: {rate:.2f} reports/s {'ok' if passed else 'FAILED'}"
+        )
+    if failed:
+        raise SystemExit(f"FAILED: more than {MAX_REPORT_RATE} reports/s")
+    print("PASSED")
@@ -1,17 +1,28 @@
 import os
 import logging
-from typing import List
+from typing import List, Optional
 import ssl
-from asyncio import run, gather
+from asyncio import gather, wait, create_task, CancelledError, FIRST_COMPLETED
+from contextlib import suppress
 
 
 from lib.backend import Backend
+from lib.lifecycle import Lifecycle, listening_socket, DRAIN_TIMEOUT
+from lib.multiprocess import serve_processes, PYWORKER_PROCESSES
+from lib.profiler import Profiler, DEBUG_TOKEN
+from lib.server_profile import ServerProfile
 from aiohttp import web
 
 log = logging.getLogger(__file__)
 
 
-def start_server(backend: Backend, routes: List[web.RouteDef], **kwargs):
+def start_server(
+    backend: Backend,
+    routes: List[web.RouteDef],
+    profile: Optional[ServerProfile] = None,
+    **kwargs,
+):
+    profile = profile or ServerProfile()
     log.debug("getting certificate...")
     use_ssl = os.environ.get("USE_SSL", "false") == "true"
     if use_ssl is True:
@@ -23,18 +34,65 @@ def start_server(backend: Backend, routes: List[web.RouteDef], **kwargs):
     else:
         ssl_context = None
 
+    port = int(os.environ["WORKER_PORT"])
+    if PYWORKER_PROCESSES > 1:
+        serve_processes(
+            backend,
+            lambda: make_app(backend, routes, profile),
+            PYWORKER_PROCESSES,
+            profile,
+            ssl_context=ssl_context,
+            port=port,
+            **kwargs,
+        )
+        return
+
     async def main():
         log.debug("starting server...")
-        app = web.Application()
-        app.add_routes(routes)
-        runner = web.AppRunner(app)
+        lifecycle = Lifecycle(backend)
+        lifecycle.install()
+        runner = profile.make_runner(
+            make_app(backend, routes, profile), shutdown_timeout=DRAIN_TIMEOUT
+        )
         await runner.setup()
-        site = web.TCPSite(
-            runner,
-            ssl_context=ssl_context,
-            port=int(os.environ["WORKER_PORT"]),
-            **kwargs
+        # a socket rather than a port, so that it can be handed over to a new process, see lib.lifecycle
+        sock = listening_socket(port, profile.backlog)
+        lifecycle.listen_fd = sock.fileno()
+        site = web.SockSite(runner, sock, ssl_context=ssl_context, **kwargs)
+        await site.start()
+        tracking = gather(backend._start_tracking(), lifecycle.take_over())
+        stopped = create_task(lifecycle.wait())
+        await wait([tracking, stopped], return_when=FIRST_COMPLETED)
+        if tracking.done():
+            stopped.cancel()
+            tracking.result()
+        # stops listening, then waits for the requests in flight for up to DRAIN_TIMEOUT
+        await runner.cleanup()
+        tracking.cancel()
+        with suppress(CancelledError):
+            await tracking
+        unfinished = len(backend.metrics.model_metrics.requests_working)
+        if unfinished:
+            log.debug(f"{unfinished} requests didn't finish within {DRAIN_TIMEOUT}s")
+        await backend.metrics._send_final_metrics()
+        log.debug("server stopped")
+
+    profile.run(main())
+
+
+def make_app(
+    backend: Backend, routes: List[web.RouteDef], profile: ServerProfile
+) -> web.Application:
+    async def handle_metrics(_: web.Request) -> web.Response:
+        return web.Response(
+            text=backend.metrics.registry.render(), content_type="text/plain"
         )
-        await gather(site.start(), backend._start_tracking())
 
-    run(main())
+    app = profile.make_app()
+    app.add_routes(routes)
+    # every PyWorker serves its metrics in Prometheus text format
+    app.add_routes([web.get("/metrics", handle_metrics)])
+    if DEBUG_TOKEN:
+        log.debug("adding debug routes")
+        app.add_routes(Profiler(token=DEBUG_TOKEN).routes())
+    return app
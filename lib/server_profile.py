@@ -0,0 +1,123 @@
+"""
+Runtime options of the aiohttp server PyWorker serves requests with, read from the environment:
+
+$PYWORKER_UVLOOP                runs the event loop on uvloop if it's installed, "true" by default
+$PYWORKER_BACKLOG               connections the kernel queues before they are accepted, 1024 (aiohttp's is 128)
+$PYWORKER_KEEPALIVE_TIMEOUT     seconds an idle keep-alive connection is kept open, 75
+$PYWORKER_CLIENT_MAX_SIZE       largest request body, in bytes, 1 MiB
+$PYWORKER_ROUTE_MAX_SIZE        largest request body of some routes, i.e. "/custom-workflow=104857600,/prompt=65536"
+$PYWORKER_MAX_LINE_SIZE         longest request line and header line the HTTP parser accepts, 8190
+$PYWORKER_MAX_FIELD_SIZE        longest header value the HTTP parser accepts, 8190
+$PYWORKER_ACCESS_LOG            logs every request to the aiohttp.access logger, "false" by default
+
+Workers set the largest request body of their routes with ServerProfile(route_client_max_size=...), the routes
+in $PYWORKER_ROUTE_MAX_SIZE override them.
+"""
+
+import os
+import logging
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Coroutine, Dict
+
+from aiohttp import web
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def parse_route_max_size(value: str) -> Dict[str, int]:
+    """parses "/path=bytes,/other=bytes" """
+    sizes = {}
+    for entry in filter(None, value.split(",")):
+        path, size = entry.split("=")
+        sizes[path.strip()] = int(size)
+    return sizes
+
+
+USE_UVLOOP = os.environ.get("PYWORKER_UVLOOP", "true") == "true"
+BACKLOG = int(os.environ.get("PYWORKER_BACKLOG", "1024"))
+KEEPALIVE_TIMEOUT = float(os.environ.get("PYWORKER_KEEPALIVE_TIMEOUT", "75"))
+CLIENT_MAX_SIZE = int(os.environ.get("PYWORKER_CLIENT_MAX_SIZE", str(2**20)))
+ROUTE_MAX_SIZE = parse_route_max_size(os.environ.get("PYWORKER_ROUTE_MAX_SIZE", ""))
+MAX_LINE_SIZE = int(os.environ.get("PYWORKER_MAX_LINE_SIZE", "8190"))
+MAX_FIELD_SIZE = int(os.environ.get("PYWORKER_MAX_FIELD_SIZE", "8190"))
+ACCESS_LOG = os.environ.get("PYWORKER_ACCESS_LOG", "false") == "true"
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class ServerProfile:
+    use_uvloop: bool = USE_UVLOOP
+    backlog: int = BACKLOG
+    keepalive_timeout: float = KEEPALIVE_TIMEOUT
+    client_max_size: int = CLIENT_MAX_SIZE
+    # largest request body of routes that differ from client_max_size, by path
+    route_client_max_size: Dict[str, int] = field(default_factory=dict)
+    max_line_size: int = MAX_LINE_SIZE
+    max_field_size: int = MAX_FIELD_SIZE
+    access_log: bool = ACCESS_LOG
+
+    def __post_init__(self):
+        self.route_client_max_size = {**self.route_client_max_size, **ROUTE_MAX_SIZE}
+
+    @classmethod
+    def aiohttp_defaults(cls) -> "ServerProfile":
+        """what PyWorker ran with before it had a profile, aiohttp's own defaults"""
+        return cls(
+            use_uvloop=False,
+            backlog=128,
+            keepalive_timeout=75.0,
+            client_max_size=2**20,
+            max_line_size=8190,
+            max_field_size=8190,
+            access_log=True,
+        )
+
+    def run(self, main: Coroutine) -> Any:
+        """asyncio.run, on uvloop if the profile uses it"""
+        if self.use_uvloop and uvloop is not None:
+            # unlike asyncio.Runner's loop_factory, available before Python 3.11
+            return uvloop.run(main)
+        if self.use_uvloop:
+            log.debug("uvloop isn't installed, running on the asyncio event loop")
+        return asyncio.run(main)
+
+    def make_app(self) -> web.Application:
+        middlewares = []
+        if self.route_client_max_size:
+
+            @web.middleware
+            async def route_body_size(
+                request: web.Request, handler
+            ) -> web.StreamResponse:
+                size = self.route_client_max_size.get(
+                    request.match_info.route.resource.canonical
+                    if request.match_info.route.resource
+                    else ""
+                )
+                if size is not None:
+                    request = request.clone(client_max_size=size)
+                return await handler(request)
+
+            middlewares.append(route_body_size)
+        return web.Application(
+            client_max_size=self.client_max_size, middlewares=middlewares
+        )
+
+    def make_runner(self, app: web.Application, **kwargs: Any) -> web.AppRunner:
+        if not self.access_log:
+            kwargs.update(access_log=None)
+        return web.AppRunner(
+            app,
+            keepalive_timeout=self.keepalive_timeout,
+            max_line_size=self.max_line_size,
+            max_field_size=self.max_field_size,
+            **kwargs,
+        )
+
+    def make_site(self, runner: web.AppRunner, **kwargs: Any) -> web.TCPSite:
+        return web.TCPSite(runner, backlog=self.backlog, **kwargs)
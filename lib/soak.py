@@ -0,0 +1,353 @@
+"""
+Soak tests that fail if PyWorker's memory keeps growing, i.e:
+
+python3 -m lib.soak metrics -n 5000000
+python3 -m lib.soak worker --worker tgi --hours 4 --rps 20 --report soak.json
+
+The metrics mode runs requests through Metrics' bookkeeping only. The worker mode serves a worker in-process,
+its routes and its backend's log reading, benchmark and metrics reporting, as lib.server does, in front of
+lib.fake_model_server on the worker's model API port, and sends it hours of signed requests. Every --interval
+seconds it samples the process' RSS, Python heap (tracemalloc), open file descriptors and asyncio tasks, and the
+disk used by the fake model API's output files, and fails if any of them grows faster than MAX_WORKER_GROWTH
+in the second half of the run. Metrics reports are sent to a local route that drops them.
+"""
+
+import os
+import gc
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib
+import itertools
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+import psutil
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+from lib.metrics import Metrics
+
+# growth allowed in the second half of a run, once caches and allocator pools have filled up
+MAX_RSS_GROWTH_MB_PER_MILLION_REQUESTS = 1.0
+NUM_SAMPLES = 50
+# growth per hour allowed in the second half of a worker soak, override with --max-growth
+MAX_WORKER_GROWTH = dict(
+    rss_mb=20.0, heap_mb=10.0, open_fds=1.0, tasks=1.0, disk_mb=10.0
+)
+# requests per second by default, ComfyUI serves one image at a time
+DEFAULT_WORKER_RPS = dict(tgi=20.0, comfyui=1.0, hello_world=20.0)
+REQUEST_TIMEOUT = 120
+TOP_HEAP_GROWTH = 10
+
+log = logging.getLogger(__file__)
+
+
+def rss_mb() -> float:
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def growth_rate(samples: List[Tuple[float, float]]) -> float:
+    """slope of a least squares fit of the second half of the (x, y) samples"""
+    xs, ys = zip(*samples[len(samples) // 2 :])
+    return float(numpy.polyfit(xs, ys, 1)[0])
+
+
+def soak_metrics(num_requests: int, concurrency: int) -> List[Tuple[float, float]]:
+    """
+    runs requests through Metrics' bookkeeping only, returns (millions of requests, RSS in MB) samples
+    """
+    # no reports are sent, so the values read from the environment by default aren't needed
+    metrics = Metrics(id=0, report_addr=[], url="")
+    samples = []
+    sample_every = max(num_requests // NUM_SAMPLES, 1)
+    for reqnum in range(num_requests):
+        metrics._request_start(workload=100.0, reqnum=reqnum)
+        if reqnum >= concurrency:
+            done = reqnum - concurrency
+            if done % 10 == 0:
+                metrics._request_canceled(workload=100.0, reqnum=done)
+            else:
+                metrics._request_end(workload=100.0, req_response_time=1.0, reqnum=done)
+        if reqnum % sample_every == 0:
+            # report windows are normally reset once per second
+            metrics.model_metrics.reset()
+            gc.collect()
+            samples.append((reqnum / 1e6, rss_mb()))
+    return samples
+
+
+def check_growth(samples: List[Tuple[float, float]], max_growth: float) -> bool:
+    growth = growth_rate(samples)
+    print(
+        f"RSS: start {samples[0][1]:.1f}MB, end {samples[-1][1]:.1f}MB, "
+        f"growth {growth:.3f}MB per million requests (max {max_growth})"
+    )
+    return growth <= max_growth
+
+
+def dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                # removed by the worker while walking
+                pass
+    return size
+
+
+async def serve(app: web.Application, port: int = 0) -> Tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, runner.addresses[0][1]
+
+
+async def soak_worker(
+    worker: str, hours: float, rps: float, interval: float, workdir: str
+) -> Tuple[List[Dict[str, float]], List[str]]:
+    """
+    sends `rps` requests per second to the worker for `hours`, returns a sample of its resources every `interval`
+    seconds, and the lines of code whose allocations grew the most in the second half of the run
+    """
+    # imported here as they read the environment set up below on import
+    from lib.bench_proxy import CASES, worker_env
+    from lib.fake_autoscaler import FakeAutoscaler
+    from lib.fake_model_server import (
+        FakeModelServer,
+        DEFAULT_PORTS,
+        DEFAULT_MAX_BATCH,
+    )
+
+    async def drop_report(_: web.Request) -> web.Response:
+        return web.json_response(dict(status="ok"))
+
+    reports = web.Application()
+    reports.add_routes([web.post("/worker_status/", drop_report)])
+    reports_runner, reports_port = await serve(reports)
+    os.environ["REPORT_ADDR"] = f"http://127.0.0.1:{reports_port}"
+    # the fake autoscaler only signs requests, its public key is what the worker fetches
+    autoscaler = FakeAutoscaler()
+    pubkey_file = os.path.join(workdir, "pubkey.pem")
+    with open(pubkey_file, "wb") as f:
+        f.write(autoscaler.key.public_key().export_key())
+    model_log = os.path.join(workdir, "model.log")
+    os.environ["MODEL_LOG"] = model_log
+    # disk usage is checked with the worker removing ComfyUI's images, as it does in production
+    os.environ["KEEP_OUTPUT_FILES"] = "false"
+    worker_env(pubkey_file, model_log)
+    output_dir = os.path.join(workdir, "outputs")
+    model_api = FakeModelServer(
+        flavor=worker,
+        log_file=model_log,
+        output_dir=output_dir,
+        load_time=1.0,
+        max_batch=DEFAULT_MAX_BATCH[worker],
+    )
+    model_runner, _ = await serve(model_api.app(), DEFAULT_PORTS[worker])
+    server = importlib.import_module(f"workers.{worker}.server")
+    from lib.backend import BENCHMARK_INDICATOR_FILE
+
+    # the worker saves its benchmark result in the working directory, don't leave behind one it didn't find
+    had_benchmark = os.path.exists(BENCHMARK_INDICATOR_FILE)
+    # the worker modules log every request at debug level
+    logging.getLogger().setLevel(logging.WARNING)
+    log.setLevel(logging.INFO)
+    app = web.Application()
+    app.add_routes(server.routes)
+    worker_runner, worker_port = await serve(app)
+    tracking = asyncio.create_task(server.backend._start_tracking())
+
+    cases = [case for case in CASES if case.worker == worker]
+    reqnums = itertools.count()
+    outcomes = Counter()
+    in_flight = set()
+
+    async def send(session: ClientSession, case) -> None:
+        payload = case.make_payload(server)
+        handler = getattr(server, case.handler)
+        # in the order of AuthData's fields, which the signed message is built from
+        message = dict(
+            cost=handler.payload_cls().from_json_msg(payload).count_workload(),
+            endpoint="soak",
+            reqnum=next(reqnums),
+            url="soak",
+        )
+        auth_data = dict(signature=autoscaler.sign(message), **message)
+        try:
+            async with session.post(
+                f"http://127.0.0.1:{worker_port}{case.route}",
+                json=dict(auth_data=auth_data, payload=payload),
+            ) as res:
+                await res.read()
+                outcomes[res.status] += 1
+        except (ClientError, asyncio.TimeoutError):
+            outcomes["error"] += 1
+
+    def sample(elapsed: float) -> Dict[str, float]:
+        gc.collect()
+        return dict(
+            hours=elapsed / 3600,
+            rss_mb=rss_mb(),
+            heap_mb=tracemalloc.get_traced_memory()[0] / 2**20,
+            open_fds=psutil.Process().num_fds(),
+            # the requests the soak itself has in flight aren't the worker's
+            tasks=len(asyncio.all_tasks()) - len(in_flight),
+            disk_mb=dir_size(output_dir) / 2**20,
+            requests_ok=outcomes[200],
+            requests_failed=sum(outcomes.values()) - outcomes[200],
+        )
+
+    ###########
+
+    duration = hours * 3600
+    samples = []
+    halfway_snapshot: Optional[tracemalloc.Snapshot] = None
+    tracemalloc.start()
+    start = time.monotonic()
+    next_sample = start
+    try:
+        async with ClientSession(
+            timeout=ClientTimeout(total=REQUEST_TIMEOUT)
+        ) as session:
+            for i in itertools.count():
+                now = time.monotonic()
+                if now - start >= duration:
+                    break
+                if now >= next_sample:
+                    samples.append(sample(now - start))
+                    log.info(", ".join(f"{k}: {v:.2f}" for k, v in samples[-1].items()))
+                    next_sample += interval
+                    if halfway_snapshot is None and now - start >= duration / 2:
+                        halfway_snapshot = tracemalloc.take_snapshot()
+                task = asyncio.create_task(send(session, cases[i % len(cases)]))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                await asyncio.sleep(max(start + (i + 1) / rps - time.monotonic(), 0))
+            await asyncio.gather(*in_flight)
+        log.info(f"responses: {dict(outcomes)}")
+        top_growth = []
+        if halfway_snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(halfway_snapshot, "lineno")
+            top_growth = [str(stat) for stat in stats[:TOP_HEAP_GROWTH]]
+    finally:
+        tracemalloc.stop()
+        tracking.cancel()
+        await worker_runner.cleanup()
+        await model_runner.cleanup()
+        await reports_runner.cleanup()
+        await server.backend.session.close()
+        if not had_benchmark and os.path.exists(BENCHMARK_INDICATOR_FILE):
+            os.remove(BENCHMARK_INDICATOR_FILE)
+    return samples, top_growth
+
+
+def check_worker_growth(
+    samples: List[Dict[str, float]], max_growth: Dict[str, float]
+) -> Dict[str, Dict[str, Any]]:
+    """growth per hour of every sampled resource in the second half of the run, and whether it's allowed"""
+    results = {}
+    for name, max_rate in max_growth.items():
+        rate = growth_rate([(sample["hours"], sample[name]) for sample in samples])
+        results[name] = dict(
+            start=samples[0][name],
+            end=samples[-1][name],
+            growth_per_hour=rate,
+            max_growth_per_hour=max_rate,
+            passed=rate <= max_rate,
+        )
+        print(
+            f"{name}: start {samples[0][name]:.1f}, end {samples[-1][name]:.1f}, "
+            f"growth {rate:.3f} per hour (max {max_rate}) "
+            f"{'ok' if rate <= max_rate else 'FAILED'}"
+        )
+    return results
+
+
+def run_worker_soak(args: argparse.Namespace) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)-5s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    max_growth = dict(MAX_WORKER_GROWTH)
+    for override in args.max_growth:
+        name, value = override.split("=")
+        if name not in max_growth:
+            raise SystemExit(f"unknown resource: {name}")
+        max_growth[name] = float(value)
+    with tempfile.TemporaryDirectory() as workdir:
+        samples, top_growth = asyncio.run(
+            soak_worker(
+                args.worker,
+                args.hours,
+                args.rps or DEFAULT_WORKER_RPS[args.worker],
+                args.interval,
+                workdir,
+            )
+        )
+    if len(samples) < 4:
+        raise SystemExit(
+            "FAILED: not enough samples, run for longer or sample more often"
+        )
+    results = check_worker_growth(samples, max_growth)
+    if top_growth:
+        print("largest heap growth in the second half:")
+        print("\n".join(top_growth))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(
+                dict(
+                    worker=args.worker,
+                    samples=samples,
+                    results=results,
+                    top_heap_growth=top_growth,
+                ),
+                f,
+                indent=2,
+            )
+    if not all(result["passed"] for result in results.values()):
+        raise SystemExit("FAILED: resources keep growing")
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="PyWorker soak tests")
+    arg_parser.add_argument("mode", choices=["metrics", "worker"])
+    arg_parser.add_argument(
+        "-n",
+        dest="num_requests",
+        type=int,
+        default=5_000_000,
+        help="number of requests",
+    )
+    arg_parser.add_argument(
+        "-c", dest="concurrency", type=int, default=100, help="requests in flight"
+    )
+    arg_parser.add_argument("--worker", choices=list(DEFAULT_WORKER_RPS), default="tgi")
+    arg_parser.add_argument("--hours", type=float, default=4.0)
+    arg_parser.add_argument("--rps", type=float, help="defaults to the worker's")
+    arg_parser.add_argument(
+        "--interval", type=float, default=60.0, help="seconds between samples"
+    )
+    arg_parser.add_argument(
+        "--max-growth",
+        action="append",
+        default=[],
+        help="growth per hour allowed for a resource, i.e. rss_mb=50, can be repeated",
+    )
+    arg_parser.add_argument("--report", help="write the samples and results as JSON")
+    args = arg_parser.parse_args()
+    if args.mode == "metrics":
+        samples = soak_metrics(args.num_requests, args.concurrency)
+        if not check_growth(samples, MAX_RSS_GROWTH_MB_PER_MILLION_REQUESTS):
+            raise SystemExit("FAILED: memory keeps growing")
+        print("PASSED")
+    else:
+        run_worker_soak(args)
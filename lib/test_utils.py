@@ -1,31 +1,34 @@
+"""
+Open loop load testing of an endpoint group: requests are sent at the times set by an arrival pattern,
+whether or not earlier requests have finished, so that a slow endpoint shows up as latency rather than as a
+lower request rate. All requests run as tasks on a single event loop, sharing a pool of connections.
+"""
+
 import os
+import sys
+import json
 import time
+import signal
+import asyncio
 import argparse
-from typing import Callable, List, Dict, Tuple, Dict, Any, Type
-from time import sleep
-import threading
-from enum import Enum
-from collections import Counter
+from typing import Any, Deque, Dict, List, Optional, Tuple, Type, Callable
+from collections import Counter, deque
 from dataclasses import dataclass, field, asdict
 from urllib.parse import urljoin
 
-import requests
+import numpy
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 
 from lib.data_types import AuthData, ApiPayload
 
+ARRIVAL_PATTERNS = ["constant", "poisson", "step", "ramp"]
+DASHBOARD_INTERVAL = 1.0
+# latencies are recorded with 2^HISTOGRAM_PRECISION_BITS sub buckets per power of two microseconds, which
+# keeps the relative error of percentiles under 1/2^(HISTOGRAM_PRECISION_BITS - 1)
+HISTOGRAM_PRECISION_BITS = 7
+LATENCY_PERCENTILES = (50.0, 90.0, 95.0, 99.0, 99.9)
+ROUTE_TIMEOUT = 4
 
-class ClientStatus(Enum):
-    FetchEndpoint = 1
-    Generating = 2
-    Done = 3
-    Error = 4
-
-
-total_success = 0
-last_res = []
-stop_event = threading.Event()
-
-start_time = time.time()
 test_args = argparse.ArgumentParser(description="Test inference endpoint")
 test_args.add_argument(
     "-k", dest="api_key", type=str, required=True, help="Your vast account API key"
@@ -56,184 +59,312 @@ def print_truncate_res(res: str):
         print(res)
 
 
+def arrival_times(
+    pattern: str,
+    num_requests: int,
+    requests_per_second: float,
+    final_requests_per_second: Optional[float] = None,
+    seed: Optional[int] = None,
+) -> numpy.ndarray:
+    """
+    seconds from the start of the test at which each request is sent.
+    constant: evenly spaced at requests_per_second
+    poisson: exponentially distributed gaps at requests_per_second on average
+    step: poisson, at requests_per_second for the first half of the requests and final_requests_per_second after
+    ramp: poisson, at a rate that goes linearly from requests_per_second to final_requests_per_second
+    """
+    final_rps = final_requests_per_second or requests_per_second
+    match pattern:
+        case "constant":
+            rates = numpy.full(num_requests, requests_per_second)
+        case "poisson":
+            rates = numpy.full(num_requests, requests_per_second)
+        case "step":
+            rates = numpy.where(
+                numpy.arange(num_requests) < num_requests // 2,
+                requests_per_second,
+                final_rps,
+            )
+        case "ramp":
+            rates = numpy.linspace(requests_per_second, final_rps, num_requests)
+        case _:
+            raise ValueError(f"unknown arrival pattern: {pattern}")
+    if pattern == "constant":
+        gaps = 1 / rates
+    else:
+        gaps = numpy.random.default_rng(seed).exponential(1 / rates)
+    # the first request is sent right away
+    return numpy.concatenate(([0.0], numpy.cumsum(gaps[:-1])))
+
+
+@dataclass
+class LatencyHistogram:
+    """
+    HDR style histogram of latencies: a fixed number of sub buckets per power of two microseconds, so that
+    percentiles have the same relative precision from microseconds to minutes in a few KB
+    """
+
+    precision_bits: int = HISTOGRAM_PRECISION_BITS
+    counts: Counter = field(default_factory=Counter)
+    count: int = 0
+    total: float = 0.0
+    min: float = float("inf")
+    max: float = 0.0
+
+    def record(self, seconds: float) -> None:
+        seconds = float(seconds)
+        micros = max(int(seconds * 1e6), 1)
+        shift = max(micros.bit_length() - self.precision_bits, 0)
+        self.counts[(shift, micros >> shift)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentiles(self, *percentiles: float) -> List[float]:
+        if self.count == 0:
+            return [0.0 for _ in percentiles]
+        buckets = sorted(self.counts.items(), key=lambda item: item[0][1] << item[0][0])
+        cumulative = numpy.cumsum([count for _, count in buckets])
+        values = []
+        for percentile in percentiles:
+            i = int(numpy.searchsorted(cumulative, percentile / 100 * self.count))
+            (shift, sub_bucket), _ = buckets[min(i, len(buckets) - 1)]
+            # middle of the bucket, clamped to the values that were actually recorded
+            micros = (sub_bucket << shift) + ((1 << shift) - 1) / 2
+            values.append(min(max(micros / 1e6, self.min), self.max))
+        return values
+
+    def summary(self) -> Dict[str, float]:
+        if self.count == 0:
+            return dict(count=0)
+        return dict(
+            count=self.count,
+            mean=self.total / self.count,
+            min=self.min,
+            max=self.max,
+            **{
+                f"p{percentile:g}": value
+                for percentile, value in zip(
+                    LATENCY_PERCENTILES, self.percentiles(*LATENCY_PERCENTILES)
+                )
+            },
+        )
+
+
 @dataclass
-class ClientState:
+class LoadTest:
     endpoint_group_name: str
     api_key: str
     server_url: str
     worker_endpoint: str
-    payload: ApiPayload
-    url: str = ""
-    status: ClientStatus = ClientStatus.FetchEndpoint
-    as_error: List[str] = field(default_factory=list)
-    infer_error: List[str] = field(default_factory=list)
-    conn_errors: Counter = field(default_factory=Counter)
+    payload_cls: Type[ApiPayload]
+    arrivals: numpy.ndarray
+    max_connections: int = 1000
+    timeout: Optional[float] = None
+    dashboard: bool = True
+    # payload and worker endpoint of each request, i.e. replayed from a capture. By default, payloads are made
+    # with payload_cls.for_test() and sent to worker_endpoint
+    payloads: Optional[List[Optional[ApiPayload]]] = None
+    endpoints: Optional[List[str]] = None
+    # outcome of each request: success, route_error, infer_error or conn_error
+    outcomes: Counter = field(default_factory=Counter)
+    worker_requests: Counter = field(default_factory=Counter)
+    route_latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    worker_latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    total_latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # how late requests were sent compared to their arrival time, a high value means that the load generator
+    # couldn't keep up and the results don't reflect the requested load
+    send_lag: LatencyHistogram = field(default_factory=LatencyHistogram)
+    in_flight: int = 0
+    sent: int = 0
+    last_results: Deque[str] = field(default_factory=lambda: deque(maxlen=5))
+    last_errors: Deque[str] = field(default_factory=lambda: deque(maxlen=5))
 
-    def make_call(self):
-        self.status = ClientStatus.FetchEndpoint
-        route_payload = {
-            "endpoint": self.endpoint_group_name,
-            "api_key": self.api_key,
-            "cost": self.payload.count_workload(),
-        }
-        response = requests.post(
-            urljoin(self.server_url, "/route/"),
-            json=route_payload,
-            timeout=4,
-        )
-        if response.status_code != 200:
-            self.as_error.append(
-                f"code: {response.status_code}, body: {response.text}",
-            )
-            self.status = ClientStatus.Error
-            return
-        message = response.json()
-        worker_address = message["url"]
-        req_data = dict(
-            payload=asdict(self.payload),
-            auth_data=asdict(AuthData.from_json_msg(message)),
-        )
-        self.url = worker_address
-        url = urljoin(worker_address, self.worker_endpoint)
-        self.status = ClientStatus.Generating
-        response = requests.post(
-            url,
-            json=req_data,
+    async def run(self) -> Dict[str, Any]:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, stop_event.set)
+        connector = TCPConnector(limit=self.max_connections)
+        tasks = set()
+        self.start = time.monotonic()
+        async with ClientSession(
+            connector=connector, timeout=ClientTimeout(total=self.timeout)
+        ) as session:
+            dashboard_task = asyncio.create_task(self.__dashboard_loop())
+            for i, arrival in enumerate(self.arrivals):
+                delay = self.start + arrival - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(stop_event.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                if stop_event.is_set():
+                    break
+                self.send_lag.record(time.monotonic() - self.start - arrival)
+                task = asyncio.create_task(self.__make_call(session, i))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if stop_event.is_set():
+                print("\n### waiting for existing connections to close ###")
+            await asyncio.gather(*tasks)
+            dashboard_task.cancel()
+        loop.remove_signal_handler(signal.SIGINT)
+        self.__print_dashboard()
+        return self.summary()
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.start
+        return dict(
+            requests=len(self.arrivals),
+            sent=self.sent,
+            elapsed=elapsed,
+            throughput=self.outcomes["success"] / elapsed if elapsed > 0 else 0.0,
+            outcomes=dict(self.outcomes),
+            workers=dict(self.worker_requests),
+            latency=dict(
+                route=self.route_latency.summary(),
+                worker=self.worker_latency.summary(),
+                total=self.total_latency.summary(),
+            ),
+            send_lag=self.send_lag.summary(),
         )
-        if response.status_code != 200:
-            self.infer_error.append(
-                f"code: {response.status_code}, body: {response.text}, url: {url}",
-            )
-            self.status = ClientStatus.Error
-            return
-        res = str(response.json())
-        global total_success
-        global last_res
-        total_success += 1
-        last_res.append(res)
-        self.status = ClientStatus.Done
 
-    def simulate_user(self) -> None:
+    #######################################Private#######################################
+
+    async def __make_call(self, session: ClientSession, i: int) -> None:
+        self.sent += 1
+        self.in_flight += 1
+        start = time.monotonic()
+        url = ""
         try:
-            self.make_call()
+            payload = (self.payloads[i] if self.payloads else None) or (
+                self.payload_cls.for_test()
+            )
+            endpoint = self.endpoints[i] if self.endpoints else self.worker_endpoint
+            route_payload = {
+                "endpoint": self.endpoint_group_name,
+                "api_key": self.api_key,
+                "cost": payload.count_workload(),
+            }
+            async with session.post(
+                urljoin(self.server_url, "/route/"),
+                json=route_payload,
+                timeout=ClientTimeout(total=ROUTE_TIMEOUT),
+            ) as response:
+                if response.status != 200:
+                    self.__error(
+                        "route_error",
+                        f"code: {response.status}, body: {await response.text()}",
+                    )
+                    return
+                message = await response.json()
+            routed = time.monotonic()
+            self.route_latency.record(routed - start)
+            url = message["url"]
+            req_data = dict(
+                payload=asdict(payload),
+                auth_data=asdict(AuthData.from_json_msg(message)),
+            )
+            async with session.post(urljoin(url, endpoint), json=req_data) as response:
+                if response.status != 200:
+                    self.__error(
+                        "infer_error",
+                        f"code: {response.status}, body: {await response.text()}, url: {url}",
+                    )
+                    return
+                res = await response.text()
+            end = time.monotonic()
+            self.worker_latency.record(end - routed)
+            self.total_latency.record(end - start)
+            self.worker_requests[url] += 1
+            self.outcomes["success"] += 1
+            self.last_results.append(res)
         except Exception as e:
-            self.status = ClientStatus.Error
-            _ = e
-            self.conn_errors[self.url] += 1
+            self.__error("conn_error", f"{type(e).__name__}: {e}, url: {url}")
+        finally:
+            self.in_flight -= 1
 
+    def __error(self, outcome: str, error: str) -> None:
+        self.outcomes[outcome] += 1
+        self.last_errors.append(error)
 
-def print_state(clients: List[ClientState], num_clients: int) -> None:
-    print("starting up...")
-    sleep(2)
-    center_size = 14
-    global start_time
-    while len(clients) < num_clients or (
-        any(
-            map(
-                lambda client: client.status
-                in [ClientStatus.FetchEndpoint, ClientStatus.Generating],
-                clients,
-            )
-        )
-    ):
-        sleep(0.5)
-        os.system("clear")
-        print(
-            " | ".join(
-                [member.name.center(center_size) for member in ClientStatus]
-                + [
-                    item.center(center_size)
-                    for item in [
-                        "urls",
-                        "as_error",
-                        "infer_error",
-                        "conn_error",
-                        "total_success",
-                    ]
-                ]
-            )
-        )
-        unique_urls = len(set([c.url for c in clients if c.url != ""]))
-        as_errors = sum(
-            map(
-                lambda client: len(client.as_error),
-                [client for client in clients],
-            )
-        )
-        infer_errors = sum(
-            map(
-                lambda client: len(client.infer_error),
-                [client for client in clients],
-            )
-        )
-        conn_errors = sum([client.conn_errors for client in clients], start=Counter())
-        conn_errors_str = ",".join(map(str, conn_errors.values())) or "0"
-        elapsed = time.time() - start_time
-        print(
-            " | ".join(
-                map(
-                    lambda item: str(item).center(center_size),
-                    [
-                        len(list(filter(lambda x: x.status == member, clients)))
-                        for member in ClientStatus
-                    ]
-                    + [
-                        unique_urls,
-                        as_errors,
-                        infer_errors,
-                        conn_errors_str,
-                        f"{total_success}({((total_success/elapsed) * 60):.2f}/minute)",
-                    ],
-                )
-            )
-        )
-        if conn_errors:
-            print("conn_errors:")
-            for url, count in conn_errors.items():
-                print(url.ljust(28), ": ", str(count))
-        elapsed = time.time() - start_time
-        print(f"\n elapsed: {int(elapsed // 60)}:{int(elapsed % 60)}")
-        if last_res:
-            for i, res in enumerate(last_res[-10:]):
-                print_truncate_res(f"res #{1+i+max(len(last_res )-10,0)}: {res}")
-        if stop_event.is_set():
-            print("\n### waiting for existing connections to close ###")
+    async def __dashboard_loop(self) -> None:
+        while self.dashboard:
+            await asyncio.sleep(DASHBOARD_INTERVAL)
+            self.__print_dashboard()
+
+    def __print_dashboard(self) -> None:
+        elapsed = time.monotonic() - self.start
+        p50, p99 = self.total_latency.percentiles(50, 99)
+        lines = [
+            f"elapsed: {int(elapsed // 60)}:{int(elapsed % 60):02d}  "
+            f"sent: {self.sent}/{len(self.arrivals)}  in flight: {self.in_flight}  "
+            f"workers: {len(self.worker_requests)}  "
+            f"send lag max: {self.send_lag.max if self.send_lag.count else 0.0:.3f}s",
+            f"success: {self.outcomes['success']} "
+            f"({self.outcomes['success'] / elapsed if elapsed > 0 else 0.0:.2f}/s)  "
+            f"route errors: {self.outcomes['route_error']}  "
+            f"infer errors: {self.outcomes['infer_error']}  "
+            f"conn errors: {self.outcomes['conn_error']}",
+            f"latency p50: {p50:.3f}s  p99: {p99:.3f}s  max: {self.total_latency.max:.3f}s",
+        ]
+        if self.last_results:
+            lines.append(f"last result: {self.last_results[-1][:100]}")
+        if self.last_errors:
+            lines.append(f"last error: {self.last_errors[-1][:100]}")
+        # redraw in place
+        if getattr(self, "dashboard_lines", 0):
+            sys.stdout.write(f"\x1b[{self.dashboard_lines}F\x1b[J")
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        self.dashboard_lines = len(lines)
 
 
 def run_test(
     num_requests: int,
-    requests_per_second: int,
+    requests_per_second: float,
     endpoint_group_name: str,
     api_key: str,
     server_url: str,
     worker_endpoint: str,
     payload_cls: Type[ApiPayload],
-):
-    threads = []
-
-    clients = []
-    print_thread = threading.Thread(target=print_state, args=(clients, num_requests))
-    print_thread.daemon = True  # makes threads get killed on program exit
-    print_thread.start()
-    try:
-        for _ in range(num_requests):
-            client = ClientState(
-                endpoint_group_name=endpoint_group_name,
-                api_key=api_key,
-                server_url=server_url,
-                worker_endpoint=worker_endpoint,
-                payload=payload_cls.for_test(),
-            )
-            clients.append(client)
-            thread = threading.Thread(target=client.simulate_user, args=())
-            threads.append(thread)
-            thread.start()
-            sleep(1 / requests_per_second)
-        for thread in threads:
-            thread.join()
-        print("done spawning workers")
-    except KeyboardInterrupt:
-        stop_event.set()
+    arrival_pattern: str = "constant",
+    final_requests_per_second: Optional[float] = None,
+    max_connections: int = 1000,
+    timeout: Optional[float] = None,
+    summary_file: Optional[str] = None,
+    dashboard: bool = True,
+    seed: Optional[int] = None,
+) -> Dict[str, Any]:
+    load_test = LoadTest(
+        endpoint_group_name=endpoint_group_name,
+        api_key=api_key,
+        server_url=server_url,
+        worker_endpoint=worker_endpoint,
+        payload_cls=payload_cls,
+        arrivals=arrival_times(
+            arrival_pattern,
+            num_requests,
+            requests_per_second,
+            final_requests_per_second,
+            seed,
+        ),
+        max_connections=max_connections,
+        timeout=timeout,
+        dashboard=dashboard,
+    )
+    summary = asyncio.run(load_test.run())
+    summary.update(
+        arrival_pattern=arrival_pattern,
+        requests_per_second=requests_per_second,
+        final_requests_per_second=final_requests_per_second,
+    )
+    if summary_file:
+        with open(summary_file, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"summary written to {summary_file}")
+    return summary
 
 
 def test_load_cmd(
@@ -253,6 +384,39 @@ def test_load_cmd(
         required=True,
         help="requests per second",
     )
+    arg_parser.add_argument(
+        "--arrival",
+        dest="arrival_pattern",
+        choices=ARRIVAL_PATTERNS,
+        default="constant",
+        help="how requests are spaced, step and ramp go from -rps to --final-rps",
+    )
+    arg_parser.add_argument(
+        "--final-rps",
+        dest="final_requests_per_second",
+        type=float,
+        help="requests per second at the end of a step or ramp",
+    )
+    arg_parser.add_argument(
+        "--connections",
+        dest="max_connections",
+        type=int,
+        default=1000,
+        help="maximum number of open connections",
+    )
+    arg_parser.add_argument(
+        "--timeout", type=float, help="timeout of each request, in seconds"
+    )
+    arg_parser.add_argument(
+        "--summary", dest="summary_file", help="write a JSON summary to this file"
+    )
+    arg_parser.add_argument(
+        "--no-dashboard",
+        dest="dashboard",
+        action="store_false",
+        help="only print the results once the test is done",
+    )
+    arg_parser.add_argument("--seed", type=int, help="seed of random arrivals")
     args = arg_parser.parse_args()
     if hasattr(args, "comfy_model"):
         os.environ["COMFY_MODEL"] = args.comfy_model
@@ -264,4 +428,11 @@ def test_load_cmd(
         endpoint_group_name=args.endpoint_group_name,
         worker_endpoint=endpoint,
         payload_cls=payload_cls,
+        arrival_pattern=args.arrival_pattern,
+        final_requests_per_second=args.final_requests_per_second,
+        max_connections=args.max_connections,
+        timeout=args.timeout,
+        summary_file=args.summary_file,
+        dashboard=args.dashboard,
+        seed=args.seed,
     )
@@ -0,0 +1,161 @@
+"""
+Per-stage timing of requests. Every request handled by Backend gets a RequestContext, a sample of them
+records a span for each stage of `Backend.__handle_request`. Sampled requests are aggregated in the
+`pyworker_stage_seconds` histogram and, if $TRACE_FILE is set, written to it as JSON lines by a background
+thread.
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from queue import SimpleQueue
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+
+from lib.prometheus import Registry, LATENCY_BUCKETS
+
+# propagated to the model API, and taken from the client request if it's set there
+REQUEST_ID_HEADER = "X-Request-Id"
+# fraction of requests whose stages are timed
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_FILE = os.environ.get("TRACE_FILE")
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class JsonlWriter:
+    """
+    appends records to a JSON lines file from a background thread, so that writing never blocks the
+    event loop. `write` only puts the record on a queue. If `max_bytes` is set, the file is rotated once it's
+    larger: path is renamed to path.1, path.1 to path.2, and so on, keeping `backups` old files.
+    `prepare`, if set, turns each record into the one that is written, in the background thread
+    """
+
+    path: str
+    max_bytes: Optional[int] = None
+    backups: int = 1
+    prepare: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+    queue: SimpleQueue = field(default_factory=SimpleQueue)
+
+    def __post_init__(self):
+        self.thread = threading.Thread(
+            target=self.__write_loop, name="pyworker-jsonl-writer", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.queue.put(record)
+
+    #######################################Private#######################################
+
+    def __write_loop(self) -> None:
+        f = open(self.path, "a")
+        while True:
+            f.write(self.__line(self.queue.get()))
+            # batch whatever else is queued before flushing
+            while not self.queue.empty():
+                f.write(self.__line(self.queue.get()))
+            f.flush()
+            if self.max_bytes is not None and f.tell() >= self.max_bytes:
+                f.close()
+                self.__rotate()
+                f = open(self.path, "a")
+
+    def __line(self, record: Dict[str, Any]) -> str:
+        if self.prepare is not None:
+            record = self.prepare(record)
+        return json.dumps(record) + "\n"
+
+    def __rotate(self) -> None:
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        log.debug(f"rotated {self.path}")
+
+
+@dataclass
+class RequestContext:
+    """carried by a request through Backend, holds its ID and the spans of its stages if it's sampled"""
+
+    request_id: str
+    endpoint: str
+    sampled: bool
+    start_time: float = field(default_factory=time.time)
+    start: float = field(default_factory=time.monotonic)
+    # (stage, start, end), in monotonic clock time
+    spans: List[Tuple[str, float, float]] = field(default_factory=list)
+    # estimated workload and client payload of the request once it's parsed, for lib.capture
+    workload: Optional[float] = None
+    payload: Optional[Dict[str, Any]] = None
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        if not self.sampled:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append((stage, start, time.monotonic()))
+
+
+@dataclass
+class Tracer:
+    registry: Registry
+    sample_rate: float = TRACE_SAMPLE_RATE
+    trace_file: Optional[str] = TRACE_FILE
+
+    def __post_init__(self):
+        self.stage_seconds = self.registry.histogram(
+            "pyworker_stage_seconds",
+            "Time sampled requests spent in each stage of request handling",
+            LATENCY_BUCKETS,
+            ("endpoint", "stage"),
+        )
+        self.writer = JsonlWriter(self.trace_file) if self.trace_file else None
+        if self.writer:
+            log.debug(f"writing request traces to {self.trace_file}")
+
+    def start(self, request: web.Request) -> RequestContext:
+        return RequestContext(
+            request_id=request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex,
+            endpoint=request.path,
+            sampled=random.random() < self.sample_rate,
+        )
+
+    def finish(self, ctx: RequestContext, status: int) -> None:
+        if not ctx.sampled:
+            return
+        for stage, start, end in ctx.spans:
+            self.stage_seconds.observe(end - start, ctx.endpoint, stage)
+        if self.writer:
+            self.writer.write(
+                dict(
+                    request_id=ctx.request_id,
+                    endpoint=ctx.endpoint,
+                    start_time=ctx.start_time,
+                    # a sample of requests is traced, each record stands for 1 / sample_rate of them
+                    sample_rate=self.sample_rate,
+                    workload=ctx.workload,
+                    status=status,
+                    duration=time.monotonic() - ctx.start,
+                    # offset from the start of the request and duration of each stage, in seconds
+                    spans={
+                        stage: [start - ctx.start, end - start]
+                        for stage, start, end in ctx.spans
+                    },
+                )
+            )
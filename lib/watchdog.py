@@ -0,0 +1,118 @@
+"""
+Detects a model that stopped making progress without logging an error, such as a wedged TGI shard or a stuck
+ComfyUI node, which LogAction.ModelError can't catch: requests pile up and the worker keeps looking healthy.
+
+Backend reports progress to the watchdog: every response from the model API and every line of the model's log,
+and the watchdog also counts the last token streamed by each request in flight (see StreamStats). While requests
+are in flight and there's been no progress for $WATCHDOG_PROBE_AFTER seconds, the model's health endpoint
+(EndpointHandler.healthcheck_endpoint) is probed every $WATCHDOG_PROBE_INTERVAL seconds. The model is considered
+stalled once $WATCHDOG_PROBE_FAILURES probes in a row have failed, or once there's been no progress for
+$WATCHDOG_STALL_TIMEOUT seconds, which must be longer than the longest request that doesn't stream or log
+anything.
+"""
+
+import os
+import time
+import logging
+from asyncio import sleep
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+from lib.data_types import StreamStats
+from lib.prometheus import Registry
+
+WATCHDOG_PROBE_AFTER = float(os.environ.get("WATCHDOG_PROBE_AFTER", "30"))
+WATCHDOG_PROBE_INTERVAL = float(os.environ.get("WATCHDOG_PROBE_INTERVAL", "5"))
+WATCHDOG_PROBE_TIMEOUT = float(os.environ.get("WATCHDOG_PROBE_TIMEOUT", "10"))
+WATCHDOG_PROBE_FAILURES = int(os.environ.get("WATCHDOG_PROBE_FAILURES", "3"))
+WATCHDOG_STALL_TIMEOUT = float(os.environ.get("WATCHDOG_STALL_TIMEOUT", "300"))
+
+log = logging.getLogger(__file__)
+
+
+@dataclass
+class Watchdog:
+    registry: Registry
+    probe_after: float = WATCHDOG_PROBE_AFTER
+    probe_interval: float = WATCHDOG_PROBE_INTERVAL
+    probe_failures: int = WATCHDOG_PROBE_FAILURES
+    stall_timeout: float = WATCHDOG_STALL_TIMEOUT
+
+    def __post_init__(self):
+        # wall clock time, as StreamStats' and that of serving processes, see lib.multiprocess
+        self.last_progress = time.time()
+        # StreamStats of the requests in flight, by id
+        self.streams: Dict[int, StreamStats] = {}
+        self.registry.gauge(
+            "pyworker_seconds_since_progress",
+            "Seconds since the model last made progress on a request in flight",
+            self.stalled_for,
+        )
+        self.probes = self.registry.counter(
+            "pyworker_watchdog_probes_total",
+            "Health probes of a model that made no progress, by result",
+            ("result",),
+        )
+
+    def progress(self, at: Optional[float] = None) -> None:
+        self.last_progress = max(self.last_progress, at or time.time())
+
+    def watch_stream(self, stream: StreamStats) -> None:
+        self.streams[id(stream)] = stream
+
+    def unwatch_stream(self, stream: StreamStats) -> None:
+        self.streams.pop(id(stream), None)
+
+    def last_progress_at(self) -> float:
+        return max(
+            [self.last_progress]
+            + [
+                stream.last_token
+                for stream in self.streams.values()
+                if stream.last_token is not None
+            ]
+        )
+
+    def stalled_for(self) -> float:
+        return time.time() - self.last_progress_at()
+
+    async def run(
+        self,
+        in_flight: Callable[[], int],
+        probe: Optional[Callable[[], Awaitable[bool]]],
+        stalled: Callable[[str], None],
+    ) -> None:
+        """
+        `in_flight` returns the number of requests the model is working on, `probe` whether the model's health
+        endpoint responds, if it has one, and `stalled` is called once, when the model is considered stalled
+        """
+        failures = 0
+        while True:
+            await sleep(self.probe_interval)
+            if in_flight() == 0:
+                # an idle model isn't stalled
+                self.progress()
+                failures = 0
+                continue
+            stalled_for = self.stalled_for()
+            if stalled_for < self.probe_after:
+                failures = 0
+                continue
+            if probe is not None:
+                healthy = await probe()
+                self.probes.inc(1, "healthy" if healthy else "failed")
+                failures = 0 if healthy else failures + 1
+            log.debug(
+                f"no progress for {stalled_for:.0f}s with {in_flight()} requests in flight, "
+                f"failed probes: {failures}"
+            )
+            if failures >= self.probe_failures:
+                stalled(
+                    f"model made no progress for {stalled_for:.0f}s and failed {failures} health probes"
+                )
+                return
+            if stalled_for >= self.stall_timeout:
+                stalled(
+                    f"model made no progress for {stalled_for:.0f}s with {in_flight()} requests in flight"
+                )
+                return
@@ -5,14 +5,15 @@ import base64
 from typing import Union, Type
 
 from aiohttp import web, ClientResponse
-from anyio import open_file
+from anyio import open_file, Path
 
 from lib.backend import Backend, LogAction
-from lib.data_types import EndpointHandler
+from lib.data_types import EndpointHandler, cpu_bound
 from lib.server import start_server
+from lib.load_progress import tqdm_progress
+from lib.server_profile import ServerProfile
 from .data_types import DefaultComfyWorkflowData, CustomComfyWorkflowData
 
-
 MODEL_SERVER_URL = "http://0.0.0.0:38188"
 
 # This is the last log line that gets emitted once comfyui+extensions have been fully loaded
@@ -22,6 +23,21 @@ MODEL_SERVER_ERROR_LOG_MSGS = [
     "Value not in list: unet_name",  # This error is emitted when the model file is not there at all
 ]
 
+# keep the images ComfyUI writes once they've been sent to the client
+KEEP_OUTPUT_FILES = os.environ.get("KEEP_OUTPUT_FILES", "false") == "true"
+
+# custom workflows can embed input images, larger than the 1 MiB other requests are limited to
+CUSTOM_WORKFLOW_MAX_SIZE = 100 * 2**20
+
+# image shapes other than the benchmark's 1024x1024 that are run before the worker reports it is loaded,
+# see EndpointHandler.warmup_shapes. Workload counts 512px tiles, so each covers 1, 2 and 6 tiles to add a
+# distinct point to the throughput curve, the benchmark covers 4
+WARMUP_SHAPES = [
+    dict(width=512, height=512, steps=28),
+    dict(width=1024, height=512, steps=28),
+    dict(width=1344, height=768, steps=28),
+]
+
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -31,6 +47,11 @@ logging.basicConfig(
 log = logging.getLogger(__file__)
 
 
+@cpu_bound
+def encode_image(contents: bytes) -> str:
+    return f"data:image/png;base64,{base64.b64encode(contents).decode('utf-8')}"
+
+
 async def generate_client_response(
     request: web.Request, response: ClientResponse
 ) -> Union[web.Response, web.StreamResponse]:
@@ -54,9 +75,11 @@ async def generate_client_response(
             for image_path in image_paths:
                 async with await open_file(image_path, mode="rb") as f:
                     contents = await f.read()
-                    images.append(
-                        f"data:image/png;base64,{base64.b64encode(contents).decode('utf-8')}"
-                    )
+                # images are only returned to the client, they would otherwise fill the disk of long running workers
+                if not KEEP_OUTPUT_FILES:
+                    await Path(image_path).unlink(missing_ok=True)
+                # base64 encoding large images would stall other requests if done on the event loop
+                images.append(await backend.run_hook(encode_image, contents))
             return web.json_response(data=dict(images=images))
         case code:
             log.debug("SENDING RESPONSE: ERROR: unknown code")
@@ -108,7 +131,7 @@ backend = Backend(
     model_log_file=os.environ["MODEL_LOG"],
     allow_parallel_requests=False,
     benchmark_handler=DefaultComfyWorkflowHandler(
-        benchmark_runs=3, benchmark_words=100
+        benchmark_runs=3, benchmark_words=100, warmup_shapes=WARMUP_SHAPES
     ),
     log_actions=[
         (LogAction.ModelLoaded, MODEL_SERVER_START_LOG_MSG),
@@ -118,6 +141,7 @@ backend = Backend(
             for error_msg in MODEL_SERVER_ERROR_LOG_MSGS
         ],
     ],
+    load_progress_extractors=[tqdm_progress],
 )
 
 
@@ -132,4 +156,10 @@ routes = [
 ]
 
 if __name__ == "__main__":
-    start_server(backend, routes)
+    start_server(
+        backend,
+        routes,
+        ServerProfile(
+            route_client_max_size={"/custom-workflow": CUSTOM_WORKFLOW_MAX_SIZE}
+        ),
+    )
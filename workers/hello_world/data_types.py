@@ -6,7 +6,7 @@ from typing import Dict, Any
 from transformers import AutoTokenizer
 import nltk
 
-from lib.data_types import ApiPayload, JsonDataException
+from lib.data_types import ApiPayload, JsonDataException, cpu_bound
 
 nltk.download("words")
 WORD_LIST = nltk.corpus.words.words()
@@ -28,6 +28,7 @@ class InputData(ApiPayload):
     def generate_payload_json(self) -> Dict[str, Any]:
         return dataclasses.asdict(self)
 
+    @cpu_bound
     def count_workload(self) -> int:
         return len(tokenizer.tokenize(self.prompt))
 
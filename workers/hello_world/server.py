@@ -20,6 +20,7 @@ from aiohttp import web, ClientResponse
 from lib.backend import Backend, LogAction
 from lib.data_types import EndpointHandler
 from lib.server import start_server
+from lib.load_progress import tgi_download_progress
 from .data_types import InputData
 
 # the url and port of model API
@@ -50,6 +51,11 @@ class GenerateHandler(EndpointHandler[InputData]):
         # the API endpoint
         return "/generate"
 
+    @property
+    def healthcheck_endpoint(self) -> str:
+        # probed if the model stops making progress
+        return "/healthcheck"
+
     @classmethod
     def payload_cls(cls) -> Type[InputData]:
         return InputData
@@ -141,6 +147,8 @@ backend = Backend(
             for error_msg in MODEL_SERVER_ERROR_LOG_MSGS
         ],
     ],
+    # parses the model's download progress from its log lines, reported to the autoscaler while it loads
+    load_progress_extractors=[tgi_download_progress],
 )
 
 
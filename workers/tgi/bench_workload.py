@@ -0,0 +1,58 @@
+"""
+measures the overhead of counting workload for a chat request, i.e:
+
+python3 -m workers.tgi.bench_workload -n 1000
+"""
+
+import time
+import random
+import argparse
+import dataclasses
+
+from .data_types import InputData, get_encoding, token_counts
+
+
+def time_per_request(payloads, clear_cache: bool) -> float:
+    start = time.perf_counter()
+    for payload in payloads:
+        if clear_cache:
+            token_counts.clear()
+        payload.count_workload()
+    return (time.perf_counter() - start) / len(payloads)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark TGI workload counting")
+    arg_parser.add_argument(
+        "-n", dest="num_requests", type=int, default=1000, help="number of requests"
+    )
+    args = arg_parser.parse_args()
+    print(f"tiktoken encoding: {get_encoding()}")
+
+    test_payload = InputData.for_test()
+    prompt_tokens = test_payload.count_prompt_tokens()
+    same_payloads = [InputData.for_test() for _ in range(args.num_requests)]
+    # same system prompt, but a different document in every request, like the brand detection task
+    system_message, user_message = test_payload.messages
+    unique_payloads = [
+        dataclasses.replace(
+            test_payload,
+            messages=[
+                system_message,
+                dict(
+                    user_message,
+                    content=f"{random.random()} {user_message['content']}",
+                ),
+            ],
+        )
+        for _ in range(args.num_requests)
+    ]
+
+    results = {
+        "uncached": time_per_request(same_payloads, clear_cache=True),
+        "cached (repeated request)": time_per_request(same_payloads, clear_cache=False),
+        "cached system prompt": time_per_request(unique_payloads, clear_cache=False),
+    }
+    print(f"prompt tokens: {prompt_tokens}, workload: {test_payload.count_workload()}")
+    for name, seconds in results.items():
+        print(f"{name.ljust(28)}: {seconds * 1e6:10.1f} us/request")
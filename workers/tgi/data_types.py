@@ -1,9 +1,84 @@
 import dataclasses
 import inspect
-from typing import Dict, Any, Optional
-from lib.data_types import ApiPayload, JsonDataException
+import logging
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import ClassVar, Dict, Any, Optional
+from functools import cache
+from math import ceil
+
+import tiktoken
+
+from lib.data_types import ApiPayload, JsonDataException, cpu_bound
 from tasks.brand import bench_messages
 
+log = logging.getLogger(__file__)
+
+# workload = PROMPT_TOKEN_WEIGHT * prompt_tokens + COMPLETION_TOKEN_WEIGHT * max_tokens * n
+# prompt tokens are prefilled in parallel, so each one is much cheaper than a generated token, which needs its
+# own forward pass. With long system prompts they still make up most of the cost of a request
+PROMPT_TOKEN_WEIGHT = 0.1
+COMPLETION_TOKEN_WEIGHT = 1.0
+# tokens added by the chat template around each message
+TOKENS_PER_MESSAGE = 4
+# tiktoken is only used to approximate the model's tokenizer, which is good enough to count workload
+TIKTOKEN_ENCODING = "cl100k_base"
+# number of distinct message contents whose token count is memoized, the system prompt of every request is
+# the same, so it is tokenized only once
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+# token counts of recently seen message contents, keyed by a digest of the content so that the cache doesn't
+# keep long prompts and documents alive
+token_counts: "OrderedDict[bytes, int]" = OrderedDict()
+# counted in the hook executor's threads
+token_counts_lock = threading.Lock()
+
+
+@cache
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    try:
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception as e:
+        log.debug(
+            f"failed to load tiktoken encoding, token counts will be approximate: {e}"
+        )
+        return None
+
+
+def count_tokens(content: str) -> int:
+    key = blake2b(content.encode(), digest_size=16).digest()
+    with token_counts_lock:
+        tokens = token_counts.get(key)
+        if tokens is not None:
+            token_counts.move_to_end(key)
+            return tokens
+    encoding = get_encoding()
+    if encoding is None:
+        # roughly 4 characters per token for english text
+        tokens = ceil(len(content) / 4)
+    else:
+        tokens = len(encoding.encode_ordinary(content))
+    with token_counts_lock:
+        token_counts[key] = tokens
+        if len(token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            token_counts.popitem(last=False)
+    return tokens
+
+
+def count_message_tokens(message: Dict[str, Any]) -> int:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        # content parts, only text parts are counted
+        tokens = sum(
+            count_tokens(part.get("text", ""))
+            for part in content
+            if isinstance(part, dict)
+        )
+    else:
+        tokens = count_tokens(str(content))
+    return tokens + TOKENS_PER_MESSAGE
+
 
 def no_default_str(cls):  # Decorator for class.
     def __str__(self):
@@ -20,6 +95,11 @@ def no_default_str(cls):  # Decorator for class.
 @dataclasses.dataclass
 @no_default_str
 class InputData(ApiPayload):
+    # weighted prompt and completion tokens, as counted with TIKTOKEN_ENCODING
+    workload_unit: ClassVar[str] = (
+        f"{TIKTOKEN_ENCODING}:{PROMPT_TOKEN_WEIGHT}:{COMPLETION_TOKEN_WEIGHT}"
+    )
+
     messages: list
     max_tokens: int
     stream: bool = False
@@ -97,8 +177,25 @@ class InputData(ApiPayload):
     def generate_payload_json(self) -> Dict[str, Any]:
         return dataclasses.asdict(self)
 
-    def count_workload(self) -> int:
-        return self.max_tokens
+    def count_prompt_tokens(self) -> int:
+        return sum(count_message_tokens(message) for message in self.messages)
+
+    @cpu_bound
+    def count_workload(self) -> float:
+        return (
+            PROMPT_TOKEN_WEIGHT * self.count_prompt_tokens()
+            + COMPLETION_TOKEN_WEIGHT * self.max_tokens * (self.n or 1)
+        )
+
+    def count_actual_workload(self, usage: Dict[str, Any]) -> Optional[float]:
+        # completion_tokens already counts the tokens of all `n` choices
+        try:
+            return (
+                PROMPT_TOKEN_WEIGHT * usage["prompt_tokens"]
+                + COMPLETION_TOKEN_WEIGHT * usage["completion_tokens"]
+            )
+        except (KeyError, TypeError):
+            return None
 
     @classmethod
     def from_json_msg(cls, json_msg: Dict[str, Any]) -> "InputData":
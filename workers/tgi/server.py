@@ -1,4 +1,5 @@
 import os
+import json
 import logging
 from typing import Union, Type
 import dataclasses
@@ -6,8 +7,9 @@ import dataclasses
 from aiohttp import web, ClientResponse
 
 from lib.backend import Backend, LogAction
-from lib.data_types import EndpointHandler
+from lib.data_types import EndpointHandler, STREAM_STATS_KEY
 from lib.server import start_server
+from lib.load_progress import tgi_download_progress
 from .data_types import InputData
 
 
@@ -29,8 +31,48 @@ logging.basicConfig(
 log = logging.getLogger(__file__)
 
 
+async def stream_chat_response(
+    client_request: web.Request, model_response: ClientResponse
+) -> web.StreamResponse:
+    """
+    forwards the server-sent events of a streamed chat completion to the client as soon as they are received.
+    Every event carries a single token, the last one may only carry the usage of the request
+    """
+    stream_stats = client_request.get(STREAM_STATS_KEY)
+    res = web.StreamResponse()
+    res.content_type = "text/event-stream"
+    await res.prepare(client_request)
+    try:
+        # the response is read line by line, so at most one event line is buffered at a time
+        async for line in model_response.content:
+            await res.write(line)
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:") :].strip()
+            if data == b"[DONE]":
+                continue
+            if b'"usage":{' in data:
+                event = json.loads(data)
+                EndpointHandler.report_usage(client_request, event["usage"])
+                if not event.get("choices"):
+                    continue
+            if stream_stats is not None:
+                stream_stats.token()
+        await res.write_eof()
+    except ConnectionResetError:
+        # the client disconnected mid-stream, the response is already prepared so it can't become an error
+        log.debug("Client disconnected while streaming response")
+        EndpointHandler.report_cancelled(client_request)
+        return res
+    log.debug("Done streaming response")
+    return res
+
+
 @dataclasses.dataclass
 class ChatHandler(EndpointHandler[InputData]):
+    """
+    handles both streamed and non streamed chat completions, depending on the `stream` field of the payload
+    """
 
     @property
     def endpoint(self) -> str:
@@ -38,7 +80,8 @@ class ChatHandler(EndpointHandler[InputData]):
 
     @property
     def healthcheck_endpoint(self) -> str:
-        return f"{MODEL_SERVER_URL}/health"
+        # TGI's health check runs a single token generation through every shard
+        return "/health"
 
     @classmethod
     def payload_cls(cls) -> Type[InputData]:
@@ -50,11 +93,15 @@ class ChatHandler(EndpointHandler[InputData]):
     async def generate_client_response(
         self, client_request: web.Request, model_response: ClientResponse
     ) -> Union[web.Response, web.StreamResponse]:
-        _ = client_request
         match model_response.status:
+            case 200 if model_response.content_type == "text/event-stream":
+                log.debug("Streaming response...")
+                return await stream_chat_response(client_request, model_response)
             case 200:
                 log.debug("SUCCESS")
                 data = await model_response.json()
+                if data.get("usage"):
+                    self.report_usage(client_request, data["usage"])
                 return web.json_response(data=data)
             case code:
                 log.debug("SENDING RESPONSE: ERROR: unknown code")
@@ -74,6 +121,7 @@ backend = Backend(
             for error_msg in MODEL_SERVER_ERROR_LOG_MSGS
         ],
     ],
+    load_progress_extractors=[tgi_download_progress],
 )
 
 
@@ -90,7 +138,7 @@ async def handle_ping(_):
     #            cur_perf=self.model_metrics.cur_perf,
     #            error_msg=self.model_metrics.error_msg or "",
     #            num_requests_working=len(self.model_metrics.requests_working),
-    #            num_requests_recieved=len(self.model_metrics.requests_recieved),
+    #            num_requests_recieved=self.model_metrics.requests_recieved_total,
     #            additional_disk_usage=self.system_metrics.additional_disk_usage,
     #            cur_capacity=0,
     #            max_capacity=0,
@@ -103,11 +151,21 @@ async def handle_ping(_):
         'id': backend.metrics.id,
         'loadtime': (backend.metrics.system_metrics.model_loading_time or 0.0),
         'max_perf': backend.metrics.model_metrics.max_throughput,
-        'cur_perf': backend.metrics.model_metrics.cur_perf,
+        'cur_load': backend.metrics.cur_load,
+        'cur_perf': backend.metrics.cur_perf,
+        'cur_perf_raw': backend.metrics.model_metrics.cur_perf,
         'error_msg': backend.metrics.model_metrics.error_msg or "",
         'num_requests_working': len(backend.metrics.model_metrics.requests_working),
-        'num_requests_recieved': len(backend.metrics.model_metrics.requests_recieved),
+        'num_requests_recieved': backend.metrics.model_metrics.requests_recieved_total,
         'additional_disk_usage': backend.metrics.system_metrics.additional_disk_usage,
+        'workload_estimation_error': backend.metrics.model_metrics.workload_estimation_error,
+        'time_to_first_token': backend.metrics.model_metrics.time_to_first_token,
+        'inter_token_latency': backend.metrics.model_metrics.inter_token_latency,
+        'tokens_per_second': backend.metrics.model_metrics.tokens_per_second,
+        'cur_capacity': backend.metrics.cur_capacity,
+        'max_capacity': backend.metrics.max_capacity,
+        'estimated_wait': backend.metrics.estimated_wait,
+        'headroom': backend.metrics.headroom,
         'url': backend.metrics.url,
     }
     return web.json_response(res)